@@ -0,0 +1,34 @@
+#ifndef EVENTTREEFRIEND_H
+#define EVENTTREEFRIEND_H
+
+/*
+  Reader helper for ntuples written with normalizeEventData = True
+
+  In this mode clustTree, trajTree, trackTree, digiTree and
+  nonPropagatedExtraTrajTree store only the eventIndex branch
+  (run/I:ls:evt) instead of a full copy of the event branch.
+  attachEventTree() makes eventTree a friend of such a tree, indexed
+  with the run and event numbers, so the event fields can be used as
+  before, e.g.:
+
+    TChain* trajTree  = new TChain("trajTree");
+    TChain* eventTree = new TChain("eventTree");
+    trajTree  -> Add("Ntuple*.root");
+    eventTree -> Add("Ntuple*.root");
+    attachEventTree(trajTree, eventTree);
+    trajTree -> Draw("event.nvtx", "traj.validhit == 1");
+
+  For SetBranchAddress() based loops, the event branch is set on the
+  friend tree: eventTree -> SetBranchAddress("event", &evt);
+  trajTree -> GetEntry(i) then also loads the matching event.
+*/
+
+#include <TTree.h>
+
+inline void attachEventTree(TTree* tree, TTree* eventTree) {
+  // The leaves run and evt exist in both the event and the eventIndex branch
+  if(eventTree -> GetTreeIndex() == nullptr) eventTree -> BuildIndex("run", "evt");
+  tree -> AddFriend(eventTree);
+}
+
+#endif
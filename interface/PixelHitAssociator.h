@@ -12,11 +12,18 @@
  *
  * \version   1st version: April 2006. Add configurable switch: August 2006   
  * Adopted for pixel only. dk 3/2014
+ * Indexed lookup: the sim hits are indexed by module and by
+ * (module, sim track, event) in reset(), the digi sim links of a module
+ * are decoded and sorted by column at the first lookup on the module.
+ * The associator refers to the sim hits of the event, it does not copy
+ * them. It is created once per job with the consumes of the inputs and
+ * reset() for every event, the indices keep their capacity.
  *
  ************************************************************/
 
 #include "FWCore/ParameterSet/interface/ParameterSet.h"
 #include "FWCore/Framework/interface/Event.h"
+#include "FWCore/Framework/interface/ConsumesCollector.h"
 #include "DataFormats/Common/interface/Handle.h"
 
 //--- for SimHit
@@ -52,6 +59,7 @@
 
 #include <string>
 #include <vector>
+#include <unordered_map>
 
 
 typedef std::pair<uint32_t, EncodedEventId> SimHitIdpr;
@@ -61,13 +69,18 @@ class PixelHitAssociator {
  public:
   
   // Simple constructor
-  PixelHitAssociator(const edm::Event& e);
+  PixelHitAssociator(edm::ConsumesCollector&& iC);
   // Constructor with configurables
-  PixelHitAssociator(const edm::Event& e, const edm::ParameterSet& conf);
+  PixelHitAssociator(const edm::ParameterSet& conf, edm::ConsumesCollector&& iC);
   // Destructor
   virtual ~PixelHitAssociator(){}
+
+  // Reads the sim hits and the digi sim links of the event, to be called for every event
+  void reset(const edm::Event& e);
   
-  std::vector<PSimHit> associateHit(const TrackingRecHit&, LocalPoint);
+  // The sim hits matched to the rechit in the order of the sim hit collections,
+  // valid until the next call
+  const std::vector<const PSimHit*>& associateHit(const TrackingRecHit&, LocalPoint);
   //std::vector<PSimHit> associateHit(const SiPixelRecHit & thit);
   void associatePixelRecHit(const SiPixelRecHit*, std::vector<SimHitIdpr>&);
 
@@ -105,15 +118,46 @@ class PixelHitAssociator {
   //std::vector<SimHitIdpr> associateGSMatchedRecHit(const SiTrackerGSMatchedRecHit2D * gsmrechit);
   
   //std::vector<PSimHit> theStripHits;
-  typedef std::map<unsigned int, std::vector<PSimHit> > simhit_map;
-  typedef simhit_map::iterator simhit_map_iterator;
-  simhit_map SimHitMap;
   //std::vector<PSimHit> thePixelHits;
  
  private:
-  const edm::Event& myEvent_;
+  // Digi sim link decoded to pixel coordinates
+  struct ModuleLink {
+    int        col;
+    int        row;
+    SimHitIdpr id;
+  };
+  struct SimHitKey {
+    uint32_t     detId;
+    unsigned int trackId;
+    uint32_t     eventId;
+    bool operator==(const SimHitKey& other) const {
+      return detId == other.detId && trackId == other.trackId && eventId == other.eventId;
+    }
+  };
+  struct SimHitKeyHash {
+    size_t operator()(const SimHitKey& key) const {
+      size_t hash = std::hash<uint32_t>()(key.detId);
+      hash ^= std::hash<unsigned int>()(key.trackId) + 0x9e3779b9 + (hash << 6) + (hash >> 2);
+      hash ^= std::hash<uint32_t>()(key.eventId)     + 0x9e3779b9 + (hash << 6) + (hash >> 2);
+      return hash;
+    }
+  };
+
+  struct ModuleIndex {
+    std::vector<const PSimHit*> simHits;           // in the order of the collections
+    std::vector<int>            nextSimHitOfTrack; // position of the next sim hit of the same sim track, -1 if none
+    std::vector<ModuleLink>     links;             // sorted by column, filled at the first lookup
+    bool                        linksFilled = false;
+  };
+
+  void consumeInputs(edm::ConsumesCollector&);
+  const std::vector<ModuleLink>& getModuleLinks(uint32_t, ModuleIndex&);
+
   typedef std::vector<std::string> vstring;
   vstring trackerContainers;
+  std::vector<edm::EDGetTokenT<std::vector<PSimHit>>>   simHitTokens_;
+  edm::EDGetTokenT<edm::DetSetVector<PixelDigiSimLink>> pixelDigiSimLinkToken_;
 
   //ADDED NOW AS A PRIVATE MEMBER
   //edm::Handle<CrossingFrame<PSimHit> > cf_simhit;
@@ -129,6 +173,13 @@ class PixelHitAssociator {
   std::vector<int> simhitCFPos;
   std::vector<PSimHit> simhitassoc;
   bool StripHits;  
+
+  // Sim hits and digi sim links of the modules, the entries are kept between the events
+  std::unordered_map<uint32_t, ModuleIndex> moduleIndex_;
+  // First and last positions in ModuleIndex::simHits of the sim hits of a sim track on a module
+  std::unordered_map<SimHitKey, std::pair<int, int>, SimHitKeyHash> simHitsOfTrack_;
+  std::vector<int>             matchedSimHitIndices_;
+  std::vector<const PSimHit*>  matchedSimHits_;
   //bool doPixel_, doStrip_, doTrackAssoc_;
   
 };  
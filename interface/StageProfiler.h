@@ -0,0 +1,127 @@
+#ifndef StageProfiler_h
+#define StageProfiler_h
+
+/* \class StageProfiler
+ *
+ ** Wall clock time and memory usage of the processing stages of an event
+ *  - every started stage pauses the running one, so the time of each
+ *    stage excludes the stages called from it (e.g. the layer 1
+ *    propagation and the tree fills inside the trajectory loop)
+ *  - time spent outside of any stage is booked as "other"
+ *  - the resident memory of the process is sampled at the start and
+ *    the end of the stages called directly from analyze(), the peak
+ *    memory increase of an event is the largest increase with respect
+ *    to the start of the event (allocations released within a stage
+ *    are not seen)
+ *  Per-event histograms of the stages are booked in a directory of the
+ *  output file, and a summary table is printed at the end of the job.
+ *
+ ************************************************************/
+
+#include <TDirectory.h>
+#include <TH1D.h>
+
+#include <array>
+#include <chrono>
+#include <string>
+#include <vector>
+
+class StageProfiler {
+
+ public:
+
+  enum Stage {
+    evtData = 0,
+    digiData,
+    simhitData,
+    clustData,
+    trackData,
+    trajTrackData,
+    layer1Propagation,
+    simMatching,
+    treeFill,
+    other,
+    numStages
+  };
+
+  // Times the enclosing block as the given stage, does nothing
+  // without a profiler or outside of an event
+  class Scope {
+   public:
+    Scope(StageProfiler* profiler, Stage stage) :
+      profiler_(profiler != nullptr && profiler -> isInEvent() ? profiler : nullptr) {
+      if(profiler_) profiler_ -> start(stage);
+    }
+    ~Scope() { if(profiler_) profiler_ -> stop(); }
+    Scope(const Scope&) = delete;
+    Scope& operator=(const Scope&) = delete;
+   private:
+    StageProfiler* profiler_;
+  };
+
+  // Delimits an event, also on early returns
+  class EventScope {
+   public:
+    EventScope(StageProfiler* profiler) : profiler_(profiler) {
+      if(profiler_) profiler_ -> beginEvent();
+    }
+    ~EventScope() { if(profiler_) profiler_ -> endEvent(); }
+    EventScope(const EventScope&) = delete;
+    EventScope& operator=(const EventScope&) = delete;
+   private:
+    StageProfiler* profiler_;
+  };
+
+  StageProfiler() {}
+  virtual ~StageProfiler() {}
+
+  // The histograms are owned and written by the directory
+  void bookHistograms(TDirectory* directory);
+
+  void beginEvent();
+  void endEvent();
+  void start(Stage stage);
+  void stop();
+  bool isInEvent() const { return !stageStack_.empty(); }
+
+  void printSummary() const;
+
+  static const char* getStageName(Stage stage);
+
+ private:
+
+  using Clock = std::chrono::steady_clock;
+
+  struct StageStats {
+    long long int calls      = 0;
+    long long int events     = 0; // events in which the stage was called
+    double        totalTime  = 0; // [ms]
+    double        maxTime    = 0; // [ms], per event
+    double        eventTime  = 0; // [ms]
+    long long int eventCalls = 0;
+    TH1D*         histogram  = nullptr;
+  };
+
+  void chargeRunningStage();
+  void sampleMemory();
+  static long long int getResidentBytes();
+
+  std::array<StageStats, numStages> stages_;
+  std::vector<Stage>                stageStack_;
+  Clock::time_point                 lastTime_;
+  Clock::time_point                 eventStartTime_;
+
+  long long int numEvents_          = 0;
+  double        totalEventTime_     = 0; // [ms]
+  double        maxEventTime_       = 0; // [ms]
+  TH1D*         eventTimeHistogram_ = nullptr;
+
+  long long int eventStartMemory_            = 0;
+  long long int eventMaxMemory_              = 0;
+  double        totalPeakMemoryIncrease_     = 0; // [MB]
+  double        maxPeakMemoryIncrease_       = 0; // [MB]
+  TH1D*         peakMemoryIncreaseHistogram_ = nullptr;
+
+};
+
+#endif
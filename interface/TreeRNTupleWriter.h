@@ -0,0 +1,89 @@
+#ifndef TreeRNTupleWriter_h
+#define TreeRNTupleWriter_h
+
+/* \class TreeRNTupleWriter
+ *
+ ** Writes the entries of a TTree made of leaf-list branches into an
+ *  RNTuple of the same name, so that single columns can be read
+ *  without decompressing the whole structs:
+ *  - every branch becomes a record field with a subfield per leaf
+ *    (e.g. traj.validhit, mod_on.layer), fixed size arrays become
+ *    std::array fields
+ *  - variable length leaves (adc[size], federrs[federrs_size][2]) are
+ *    written as flattened std::vector fields, named after the branch,
+ *    or <branch>_<leaf> if the branch has other leaves too
+ *  The branch addresses are read at every fill, so the tree and its
+ *  data objects are used as they are.
+ *
+ ************************************************************/
+
+#include <RVersion.h>
+
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,32,0)
+#define TREE_RNTUPLE_WRITER_AVAILABLE
+
+#include <ROOT/REntry.hxx>
+#include <ROOT/RField.hxx>
+#include <ROOT/RNTupleModel.hxx>
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,34,0)
+#include <ROOT/RNTupleWriter.hxx>
+#else
+#include <ROOT/RNTuple.hxx>
+#endif
+
+#include <TFile.h>
+#include <TTree.h>
+#include <TBranch.h>
+#include <TLeaf.h>
+
+#include <memory>
+#include <string>
+#include <vector>
+
+// The RNTuple classes left the Experimental namespace in ROOT 6.36
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,36,0)
+namespace RNTupleAPI = ROOT;
+#else
+namespace RNTupleAPI = ROOT::Experimental;
+#endif
+
+class TreeRNTupleWriter {
+
+ public:
+
+  // The RNTuple is appended to the given file
+  TreeRNTupleWriter(TTree* tree, TFile& file);
+  // Commits the RNTuple
+  virtual ~TreeRNTupleWriter() {}
+
+  // Writes the current content of the branches of the tree
+  void fill();
+
+ private:
+
+  struct RecordColumn {
+    TBranch*    branch;
+    std::string fieldName;
+  };
+
+  struct VariableLengthColumn {
+    TBranch*           branch;
+    TLeaf*             leaf;
+    std::string        fieldName;
+    int                staticLength; // number of values per count
+    bool               isFloat;
+    std::vector<float> floatValues;
+    std::vector<int>   intValues;
+  };
+
+  std::vector<RecordColumn>         recordColumns_;
+  std::vector<VariableLengthColumn> variableLengthColumns_;
+
+  std::unique_ptr<RNTupleAPI::RNTupleWriter> writer_;
+  std::unique_ptr<RNTupleAPI::REntry>        entry_;
+
+};
+
+#endif
+
+#endif
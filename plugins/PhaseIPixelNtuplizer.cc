@@ -16,8 +16,15 @@ constexpr float                PhaseIPixelNtuplizer::MEAS_HITSEP_CUT_VAL;
 constexpr float                PhaseIPixelNtuplizer::HIT_CLUST_NEAR_CUT_VAL;
 constexpr float                PhaseIPixelNtuplizer::BARREL_MODULE_EDGE_X_CUT;
 constexpr float                PhaseIPixelNtuplizer::BARREL_MODULE_EDGE_Y_CUT;
+constexpr std::array<PhaseIPixelNtuplizer::ROCEfficiencyBinning, 5> PhaseIPixelNtuplizer::ROC_EFFICIENCY_BINNINGS;
+constexpr double               NtuplizerHelpers::PtEtaHash::CELL_SIZE;
 
+#ifdef NTUPLIZER_MULTISTREAM
+PhaseIPixelNtuplizer::PhaseIPixelNtuplizer(edm::ParameterSet const& iConfig,
+					   const NtuplizerHelpers::OutputCache*) : 
+#else
 PhaseIPixelNtuplizer::PhaseIPixelNtuplizer(edm::ParameterSet const& iConfig) : 
+#endif
   iConfig_(iConfig),
   ntupleOutputFilename_(iConfig.getUntrackedParameter<std::string>
 			("outputFileName", "Ntuple.root")),
@@ -35,7 +42,14 @@ PhaseIPixelNtuplizer::PhaseIPixelNtuplizer(edm::ParameterSet const& iConfig) :
   keepAllTrackerMuons_(iConfig.getUntrackedParameter<bool>("keepAllTrackerMuons", true)),
   npixFromDigiCollection_(iConfig.getUntrackedParameter<bool>("npixFromDigiCollection", false)),
   minVertexSize_(15),
-  efficiencyCalculationFrequency_(iConfig.getUntrackedParameter<int>("efficiencyCalculationFrequency_", 1))
+  efficiencyCalculationFrequency_(iConfig.getUntrackedParameter<int>("efficiencyCalculationFrequency_", 1)),
+  benchmarkModuleTable_(iConfig.getUntrackedParameter<bool>("benchmarkModuleTable", false)),
+  outputSettings_(iConfig.getUntrackedParameter<edm::ParameterSet>("outputSettings", edm::ParameterSet())),
+  saveRNTuple_(iConfig.getUntrackedParameter<bool>("saveRNTuple", false)),
+  normalizeEventData_(iConfig.getUntrackedParameter<bool>("normalizeEventData", false)),
+  profileStages_(iConfig.getUntrackedParameter<bool>("profileStages", false)),
+  efficiencyOnly_(iConfig.getUntrackedParameter<bool>("efficiencyOnly", false)),
+  downscaleMode_(iConfig.getUntrackedParameter<std::string>("downscaleMode", "counter"))
 #if CMSSW_VERSION >= 123
   ,
   trackBuilderToken_(esConsumes(edm::ESInputTag("", "TransientTrackBuilder"))),
@@ -58,6 +72,32 @@ PhaseIPixelNtuplizer::PhaseIPixelNtuplizer(edm::ParameterSet const& iConfig) :
   if(saveNonPropagatedExtraTrajTree_) 
     std::cout << "Option recognized: request to save the traj." \
       " measurements replaced by track propagation as a separate tree." << std::endl;
+  if(benchmarkModuleTable_)
+    std::cout << "Option recognized: request to benchmark the module data table." << std::endl;
+  if(!outputSettings_.getParameterNames().empty())
+    std::cout << "Option recognized: request to customize the output compression and baskets." << std::endl;
+  if(saveRNTuple_)
+    std::cout << "Option recognized: request to save the trees as RNTuples in a separate file." << std::endl;
+  if(normalizeEventData_)
+    std::cout << "Option recognized: request to save only the event index instead of the event"
+      " data outside the eventTree." << std::endl;
+  if(profileStages_)
+    std::cout << "Option recognized: request to profile the processing stages of the events." << std::endl;
+  if(efficiencyOnly_)
+    std::cout << "Option recognized: request to save only the traj. measurements entering the efficiency." << std::endl;
+  if(downscaleMode_ == "hash")
+    std::cout << "Option recognized: request to downscale the events, tracks and clusters"
+      " by a hash of their identifiers." << std::endl;
+  else if(downscaleMode_ != "counter")
+    throw cms::Exception("configuration")
+      << "Unknown downscale mode: " << downscaleMode_ << " (expected counter or hash)";
+  hashDownscaling_ = downscaleMode_ == "hash";
+#ifndef NTUPLIZER_MULTISTREAM
+  if(iConfig.exists("outputMode"))
+    throw cms::Exception("configuration")
+      << "outputMode is only used by the multi-stream plugin: build it with -DNTUPLIZER_MULTISTREAM"
+      " (see README), this plugin processes one event at a time";
+#endif
 
   // Tokens
   rawDataErrorToken_ = consumes<edm::DetSetVector<SiPixelRawDataError>>
@@ -81,6 +121,7 @@ PhaseIPixelNtuplizer::PhaseIPixelNtuplizer(edm::ParameterSet const& iConfig) :
     if(saveDigiTree_ || npixFromDigiCollection_) pixelDigiCollectionToken_ = consumes<edm::DetSetVector<PixelDigi>>
 						   (edm::InputTag("simSiPixelDigis"));
     trackerHitAssociatorConfig_ = TrackerHitAssociator::Config(iConfig, consumesCollector());
+    pixelHitAssociator_ = std::make_unique<PixelHitAssociator>(consumesCollector());
     simhitCollectionTokens_.insert
       (simhitCollectionTokens_.end(), {
 	consumes<std::vector<PSimHit> >(edm::InputTag("g4SimHits", "TrackerHitsPixelBarrelHighTof")),
@@ -99,20 +140,132 @@ PhaseIPixelNtuplizer::PhaseIPixelNtuplizer(edm::ParameterSet const& iConfig) :
   }
 
   muonCollectionToken_ = consumes<reco::MuonCollection>(iConfig.getParameter<edm::InputTag>("muonCollection"));
+
+  // ROC efficiency counters
+  rocEfficiencyOffsets_ = getROCEfficiencyOffsets();
+  const int numROCEfficiencyBins = rocEfficiencyOffsets_.back() +
+    ROC_EFFICIENCY_BINNINGS.back().nx * ROC_EFFICIENCY_BINNINGS.back().ny;
+  rocEfficiencyPassed_.assign(numROCEfficiencyBins, 0);
+  rocEfficiencyTotal_ .assign(numROCEfficiencyBins, 0);
 }
 
 PhaseIPixelNtuplizer::~PhaseIPixelNtuplizer() {}
 
+#ifdef NTUPLIZER_MULTISTREAM
+std::unique_ptr<NtuplizerHelpers::OutputCache> PhaseIPixelNtuplizer::initializeGlobalCache
+(edm::ParameterSet const& iConfig) {
+
+  const std::string outputFilename = iConfig.getUntrackedParameter<std::string>("outputFileName", "Ntuple.root");
+  const edm::ParameterSet outputSettings =
+    iConfig.getUntrackedParameter<edm::ParameterSet>("outputSettings", edm::ParameterSet());
+  int compressionSettings = getCompressionSettings
+    (outputSettings.getUntrackedParameter<std::string>("compressionAlgorithm", ""),
+     outputSettings.getUntrackedParameter<int>("compressionLevel", -1));
+  // ROOT default
+  if(compressionSettings == -1) compressionSettings = 101;
+  const std::string outputMode = iConfig.getUntrackedParameter<std::string>("outputMode", "bufferMerger");
+
+  auto outputCache = std::make_unique<NtuplizerHelpers::OutputCache>();
+  outputCache -> outputFilename      = outputFilename;
+  outputCache -> compressionSettings = compressionSettings;
+  outputCache -> outputSettings      = outputSettings;
+  if(outputMode == "bufferMerger") {
+    outputCache -> merger = std::make_unique<NtuplizerHelpers::BufferMerger>
+      (outputFilename.c_str(), "RECREATE", compressionSettings);
+    std::cout << "Output file: \"" << outputFilename << "\" created, filled by all streams." << std::endl;
+  } else if(outputMode == "subFiles") {
+    std::cout << "Option recognized: request to write a file per stream, merged into \""
+	      << outputFilename << "\" at the end of the job." << std::endl;
+  } else throw cms::Exception("configuration")
+	   << "Unknown output mode: " << outputMode << " (expected bufferMerger or subFiles)";
+  return outputCache;
+}
+
+void PhaseIPixelNtuplizer::globalEndJob(NtuplizerHelpers::OutputCache* outputCache) {
+
+  // The windows of the last lumisections are not complete yet
+  while(!outputCache -> rocEfficiencyWindows.empty())
+    completeROCEfficiencyWindow(*outputCache, outputCache -> rocEfficiencyWindows.begin());
+
+  // Merges the remaining buffers and closes the output file
+  if(outputCache -> merger) {
+    auto summaryFile = outputCache -> merger -> GetFile();
+    writeSummaryTrees(*outputCache, summaryFile.get());
+    summaryFile -> Write();
+    summaryFile.reset();
+    std::cout << "Closing the output file of the streams." << std::endl;
+    outputCache -> merger.reset();
+    return;
+  }
+
+  // The trajTree entries of the merged file are ordered by stream
+  std::stable_sort(outputCache -> rocEfficiencyBatches.begin(), outputCache -> rocEfficiencyBatches.end(),
+		   [] (const NtuplizerHelpers::ROCEfficiencyBatch& lhs, const NtuplizerHelpers::ROCEfficiencyBatch& rhs)
+		   { return lhs.subFile < rhs.subFile; });
+  const std::string& outputFilename = outputCache -> outputFilename;
+  const std::string summaryFilename = outputFilename.substr(0, outputFilename.rfind(".root")) + "_summary.root";
+  TFile summaryFile(summaryFilename.c_str(), "RECREATE", "", outputCache -> compressionSettings);
+  if(!summaryFile.IsOpen())
+    throw cms::Exception("file_operations") << "Failed to open output file: " << summaryFilename;
+  writeSummaryTrees(*outputCache, &summaryFile);
+  summaryFile.Write();
+  summaryFile.Close();
+  outputCache -> subFilenames.push_back(summaryFilename);
+
+  // Merges the files of the streams
+  std::cout << "Merging the files of the streams into: \"" << outputCache -> outputFilename
+	    << "\"." << std::endl;
+  TFileMerger fileMerger(kFALSE, kFALSE);
+  fileMerger.SetPrintLevel(0);
+  fileMerger.OutputFile(outputCache -> outputFilename.c_str(), "RECREATE",
+			outputCache -> compressionSettings);
+  for(const auto& subFilename: outputCache -> subFilenames)
+    fileMerger.AddFile(subFilename.c_str());
+  if(!fileMerger.Merge())
+    throw cms::Exception("file_operations")
+      << "Failed to merge the stream files into: " << outputCache -> outputFilename;
+  for(const auto& subFilename: outputCache -> subFilenames)
+    std::remove(subFilename.c_str());
+}
+
+void PhaseIPixelNtuplizer::beginStream(edm::StreamID streamID) {
+  streamIndex_ = streamID.value();
+  {
+    std::lock_guard<std::mutex> lock(globalCache() -> summaryMutex);
+    ++globalCache() -> numStreams;
+  }
+  beginJob();
+}
+
+void PhaseIPixelNtuplizer::endStream() { endJob(); }
+#endif
+
 void PhaseIPixelNtuplizer::beginJob()
 {
   setTriggerTable();
 
-  // Create output file
-  ntupleOutputFile_ = new TFile(ntupleOutputFilename_.c_str(), "RECREATE");
-  if(!(ntupleOutputFile_ -> IsOpen())) {
-    handleDefaultError("file_operations", "file_operations",
-		       { "Failed to open output file: ", ntupleOutputFilename_ });
+#ifdef NTUPLIZER_MULTISTREAM
+  if(globalCache() -> merger) {
+    // Create the buffer of the stream, merged into the output file by the global cache
+    streamOutputFile_ = globalCache() -> merger -> GetFile();
+    ntupleOutputFile_ = streamOutputFile_.get();
+    ntupleOutputFile_ -> cd();
+  } else {
+    // Create the file of the stream, merged into the output file in globalEndJob
+    const std::string& outputFilename = globalCache() -> outputFilename;
+    const size_t extensionPosition = outputFilename.rfind(".root");
+    ntupleOutputFilename_ = outputFilename.substr(0, extensionPosition) +
+      "_stream" + std::to_string(streamIndex_) + ".root";
+    {
+      std::lock_guard<std::mutex> lock(globalCache() -> subFilenamesMutex);
+      subFileIndex_ = globalCache() -> subFilenames.size();
+      globalCache() -> subFilenames.push_back(ntupleOutputFilename_);
+    }
+    openOutputFile();
   }
+#else
+  openOutputFile();
+#endif
   LogDebug("file_operations") << "Output file: \"" << ntupleOutputFilename_ 
 			      << "\" created." << std::endl;
 
@@ -130,33 +283,43 @@ void PhaseIPixelNtuplizer::beginJob()
 					     "The original trajectroy measurements replaced by"
 					     " propagated hits in the Pixel detector.");
   }
+#ifndef NTUPLIZER_MULTISTREAM
+  // In the multi-stream build these are written once for all streams in globalEndJob
   trajROCEfficiencyTree_ = new TTree("trajROCEfficiencyTree", "ROC and module efficiencies.");
+  lumiTree_  = new TTree("lumiTree",  "Lumisection summaries.");
+  runTree_   = new TTree("runTree",   "Run summaries.");
+  // Lumi and run trees
+  lumiTree_ -> Branch("lumi", &lumi_, lumi_.list.c_str());
+  runTree_  -> Branch("run",  &run_,  run_.list.c_str());
+  // Efficiency of the detector parts the trajectory measurements are located on
+  trajROCEfficiencyTree_ -> Branch("trajROCEfficiency", &trajROCEff_, trajROCEff_.list.c_str());
+#endif
   // Event tree
   eventTree_ -> Branch("event", &evt_, evt_.list.c_str());
   // Digi tree
   if(saveDigiTree_) {
-    digiTree_ -> Branch("event", &evt_,  evt_.list.c_str());
+    addEventBranch(digiTree_);
     digiTree_ -> Branch("digi",  &digi_, digi_.list.c_str());
   }
   // Cluster tree
-  clustTree_ -> Branch("event",     &evt_,         evt_        .list.c_str());
+  addEventBranch(clustTree_);
   clustTree_ -> Branch("mod_on",    &clu_.mod_on,  clu_.mod_on .list.c_str());
   clustTree_ -> Branch("mod",       &clu_.mod,     clu_.mod    .list.c_str());
   clustTree_ -> Branch("clust",     &clu_,         clu_        .list.c_str());
-  clustTree_ -> Branch("clust_adc", &clu_.adc,     "adc[size]/F");
-  clustTree_ -> Branch("clust_pix", &clu_.pix,     "pix[size][2]/F");
+  clustTree_ -> Branch("clust_adc", clu_.adc.data(), "adc[size]/F");
+  clustTree_ -> Branch("clust_pix", clu_.pix.data(), "pix[size][2]/F");
   // Track tree
   if(saveTrackTree_) {
-    trackTree_ -> Branch("event",     &evt_,         evt_        .list.c_str());
+    addEventBranch(trackTree_);
     trackTree_ -> Branch("track",     &track_,       track_      .list.c_str());
   }
   // Trajectory tree
-  trajTree_  -> Branch("event",     &evt_,          evt_        .list.c_str());
+  addEventBranch(trajTree_);
   trajTree_  -> Branch("mod_on",    &traj_.mod_on,  traj_.mod_on.list.c_str());
   trajTree_  -> Branch("mod",       &traj_.mod,     traj_.mod   .list.c_str());
   trajTree_  -> Branch("clust",     &traj_.clu,     traj_.clu   .list.c_str());
-  trajTree_  -> Branch("clust_adc", &traj_.clu.adc, "adc[size]/F");
-  trajTree_  -> Branch("clust_pix", &traj_.clu.pix, "pix[size][2]/F");
+  trajTree_  -> Branch("clust_adc", traj_.clu.adc.data(), "adc[size]/F");
+  trajTree_  -> Branch("clust_pix", traj_.clu.pix.data(), "pix[size][2]/F");
   trajTree_  -> Branch("track",     &track_,        track_      .list.c_str());
   trajTree_  -> Branch("traj",      &traj_,         traj_       .list.c_str());
   // Additional trajectory tree
@@ -164,17 +327,30 @@ void PhaseIPixelNtuplizer::beginJob()
     nonPropagatedExtraTrajTree_  = new TTree
       ("nonPropagatedExtraTrajTree",
        "The original trajectroy measurements replaced by propagated hits in the Pixel detector.");
-    nonPropagatedExtraTrajTree_  -> Branch("event",     &evt_,          evt_        .list.c_str());
+    addEventBranch(nonPropagatedExtraTrajTree_);
     nonPropagatedExtraTrajTree_  -> Branch("mod_on",    &traj_.mod_on,  traj_.mod_on.list.c_str());
     nonPropagatedExtraTrajTree_  -> Branch("mod",       &traj_.mod,     traj_.mod   .list.c_str());
     nonPropagatedExtraTrajTree_  -> Branch("clust",     &traj_.clu,     traj_.clu   .list.c_str());
-    nonPropagatedExtraTrajTree_  -> Branch("clust_adc", &traj_.clu.adc, "adc[size]/F");
-    nonPropagatedExtraTrajTree_  -> Branch("clust_pix", &traj_.clu.pix, "pix[size][2]/F");
+    nonPropagatedExtraTrajTree_  -> Branch("clust_adc", traj_.clu.adc.data(), "adc[size]/F");
+    nonPropagatedExtraTrajTree_  -> Branch("clust_pix", traj_.clu.pix.data(), "pix[size][2]/F");
     nonPropagatedExtraTrajTree_  -> Branch("track",     &track_,        track_      .list.c_str());
     nonPropagatedExtraTrajTree_  -> Branch("traj",      &traj_,         traj_       .list.c_str());
   }
-  // Efficiency of the detector parts the trajectory measurements are located on
-  trajROCEfficiencyTree_ -> Branch("trajROCEfficiency", &trajROCEff_, trajROCEff_.list.c_str());
+  // Compression, basket size, auto-flush and auto-save settings
+  for(TTree* tree: { eventTree_, clustTree_, trajTree_ })
+    applyOutputSettings(tree);
+#ifndef NTUPLIZER_MULTISTREAM
+  for(TTree* tree: { trajROCEfficiencyTree_, lumiTree_, runTree_ })
+    applyOutputSettings(tree);
+#endif
+  if(saveDigiTree_)                   applyOutputSettings(digiTree_);
+  if(saveTrackTree_)                  applyOutputSettings(trackTree_);
+  if(saveNonPropagatedExtraTrajTree_) applyOutputSettings(nonPropagatedExtraTrajTree_);
+  if(saveRNTuple_) createRNTupleWriters();
+  if(profileStages_) {
+    stageProfiler_ = std::make_unique<StageProfiler>();
+    stageProfiler_ -> bookHistograms(ntupleOutputFile_);
+  }
 #ifdef ADD_CHECK_PLOTS_TO_NTUPLE
   simhitOccupancy_fwd        = new TH2D("simhitOccupancy_fwd", "simhit occupancy - forward", 
 					150, -52.15, 52.15,  300,  -3.14159,  3.14159);
@@ -256,13 +432,38 @@ void PhaseIPixelNtuplizer::beginJob()
 #endif
 }
 
+void PhaseIPixelNtuplizer::openOutputFile()
+{
+  // Create output file
+  ntupleOutputFile_ = new TFile(ntupleOutputFilename_.c_str(), "RECREATE");
+  if(!(ntupleOutputFile_ -> IsOpen())) {
+    handleDefaultError("file_operations", "file_operations",
+		       { "Failed to open output file: ", ntupleOutputFilename_ });
+  }
+  // File level compression, inherited by all trees unless overridden per tree
+  const int compressionSettings = getCompressionSettings
+    (outputSettings_.getUntrackedParameter<std::string>("compressionAlgorithm", ""),
+     outputSettings_.getUntrackedParameter<int>("compressionLevel", -1));
+  if(compressionSettings != -1) ntupleOutputFile_ -> SetCompressionSettings(compressionSettings);
+}
+
 void PhaseIPixelNtuplizer::endJob() 
 {
   std::cout << "Ntuplizer endjob step started." << std::endl;
+  std::cout << "Cluster parameter estimator cache hits: " << nClusterParametersCacheHit_
+	    << ", misses: " << nClusterParametersCacheMiss_ << std::endl;
+  std::cout << "Event setup updates - module informations: " << numModuleInfoUpdates_
+	    << ", propagator and estimator: " << numTrackingComponentsUpdates_
+	    << ", measurement tracker: " << numMeasurementTrackerUpdates_
+	    << ", cluster parameter estimator: " << numPixelCPEUpdates_ << std::endl;
+  if(stageProfiler_) stageProfiler_ -> printSummary();
+#ifndef NTUPLIZER_MULTISTREAM
   std::cout << "Generating ROC efficiency tree for the missing events..." << std::endl;
-  //generateROCEfficiencyTree();
+  flushROCEfficiencies();
   std::cout << "Done generating ROC efficiency tree." << std::endl;
+#endif
   std::cout << "OutputFileName in the Ntuplizer endjob: " << ntupleOutputFilename_ << "\"." << std::endl;
+  if(saveRNTuple_) closeRNTupleWriters();
   ntupleOutputFile_ -> cd();
 #ifdef ADD_CHECK_PLOTS_TO_NTUPLE
   constexpr int PHASE_SCENARIO = 1;
@@ -329,32 +530,66 @@ void PhaseIPixelNtuplizer::endJob()
 #endif
   std::cout << "Writing plots to file: \"" << ntupleOutputFilename_ << "\"." << std::endl;
   ntupleOutputFile_ -> Write();
+#ifdef NTUPLIZER_MULTISTREAM
+  if(streamOutputFile_) {
+    // The output file is closed in globalEndJob
+    streamOutputFile_.reset();
+    ntupleOutputFile_ = nullptr;
+    return;
+  }
+#endif
   std::cout << "Closing file: \"" << ntupleOutputFilename_ << "\"." << std::endl;
   ntupleOutputFile_ -> Close();
 }
 
 void PhaseIPixelNtuplizer::beginRun(edm::Run const& iRun, edm::EventSetup const& iSetup) {
   // iRun.getByToken(conditionsInRunBlockToken_,  conditionsInRunBlock_);
+  run_.init();
+  run_.run = iRun.run();
 }
 
-void PhaseIPixelNtuplizer::endRun(edm::Run const& iRun, edm::EventSetup const& iSetup) {}
+void PhaseIPixelNtuplizer::endRun(edm::Run const& iRun, edm::EventSetup const& iSetup) {
+#ifndef NTUPLIZER_MULTISTREAM
+  fillTree(runTree_);
+#endif
+}
 
 void PhaseIPixelNtuplizer::beginLuminosityBlock(edm::LuminosityBlock const& iLumi,
-						edm::EventSetup const& iSetup) {}
+						edm::EventSetup const& iSetup) {
+  lumi_.init();
+  lumi_.run  = iLumi.run();
+  lumi_.ls   = iLumi.luminosityBlock();
+  lumi_.time = iLumi.beginTime().unixTime();
+}
 
 void PhaseIPixelNtuplizer::endLuminosityBlock(edm::LuminosityBlock const& iLumi,
 					      edm::EventSetup const& iSetup) {
-  lumi_.time = iLumi.beginTime().unixTime();
   ++nLumisection_;
-  //if(nLumisection_ % efficiencyCalculationFrequency_ == 0)
-  //{
-  //  generateROCEfficiencyTree();
-  //}
+#ifdef NTUPLIZER_MULTISTREAM
+  // Every stream sees every lumisection: the summaries are added up over the streams
+  addSummariesToGlobalCache();
+#else
+  fillTree(lumiTree_);
+  // Add the lumisection summary to the run summary
+  ++run_.nls;
+  NtuplizerHelpers::addSummaryCounts(run_, lumi_);
+  if(0 < efficiencyCalculationFrequency_ && nLumisection_ % efficiencyCalculationFrequency_ == 0)
+  {
+    flushROCEfficiencies();
+  }
+#endif
 }
 
 void PhaseIPixelNtuplizer::analyze(const edm::Event& iEvent, const edm::EventSetup& iSetup)
 {  
-  if (++nEvent_ % eventSaveDownscaling_ != 0) return;
+  // Hash mode: the decision only depends on the run, lumisection and event numbers
+  if (hashDownscaling_) {
+    eventDownscaleHash_ = NtuplizerHelpers::getDownscaleHash(0, iEvent.id().run());
+    eventDownscaleHash_ = NtuplizerHelpers::getDownscaleHash(eventDownscaleHash_, iEvent.luminosityBlock());
+    eventDownscaleHash_ = NtuplizerHelpers::getDownscaleHash(eventDownscaleHash_, iEvent.id().event());
+    if (eventDownscaleHash_ % eventSaveDownscaling_ != 0) return;
+  } else if (++nEvent_ % eventSaveDownscaling_ != 0) return;
+  StageProfiler::EventScope profiledEvent(stageProfiler_.get());
 
   // std::cout << "Analysis: " << std::endl;
   // A message is printed every time a change in the data type occurs
@@ -365,9 +600,6 @@ void PhaseIPixelNtuplizer::analyze(const edm::Event& iEvent, const edm::EventSet
   }
   LogDebug("step") << "Executing PhaseIPixelNtuplizer::analyze()..." << std::endl;
 
-  // FED errors
-  federrors_ = NtuplizerHelpers::getFedErrors(iEvent, rawDataErrorToken_);
-
 #if ADD_SIM_INFO > 0
   // Simhits and hit associator
   std::vector<edm::Handle<edm::PSimHitContainer>>
@@ -377,7 +609,8 @@ void PhaseIPixelNtuplizer::analyze(const edm::Event& iEvent, const edm::EventSet
       iEvent.getByToken(simhitCollectionTokens_[numToken], simhitCollectionHandles[numToken]);
     }
     //trackerHitAssociator_ = new TrackerHitAssociator(iEvent, trackerHitAssociatorConfig_);
-    pixelHitAssociator_   = new PixelHitAssociator(iEvent);
+    StageProfiler::Scope profiledStage(stageProfiler_.get(), StageProfiler::simMatching);
+    if (pixelHitAssociator_) pixelHitAssociator_ -> reset(iEvent);
   }
 #endif
   
@@ -392,6 +625,9 @@ void PhaseIPixelNtuplizer::analyze(const edm::Event& iEvent, const edm::EventSet
 #if ADD_SIM_INFO > 0
   if (isEventFromMc_) {
     iEvent.getByToken(simTrackToken_, simTracksHandle);
+    // The last sim track with a given trackId is kept, as in a linear search for the last match
+    simTrackById_.clear();
+    for (const SimTrack& simTrack : *simTracksHandle) simTrackById_[simTrack.trackId()] = &simTrack;
   }
 #endif
   
@@ -427,66 +663,16 @@ void PhaseIPixelNtuplizer::analyze(const edm::Event& iEvent, const edm::EventSet
   iSetup.get<TransientTrackRecord>().get("TransientTrackBuilder", trackBuilderHandle); 
 #endif
 
-  // TrackerTopology for module informations
-  edm::ESHandle<TrackerTopology> trackerTopologyHandle;
-#if CMSSW_VERSION >= 123
-  trackerTopologyHandle = iSetup.getHandle(trackerTopologyToken_);
-#else
-  iSetup.get<TrackerTopologyRcd>().get(trackerTopologyHandle);
-#endif
-  trackerTopology_ = trackerTopologyHandle.product();
-
-  // TrackerGeometry for module informations
-  edm::ESHandle<TrackerGeometry> trackerGeometryHandle;
-#if CMSSW_VERSION >= 123
-  trackerGeometryHandle = iSetup.getHandle(trackerGeometryToken_);
-#else
-  iSetup.get<TrackerDigiGeometryRecord>().get(trackerGeometryHandle);
-#endif
-  trackerGeometry_ = trackerGeometryHandle.product();
-
-  // Tracker propagator for propagating tracks to other layers
-  edm::ESHandle<Propagator> propagatorHandle;
-#if CMSSW_VERSION >= 123
-  propagatorHandle = iSetup.getHandle(propagatorToken_);
-#else
-  iSetup.get<TrackingComponentsRecord>().get("PropagatorWithMaterial", propagatorHandle);  
-#endif
-  std::unique_ptr<Propagator> propagatorUniquePtr(propagatorHandle.product() -> clone());
-  trackerPropagator_ = propagatorUniquePtr.get();
-  const_cast<Propagator*>(trackerPropagator_) -> setPropagationDirection(oppositeToMomentum);
-
-  // Measurement Tracker Handle
-  edm::ESHandle<MeasurementTracker> measurementTrackerHandle;
-#if CMSSW_VERSION >= 123
-  measurementTrackerHandle = iSetup.getHandle(measurementTrackerToken_);
-#else
-  iSetup.get<CkfComponentsRecord>().get(measurementTrackerHandle);
-#endif
-  measurementTracker_ = measurementTrackerHandle.product();
+  // Tracking tools and module informations, updated only when their records change
+  const bool isModuleTableOutdated = updateEventSetupTools(iSetup);
 
   // Measurement Tracker event
   edm::Handle<MeasurementTrackerEvent> measurementTrackerEventHandle;
   iEvent.getByToken(measurementTrackerEventToken_, measurementTrackerEventHandle);
   measurementTrackerEvent_ = measurementTrackerEventHandle.product();
 
-  // Measurement estimator
-  edm::ESHandle<Chi2MeasurementEstimatorBase> chi2MeasurementEstimatorHandle;
-#if CMSSW_VERSION >= 123
-  chi2MeasurementEstimatorHandle = iSetup.getHandle(chi2MeasurementEstimatorToken_);
-#else
-  iSetup.get<TrackingComponentsRecord>().get("Chi2", chi2MeasurementEstimatorHandle);
-#endif
-  chi2MeasurementEstimator_ = chi2MeasurementEstimatorHandle.product();
-
-  // Pixel Parameter estimator
-  edm::ESHandle<PixelClusterParameterEstimator> pixelClusterParameterEstimatorHandle;
-#if CMSSW_VERSION >= 123
-  pixelClusterParameterEstimatorHandle = iSetup.getHandle(pixelClusterParameterEstimatorToken_);
-#else
-  iSetup.get<TkPixelCPERecord>().get("PixelCPEGeneric", pixelClusterParameterEstimatorHandle); 
-#endif
-  pixelClusterParameterEstimator_ = pixelClusterParameterEstimatorHandle.product();
+  // Layer measurements for the layer 1 propagation, shared by all tracks of the event
+  layerMeasurements_ = std::make_unique<LayerMeasurements>(*measurementTracker_, *measurementTrackerEvent_);
 
   // Track distance to muons
   if (isALCARECO_) {
@@ -497,20 +683,22 @@ void PhaseIPixelNtuplizer::analyze(const edm::Event& iEvent, const edm::EventSet
     iEvent.getByToken(distanceToken_, distancesToTrack_);    
   }
 
-#if CMSSW_VERSION > 110
-  // Get CablingMap (used for ROC number)
-  edm::ESHandle<SiPixelFedCablingMap> cablingMapHandle;
-# if CMSSW_VERSION >= 123
-  cablingMapHandle = iSetup.getHandle(cablingMapToken_);
-# else
-  iSetup.get<SiPixelFedCablingMapRcd>().get(cablingMapHandle);
-# endif
+  if(isModuleTableOutdated) buildModuleTable();
+
+  // FED errors, by the index of the module in the module table
+  int nFedErrors = 0;
+  NtuplizerHelpers::getFedErrors(iEvent, rawDataErrorToken_, moduleIndex_, federrors_, nFedErrors);
+  lumi_.nfederr += nFedErrors;
+
+  if(isModuleTableOutdated && benchmarkModuleTable_) benchmarkModuleTable();
+  // Index the clusters and the pixel trajectory measurements by module for the closest cluster/track searches
+  buildClusterIndex(clusterCollectionHandle);
+  NtuplizerHelpers::buildTrajMeasIndex(trajTrackCollectionHandle, trackerTopology_, trajMeasIndex_, trackHitCounts_);
+  if (!isALCARECO_) NtuplizerHelpers::getNearestTrackDistances(trajTrackCollectionHandle, nearestTrackDr_);
+
+  // Associate the tracks to muons
+  matchTracksToMuons(trajTrackCollectionHandle, muonCollectionHandle);
 
-  // Initialize the object used to calculate module geometric informations
-  coord_.init(trackerTopology_, trackerGeometry_, cablingMapHandle.product());
-#else
-  coord_.init(iSetup);
-#endif
   //std::cout << "Event summary informations: " << std::endl;
   //std::cout << "Vertices: " << (vertexCollectionHandle.isValid() ? std::to_string(vertexCollectionHandle -> size()) : "invalid") << " ";
   //if(saveDigiTree_) std::cout << "Digis: " << (digiCollectionHandle.isValid()) 
@@ -525,7 +713,7 @@ void PhaseIPixelNtuplizer::analyze(const edm::Event& iEvent, const edm::EventSet
   //      		      std::to_string(trajTrackCollectionHandle -> size()) : "invalid")
   //          << " ";
   getEvtData(iEvent, vertexCollectionHandle, triggerResultsHandle,
-	     puInfoCollectionHandle, digiCollectionHandle, clusterCollectionHandle, trajTrackCollectionHandle);
+	     puInfoCollectionHandle, digiCollectionHandle);
   if(saveDigiTree_ && digiCollectionHandle.isValid()) {
     //std::cout << "Saving digis and creating digi plots..." << std::endl;
     getDigiData(digiCollectionHandle);
@@ -540,7 +728,7 @@ void PhaseIPixelNtuplizer::analyze(const edm::Event& iEvent, const edm::EventSet
     //std::cout << "Saving simhit plots..." << std::endl;
     getSimhitData(simhitCollectionHandles);
   } else {
-    static int timesReported = 0;
+    static std::atomic<int> timesReported{0};
     if(timesReported < 10) 
       std::cout << "Error in: " << __PRETTY_FUNCTION__
 		<< ": One or more of the handles are invalid or missing! Skipping event." \
@@ -564,13 +752,115 @@ void PhaseIPixelNtuplizer::analyze(const edm::Event& iEvent, const edm::EventSet
                      muonCollectionHandle, trackBuilderHandle, simTracksHandle);
   }
   //std::cout << "The Phase1Ntuplizer data processing has been finished." << std::endl;
+}
 
-#if ADD_SIM_INFO > 0
-  if (isEventFromMc_) {
-    //delete trackerHitAssociator_;
-    delete pixelHitAssociator_;
+// Updates the event setup dependent tools when their records change,
+// returns true when the module table has to be rebuilt
+bool PhaseIPixelNtuplizer::updateEventSetupTools(const edm::EventSetup& iSetup) {
+
+  // The module informations follow the geometry and the cabling
+  bool isModuleTableOutdated = trackerTopologyWatcher_.check(iSetup);
+  isModuleTableOutdated |= trackerGeometryWatcher_.check(iSetup);
+#if CMSSW_VERSION > 110
+  isModuleTableOutdated |= cablingMapWatcher_.check(iSetup);
+#endif
+  if(isModuleTableOutdated) {
+    ++numModuleInfoUpdates_;
+
+    // TrackerTopology for module informations
+    edm::ESHandle<TrackerTopology> trackerTopologyHandle;
+#if CMSSW_VERSION >= 123
+    trackerTopologyHandle = iSetup.getHandle(trackerTopologyToken_);
+#else
+    iSetup.get<TrackerTopologyRcd>().get(trackerTopologyHandle);
+#endif
+    trackerTopology_ = trackerTopologyHandle.product();
+
+    // TrackerGeometry for module informations
+    edm::ESHandle<TrackerGeometry> trackerGeometryHandle;
+#if CMSSW_VERSION >= 123
+    trackerGeometryHandle = iSetup.getHandle(trackerGeometryToken_);
+#else
+    iSetup.get<TrackerDigiGeometryRecord>().get(trackerGeometryHandle);
+#endif
+    trackerGeometry_ = trackerGeometryHandle.product();
+
+#if CMSSW_VERSION > 110
+    // Get CablingMap (used for ROC number)
+    edm::ESHandle<SiPixelFedCablingMap> cablingMapHandle;
+# if CMSSW_VERSION >= 123
+    cablingMapHandle = iSetup.getHandle(cablingMapToken_);
+# else
+    iSetup.get<SiPixelFedCablingMapRcd>().get(cablingMapHandle);
+# endif
+
+    // Initialize the object used to calculate module geometric informations
+    coord_.init(trackerTopology_, trackerGeometry_, cablingMapHandle.product());
+#else
+    coord_.init(iSetup);
+#endif
   }
+
+  // The propagator and the chi2 estimator come from the same record
+  if(trackingComponentsWatcher_.check(iSetup)) {
+    ++numTrackingComponentsUpdates_;
+
+    // Tracker propagator for propagating tracks to other layers
+    edm::ESHandle<Propagator> propagatorHandle;
+#if CMSSW_VERSION >= 123
+    propagatorHandle = iSetup.getHandle(propagatorToken_);
+#else
+    iSetup.get<TrackingComponentsRecord>().get("PropagatorWithMaterial", propagatorHandle);  
 #endif
+    trackerPropagator_.reset(propagatorHandle.product() -> clone());
+    trackerPropagator_ -> setPropagationDirection(oppositeToMomentum);
+
+    // Measurement estimator
+    edm::ESHandle<Chi2MeasurementEstimatorBase> chi2MeasurementEstimatorHandle;
+#if CMSSW_VERSION >= 123
+    chi2MeasurementEstimatorHandle = iSetup.getHandle(chi2MeasurementEstimatorToken_);
+#else
+    iSetup.get<TrackingComponentsRecord>().get("Chi2", chi2MeasurementEstimatorHandle);
+#endif
+    chi2MeasurementEstimator_ = chi2MeasurementEstimatorHandle.product();
+  }
+
+  if(measurementTrackerWatcher_.check(iSetup)) {
+    ++numMeasurementTrackerUpdates_;
+
+    // Measurement Tracker Handle
+    edm::ESHandle<MeasurementTracker> measurementTrackerHandle;
+#if CMSSW_VERSION >= 123
+    measurementTrackerHandle = iSetup.getHandle(measurementTrackerToken_);
+#else
+    iSetup.get<CkfComponentsRecord>().get(measurementTrackerHandle);
+#endif
+    measurementTracker_ = measurementTrackerHandle.product();
+    pixelBarrelLayer1_  = measurementTracker_ -> geometricSearchTracker() -> pixelBarrelLayers().front();
+  }
+
+  if(pixelCPEWatcher_.check(iSetup)) {
+    ++numPixelCPEUpdates_;
+
+    // Pixel Parameter estimator
+    edm::ESHandle<PixelClusterParameterEstimator> pixelClusterParameterEstimatorHandle;
+#if CMSSW_VERSION >= 123
+    pixelClusterParameterEstimatorHandle = iSetup.getHandle(pixelClusterParameterEstimatorToken_);
+#else
+    iSetup.get<TkPixelCPERecord>().get("PixelCPEGeneric", pixelClusterParameterEstimatorHandle); 
+#endif
+    pixelClusterParameterEstimator_ = pixelClusterParameterEstimatorHandle.product();
+  }
+
+  return isModuleTableOutdated;
+}
+
+// Counter mode: every factor-th call is selected, hash mode: the decision
+// only depends on the event and the key of the object in the event
+bool PhaseIPixelNtuplizer::isSelectedByDownscaling(unsigned long long int& counter, uint64_t key, int factor) {
+
+  if(hashDownscaling_) return NtuplizerHelpers::getDownscaleHash(eventDownscaleHash_, key) % factor == 0;
+  return ++counter % factor == 0;
 }
 
 void PhaseIPixelNtuplizer::setTriggerTable() {
@@ -590,7 +880,137 @@ void PhaseIPixelNtuplizer::setTriggerTable() {
     triggerNames_.push_back("HLT_ZeroBias_v");
     triggerNames_.push_back("HLT_Random_v");
   }
+  // The trigger bits are stored in an int
+  if(31 < triggerNames_.size())
+    handleDefaultError("configuration", "configuration",
+		       "At most 31 triggerNames can be saved in the trigger bits.");
+  triggerMenuID_ = edm::ParameterSetID();
+  triggerPathBits_.clear();
+
+}
+
+// In the normalized mode, the event data is only saved in eventTree, the
+// other trees refer to it with the run and event numbers (see
+// interface/EventTreeFriend.h)
+void PhaseIPixelNtuplizer::addEventBranch(TTree* tree) {
+
+  if(normalizeEventData_) tree -> Branch("eventIndex", &eventIndex_, eventIndex_.list.c_str());
+  else                    tree -> Branch("event",      &evt_,        evt_.list.c_str());
+}
 
+void PhaseIPixelNtuplizer::fillTree(TTree* tree) {
+
+  StageProfiler::Scope profiledStage(stageProfiler_.get(), StageProfiler::treeFill);
+  tree -> Fill();
+#ifdef TREE_RNTUPLE_WRITER_AVAILABLE
+  if(saveRNTuple_) rntupleWriters_.at(tree) -> fill();
+#endif
+}
+
+// The RNTuples have the same names as the trees and are written to
+// <outputFileName>_rntuple.root
+void PhaseIPixelNtuplizer::createRNTupleWriters() {
+
+#if defined(TREE_RNTUPLE_WRITER_AVAILABLE) && !defined(NTUPLIZER_MULTISTREAM)
+  const std::string rntupleOutputFilename =
+    ntupleOutputFilename_.substr(0, ntupleOutputFilename_.rfind(".root")) + "_rntuple.root";
+  rntupleOutputFile_ = new TFile(rntupleOutputFilename.c_str(), "RECREATE");
+  if(!(rntupleOutputFile_ -> IsOpen())) {
+    handleDefaultError("file_operations", "file_operations",
+		       { "Failed to open output file: ", rntupleOutputFilename });
+  }
+  std::vector<TTree*> trees = { eventTree_, lumiTree_, runTree_, clustTree_, trajTree_, trajROCEfficiencyTree_ };
+  if(saveDigiTree_)                   trees.push_back(digiTree_);
+  if(saveTrackTree_)                  trees.push_back(trackTree_);
+  if(saveNonPropagatedExtraTrajTree_) trees.push_back(nonPropagatedExtraTrajTree_);
+  for(TTree* tree: trees)
+    rntupleWriters_[tree] = std::make_unique<TreeRNTupleWriter>(tree, *rntupleOutputFile_);
+  ntupleOutputFile_ -> cd();
+#else
+  handleDefaultError("configuration", "configuration",
+		     "saveRNTuple needs ROOT 6.32 or later and is not available in the multi-stream build.");
+#endif
+}
+
+void PhaseIPixelNtuplizer::closeRNTupleWriters() {
+
+#ifdef TREE_RNTUPLE_WRITER_AVAILABLE
+  // The writers commit the RNTuples when destroyed
+  rntupleWriters_.clear();
+  rntupleOutputFile_ -> Close();
+#endif
+}
+
+// The pixel storage of the clusters grows for large clusters,
+// the branches have to follow the new addresses
+void PhaseIPixelNtuplizer::updateClusterPixelBranchAddresses() {
+
+  clustTree_ -> GetBranch("clust_adc") -> SetAddress(clu_.adc.data());
+  clustTree_ -> GetBranch("clust_pix") -> SetAddress(clu_.pix.data());
+  trajTree_  -> GetBranch("clust_adc") -> SetAddress(traj_.clu.adc.data());
+  trajTree_  -> GetBranch("clust_pix") -> SetAddress(traj_.clu.pix.data());
+  if(saveNonPropagatedExtraTrajTree_) {
+    nonPropagatedExtraTrajTree_ -> GetBranch("clust_adc") -> SetAddress(traj_.clu.adc.data());
+    nonPropagatedExtraTrajTree_ -> GetBranch("clust_pix") -> SetAddress(traj_.clu.pix.data());
+  }
+}
+
+// Settings in outputSettings are defaults for all trees, a PSet named
+// after a tree (e.g. outputSettings.trajTree) overrides them for that tree
+void PhaseIPixelNtuplizer::applyOutputSettings(TTree* tree) {
+
+  applyOutputSettings(tree, outputSettings_);
+}
+
+void PhaseIPixelNtuplizer::applyOutputSettings(TTree* tree, const edm::ParameterSet& outputSettings) {
+
+  const edm::ParameterSet treeSettings =
+    outputSettings.getUntrackedParameter<edm::ParameterSet>(tree -> GetName(), edm::ParameterSet());
+
+  const std::string compressionAlgorithm = treeSettings.getUntrackedParameter<std::string>
+    ("compressionAlgorithm", outputSettings.getUntrackedParameter<std::string>("compressionAlgorithm", ""));
+  const int compressionLevel = treeSettings.getUntrackedParameter<int>
+    ("compressionLevel", outputSettings.getUntrackedParameter<int>("compressionLevel", -1));
+  const int basketSize = treeSettings.getUntrackedParameter<int>
+    ("basketSize", outputSettings.getUntrackedParameter<int>("basketSize", 0));
+  const long long autoFlush = treeSettings.getUntrackedParameter<long long>
+    ("autoFlush", outputSettings.getUntrackedParameter<long long>("autoFlush", 0));
+  const long long autoSave = treeSettings.getUntrackedParameter<long long>
+    ("autoSave", outputSettings.getUntrackedParameter<long long>("autoSave", 0));
+
+  const int compressionSettings = getCompressionSettings(compressionAlgorithm, compressionLevel);
+  if(compressionSettings != -1) {
+    TIter nextBranch(tree -> GetListOfBranches());
+    while(TBranch* branch = static_cast<TBranch*>(nextBranch()))
+      branch -> SetCompressionSettings(compressionSettings);
+  }
+  // Zero keeps the ROOT defaults
+  if(basketSize != 0) tree -> SetBasketSize("*", basketSize);
+  if(autoFlush  != 0) tree -> SetAutoFlush(autoFlush);
+  if(autoSave   != 0) tree -> SetAutoSave(autoSave);
+
+  if(compressionSettings != -1 || basketSize != 0 || autoFlush != 0 || autoSave != 0)
+    std::cout << "Output settings of " << tree -> GetName() << ": compression = " << compressionSettings
+	      << ", basket size = " << basketSize << ", auto-flush = " << autoFlush
+	      << ", auto-save = " << autoSave << std::endl;
+}
+
+// Returns the ROOT compression settings (100 * algorithm + level),
+// or -1 if neither the algorithm nor the level is specified
+int PhaseIPixelNtuplizer::getCompressionSettings(const std::string& algorithm, int level) {
+
+  if(algorithm.empty() && level < 0) return -1;
+  // Algorithm numbering of ROOT::RCompressionSetting::EAlgorithm
+  int algorithmIndex = 1;
+  if     (algorithm == "ZLIB" || algorithm.empty()) algorithmIndex = 1;
+  else if(algorithm == "LZMA")                      algorithmIndex = 2;
+  else if(algorithm == "LZ4")                       algorithmIndex = 4;
+  else if(algorithm == "ZSTD")                      algorithmIndex = 5;
+  else throw cms::Exception("configuration")
+	 << "Unknown compression algorithm: " << algorithm << " (expected ZLIB, LZMA, LZ4 or ZSTD)";
+  if(level < 0) level = 4;
+  if(9 < level) throw cms::Exception("configuration") << "Compression level out of range: " << level;
+  return 100 * algorithmIndex + level;
 }
 
 void PhaseIPixelNtuplizer::getEvtData
@@ -598,10 +1018,9 @@ void PhaseIPixelNtuplizer::getEvtData
  const edm::Handle<reco::VertexCollection>& vertexCollectionHandle,
  const edm::Handle<edm::TriggerResults>& triggerResultsHandle,
  const edm::Handle<std::vector<PileupSummaryInfo>>& puInfoCollectionHandle,
- const edm::Handle<edm::DetSetVector<PixelDigi>>& digiCollectionHandle,
- const edm::Handle<edmNew::DetSetVector<SiPixelCluster>>& clusterCollectionHandle,
- const edm::Handle<TrajTrackAssociationCollection>& trajTrackCollectionHandle) {
+ const edm::Handle<edm::DetSetVector<PixelDigi>>& digiCollectionHandle) {
 
+  StageProfiler::Scope profiledStage(stageProfiler_.get(), StageProfiler::evtData);
   // Event info
   // Set data holder object
   evt_.init();
@@ -614,6 +1033,9 @@ void PhaseIPixelNtuplizer::getEvtData
   evt_.trig         = getTriggerInfo(iEvent, triggerResultsHandle);
   evt_.pileup       = getPileupInfo(puInfoCollectionHandle);
   evt_.time         = lumi_.time;
+  eventIndex_.run   = evt_.run;
+  eventIndex_.ls    = evt_.ls;
+  eventIndex_.evt   = evt_.evt;
 
   //std::cout << "Processing event of run: " << evt_.run << ", event: " << evt_.evt << ", orb: " << evt_.orb << ", bx: " << evt_.bx << "." << std::endl;
 
@@ -647,27 +1069,9 @@ void PhaseIPixelNtuplizer::getEvtData
     }
   } // end vtx loop
 
-  // Quick loop to get number of clusters on layers/disk
-  std::fill(evt_.nclu, evt_.nclu + 7, 0);
-  std::fill(evt_.npix, evt_.npix + 7, 0);
-  if(clusterCollectionHandle.isValid()) for(const auto &clu_set: *clusterCollectionHandle) {
-    int layDiskIndex = -1;
-    DetId detId(clu_set.id());
-    
-    if(detId.subdetId() == PixelSubdetector::PixelBarrel)
-      layDiskIndex = trackerTopology_ -> pxbLayer(detId.rawId()) - 1;
-    else {
-      if(detId.subdetId() == PixelSubdetector::PixelEndcap)
-  layDiskIndex = trackerTopology_ -> pxfDisk(detId.rawId()) + 3;
-      else continue;
-    }
-
-    evt_.nclu[layDiskIndex] += clu_set.size();
-    if(!npixFromDigiCollection_)
-    {
-      for(const auto &clu: clu_set) evt_.npix[layDiskIndex] += clu.size();
-    }
-  }
+  // Numbers of clusters on layers/disk, counted while indexing the clusters
+  std::copy(clusterIndexNclu_, clusterIndexNclu_ + 7, evt_.nclu);
+  std::copy(clusterIndexNpix_, clusterIndexNpix_ + 7, evt_.npix);
   if(npixFromDigiCollection_)
   {
     for(const auto& digiDetSet: *digiCollectionHandle)
@@ -685,39 +1089,24 @@ void PhaseIPixelNtuplizer::getEvtData
     }
   }
 
-  // Quick loop to get track numbers
-  evt_.ntracks = 0;
-  std::fill(evt_.ntrackFPix, evt_.ntrackFPix + 3, 0);
-  std::fill(evt_.ntrackBPix, evt_.ntrackBPix + 4, 0);
-  for(const auto &pair: *trajTrackCollectionHandle) {
-    const edm::Ref<std::vector<Trajectory> > traj = pair.key;
-    const reco::TrackRef track                    = pair.val;
+  // Track numbers, counted while indexing the trajectory measurements
+  evt_.ntracks = trackHitCounts_.ntracks;
+  std::copy(trackHitCounts_.ntrackFPix, trackHitCounts_.ntrackFPix + 3, evt_.ntrackFPix);
+  std::copy(trackHitCounts_.ntrackBPix, trackHitCounts_.ntrackBPix + 4, evt_.ntrackBPix);
+  // The valid hit counters are added to the values left by evt_.init()
+  for(size_t i = 0; i < 3; i++) evt_.ntrackFPixvalid[i] += trackHitCounts_.ntrackFPixvalid[i];
+  for(size_t i = 0; i < 4; i++) evt_.ntrackBPixvalid[i] += trackHitCounts_.ntrackBPixvalid[i];
 
-    // Discarding tracks without pixel measurements
-    if(!NtuplizerHelpers::trajectoryHasPixelHit(traj)) continue;
-    ++evt_.ntracks;
-
-    for(const auto &measurement: traj -> measurements()) {
-
-      if(!measurement.updatedState().isValid()) continue;
-      DetId detId(measurement.recHit() -> geographicalId());
-
-      if(detId.subdetId() == PixelSubdetector::PixelBarrel) {
-	evt_.ntrackBPix[trackerTopology_ -> pxbLayer(detId.rawId()) - 1]++;
-	if(measurement.recHit() -> getType() == TrackingRecHit::valid)
-	  evt_.ntrackBPixvalid[trackerTopology_ -> pxbLayer(detId.rawId()) - 1]++;
-      } else if(detId.subdetId() == PixelSubdetector::PixelEndcap) {
-	evt_.ntrackFPix[trackerTopology_ -> pxfDisk(detId.rawId()) - 1]++;
-	if(measurement.recHit() -> getType() == TrackingRecHit::valid)
-	  evt_.ntrackFPixvalid[trackerTopology_ -> pxfDisk(detId.rawId()) - 1]++;
-      }
+  // Fill the tree
+  fillTree(eventTree_);
 
-    }
+  // Lumisection summary counters
+  ++lumi_.nevt;
+  for(size_t i = 0; i < 7; i++) {
+    lumi_.nclu[i] += evt_.nclu[i];
+    lumi_.npix[i] += evt_.npix[i];
   }
 
-  // Fill the tree
-  eventTree_ -> Fill();
-
 }
 
 int PhaseIPixelNtuplizer::getTriggerInfo(const edm::Event& iEvent, const edm::Handle<edm::TriggerResults>& triggerResultsHandle) {
@@ -727,23 +1116,31 @@ int PhaseIPixelNtuplizer::getTriggerInfo(const edm::Event& iEvent, const edm::Ha
     else               return NOVAL_I;
   }
 
-  // Get the trigger names found in the current event
-  int trig = 0;
+  // Get the trigger names found in the current event, the paths matching
+  // the configuration only change with the menu
   const edm::TriggerNames& eventTriggerNames = iEvent.triggerNames(*triggerResultsHandle);
-  for(size_t eventNumTrigger = 0; eventNumTrigger < eventTriggerNames.size(); eventNumTrigger++) {
-
-    std::string eventTriggerNameToTest = eventTriggerNames.triggerNames()[eventNumTrigger];
-
-    // Compare current trigger name to the ones found in the config 
-    for(size_t configNumTrigger = 0; configNumTrigger < triggerNames_.size(); configNumTrigger++) {
-      // If the name starts with the one specified in the configuration
-      if(eventTriggerNameToTest.find(triggerNames_[configNumTrigger])) continue;
-      // Check: Has the eventNumTrigger-th path accepted the event?
-      if(triggerResultsHandle -> accept(eventNumTrigger) == 0) continue;
-      trig |= (1 << configNumTrigger);
+  if(eventTriggerNames.parameterSetID() != triggerMenuID_) {
+    triggerMenuID_ = eventTriggerNames.parameterSetID();
+    triggerPathBits_.clear();
+    for(size_t eventNumTrigger = 0; eventNumTrigger < eventTriggerNames.size(); eventNumTrigger++) {
+
+      const std::string& eventTriggerNameToTest = eventTriggerNames.triggerName(eventNumTrigger);
+
+      // Compare current trigger name to the ones found in the config 
+      int pathBits = 0;
+      for(size_t configNumTrigger = 0; configNumTrigger < triggerNames_.size(); configNumTrigger++) {
+	// If the name starts with the one specified in the configuration
+	if(eventTriggerNameToTest.compare(0, triggerNames_[configNumTrigger].size(), triggerNames_[configNumTrigger])) continue;
+	pathBits |= (1 << configNumTrigger);
+      }
+      if(pathBits != 0) triggerPathBits_.emplace_back(eventNumTrigger, pathBits);
     }
-
   }
+
+  // Check: Have the matching paths accepted the event?
+  int trig = 0;
+  for(const auto& pathBits: triggerPathBits_)
+    if(triggerResultsHandle -> accept(pathBits.first)) trig |= pathBits.second;
   return trig;
 }
 
@@ -754,7 +1151,7 @@ float PhaseIPixelNtuplizer::getPileupInfo
 
   // Abandon hope all ye who enter here
 
-  static int reportNum = 0;
+  static std::atomic<int> reportNum{0};
   if(!puInfoCollectionHandle.isValid()) {
     if(reportNum++ < 100)
       std::cout << "Warning: The provided pileup info is invalid." << std::endl;
@@ -780,6 +1177,7 @@ float PhaseIPixelNtuplizer::getPileupInfo
 void PhaseIPixelNtuplizer::getSimhitData
 (const std::vector<edm::Handle<edm::PSimHitContainer>>& simhitCollectionHandles) {
   
+  StageProfiler::Scope profiledStage(stageProfiler_.get(), StageProfiler::simhitData);
   int numSimHits = 0;
   for (const auto& simhitCollectionHandle: simhitCollectionHandles)
     numSimHits += simhitCollectionHandle -> size();
@@ -796,7 +1194,7 @@ void PhaseIPixelNtuplizer::getSimhitData
       GlobalPoint simhitGlobalCoordinates = geomDetUnit -> toGlobal(simhitLocalCoordinates);
 
       if(subdetId == PixelSubdetector::PixelBarrel) {
-	static int printCounter = 0; // Another static... Preposterous!
+	static std::atomic<int> printCounter{0}; // Another static... Preposterous!
 	int layer = trackerTopology_ -> pxbLayer(detId);
 
 	if(printCounter++ < 20)
@@ -836,6 +1234,7 @@ void PhaseIPixelNtuplizer::getSimhitData
 void PhaseIPixelNtuplizer::getDigiData
 (const edm::Handle<edm::DetSetVector<PixelDigi>>& digiCollectionHandle) {
 
+  StageProfiler::Scope profiledStage(stageProfiler_.get(), StageProfiler::digiData);
   int digiIndexInEvent = 0;
 
   for(const auto& digiDetSet: *digiCollectionHandle) {
@@ -882,7 +1281,7 @@ void PhaseIPixelNtuplizer::getDigiData
       }
 #endif
 
-      digiTree_ -> Fill();
+      fillTree(digiTree_);
     }
   }
 }
@@ -890,6 +1289,7 @@ void PhaseIPixelNtuplizer::getDigiData
 void PhaseIPixelNtuplizer::getClustData
 (const edm::Handle<edmNew::DetSetVector<SiPixelCluster>>& clusterCollectionHandle) {
 
+  StageProfiler::Scope profiledStage(stageProfiler_.get(), StageProfiler::clustData);
   // Cluster info
   // Trying to access the clusters
   clu_.init();
@@ -911,13 +1311,16 @@ void PhaseIPixelNtuplizer::getClustData
     // Take only pixel clusters
     if(subdetId != PixelSubdetector::PixelBarrel && subdetId != PixelSubdetector::PixelEndcap)
       continue;
+    const int moduleIndex = getModuleIndex(detId);
 
     using clustSetIt_t = edmNew::DetSet<SiPixelCluster>::const_iterator;
     for(clustSetIt_t currentClusterIt = currentClusterSet.begin();
 	currentClusterIt != currentClusterSet.end(); ++currentClusterIt) {
 
       // The number of saved clusters can be downscaled to save space
-      if(++nCluster_ % clusterSaveDownscaling_ != 0) continue;
+      const uint64_t clusterKey = (static_cast<uint64_t>(detId.rawId()) << 32) |
+	static_cast<uint64_t>(currentClusterIt - currentClusterSet.begin());
+      if(!isSelectedByDownscaling(nCluster_, clusterKey, clusterSaveDownscaling_)) continue;
       const auto& currentCluster = *currentClusterIt;
 
       // Serial num of cluster in the given module
@@ -928,16 +1331,14 @@ void PhaseIPixelNtuplizer::getClustData
       // clu_.tworoc;
 
       // Module information
-      getModuleData(clu_.mod,    0, detId);
-      getModuleData(clu_.mod_on, 1, detId);
+      getModuleData(clu_.mod,    0, detId, moduleIndex);
+      getModuleData(clu_.mod_on, 1, detId, moduleIndex);
       getRocData   (clu_.mod,    0, detId, &currentCluster);
       getRocData   (clu_.mod_on, 1, detId, &currentCluster);
 
       const GeomDetUnit* geomDetUnit = trackerGeometry_ -> idToDetUnit(detId);
 
-      LocalPoint clustLocalCoordinates;
-      std::tie(clustLocalCoordinates, std::ignore, std::ignore) = 
-	pixelClusterParameterEstimator_ -> getParameters(currentCluster, *geomDetUnit);
+      LocalPoint clustLocalCoordinates = getClusterParameters(currentCluster, *geomDetUnit).position;
       GlobalPoint clustGlobalCoordinates = geomDetUnit -> toGlobal(clustLocalCoordinates);
 
       // Position and size
@@ -950,16 +1351,16 @@ void PhaseIPixelNtuplizer::getClustData
       clu_.glz   = clustGlobalCoordinates.z();
       clu_.sizeX = currentCluster.sizeX();
       clu_.sizeY = currentCluster.sizeY();
-      clu_.size  = currentCluster.size();
+      if(clu_.setSize(currentCluster.size())) updateClusterPixelBranchAddresses();
 
       // Charge
       clu_.charge = currentCluster.charge();
       // Misc.
-      for(int i = 0; i < clu_.size && i < 1000; ++i) {
-	const auto& currentPixels = currentCluster.pixels();
-	clu_.adc[i]    = currentCluster.pixelADC()[i] / 1000.0;
-	clu_.pix[i][0] = currentPixels[i].x;
-	clu_.pix[i][1] = currentPixels[i].y;
+      const auto& currentPixels = currentCluster.pixels();
+      for(int i = 0; i < clu_.size; ++i) {
+	clu_.adc[i]         = currentCluster.pixelADC()[i] / 1000.0;
+	clu_.pix[2 * i]     = currentPixels[i].x;
+	clu_.pix[2 * i + 1] = currentPixels[i].y;
       }
 
 #ifdef ADD_CHECK_PLOTS_TO_NTUPLE
@@ -988,7 +1389,7 @@ void PhaseIPixelNtuplizer::getClustData
       }
 #endif
 
-      clustTree_ -> Fill();
+      fillTree(clustTree_);
     }
   }
 }
@@ -1000,6 +1401,7 @@ PhaseIPixelNtuplizer::getTrackData( const edm::Handle<reco::VertexCollection>& v
                                     const edm::Handle<reco::MuonCollection>& muonCollectionHandle,
                                     const edm::ESHandle<TransientTrackBuilder>& trackBuilderHandle) {
   
+  StageProfiler::Scope profiledStage(stageProfiler_.get(), StageProfiler::trackData);
   std::map<reco::TrackRef, TrackData> trackDataCollection;
   int trackIndex = 0;
 
@@ -1010,17 +1412,11 @@ PhaseIPixelNtuplizer::getTrackData( const edm::Handle<reco::VertexCollection>& v
     const reco::TrackRef                    track = currentTrackKeypair.val;
 
     // Match global and tracker muon inner tracks
-    bool saveMuon = false;
+    int muonIndex = getTrackMuonMatch(track).muon;
+    bool saveMuon = muonIndex != -1;
     reco::Muon muon;
-    for (const reco::Muon& mu : *muonCollectionHandle) {
-      if ((keepAllTrackerMuons_&&mu.isTrackerMuon()) || (keepAllGlobalMuons_&&mu.isGlobalMuon())) {
-	if (std::abs(track->pt()-mu.pt())<0.01&&std::abs(track->eta()-mu.eta())<0.01) {
-	  saveMuon = true;
-	  muon = mu;
-	}
-      }
-    }
-    if (++nTrack_ % trackSaveDownscaling_ != 0 && !saveMuon) continue;
+    if (saveMuon) muon = (*muonCollectionHandle)[muonIndex];
+    if (!isSelectedByDownscaling(nTrack_, track.key(), trackSaveDownscaling_) && !saveMuon) continue;
 
     TrackData* trackField;
 
@@ -1224,7 +1620,7 @@ PhaseIPixelNtuplizer::getTrackData( const edm::Handle<reco::VertexCollection>& v
   if(saveTrackTree_) {
     for(const auto& pair: trackDataCollection) {
       track_ = pair.second;
-      trackTree_ -> Fill();
+      fillTree(trackTree_);
     }
   }
 
@@ -1240,30 +1636,28 @@ PhaseIPixelNtuplizer::getTrajTrackData( const edm::Handle<reco::VertexCollection
                                         const edm::ESHandle<TransientTrackBuilder>& trackBuilderHandle,
                                         const edm::Handle<edm::SimTrackContainer>& simTracksHandle) {
   
+  StageProfiler::Scope profiledStage(stageProfiler_.get(), StageProfiler::trajTrackData);
   std::map<reco::TrackRef, TrackData> trackDataCollection
     (getTrackData(vertexCollectionHandle, trajTrackCollectionHandle, muonCollectionHandle, trackBuilderHandle));
 
   // Trajectory measurement loop
   unsigned long long int nTrack = nTrackSave_;
+  TrajectoryMeasurement firstExtrapolatedHitOnLayer1;
   for(const auto& currentTrackKeypair: *trajTrackCollectionHandle) {
 
     const edm::Ref<std::vector<Trajectory>> traj  = currentTrackKeypair.key;
     const reco::TrackRef                    track = currentTrackKeypair.val;
 
     // Match global and tracker muon inner tracks
-    bool saveMuon = false;
-    for (const reco::Muon& mu : *muonCollectionHandle) {
-      if ((keepAllTrackerMuons_&&mu.isTrackerMuon()) || (keepAllGlobalMuons_&&mu.isGlobalMuon())) {
-	//if (NtuplizerHelpers::sameTrack(track, mu.innerTrack())) saveMuon = true;
-        if (std::abs(track->pt()-mu.pt())<0.01&&std::abs(track->eta()-mu.eta())<0.01) saveMuon = true;
-      }
-    }
-    if (++nTrack % trackSaveDownscaling_ != 0 && !saveMuon) continue;
+    bool saveMuon = getTrackMuonMatch(track).muon != -1;
+    if (!isSelectedByDownscaling(nTrack, track.key(), trackSaveDownscaling_) && !saveMuon) continue;
 
     // Discarding tracks without pixel measurements
     if(!NtuplizerHelpers::trajectoryHasPixelHit(traj)) continue;
 
     track_ = trackDataCollection.at(track);
+    // None of the measurements of the track can enter the efficiency
+    if(efficiencyOnly_ && !passesTrackEfficiencyCuts()) continue;
     const auto& trajectoryMeasurements = traj -> measurements();
 
     // First, save trajectory measurement data from the original track
@@ -1299,10 +1693,9 @@ PhaseIPixelNtuplizer::getTrajTrackData( const edm::Handle<reco::VertexCollection
       std::cout << "Invalid rechit pointer." << std::endl;
     if(!(lastNonLayer1TrajMeasurementRecHit -> isValid())) continue;
 
-    std::vector<TrajectoryMeasurement> extrapolatedHitsOnLayer1
-      (getLayer1ExtrapolatedHitsFromMeas(*lastNonLayer1TrajMeasurementIt));
-
     // Save  all propagated hits
+    //std::vector<TrajectoryMeasurement> extrapolatedHitsOnLayer1
+    //  (getLayer1ExtrapolatedHitsFromMeas(*lastNonLayer1TrajMeasurementIt));
     //for(auto measurementIt = extrapolatedHitsOnLayer1.begin();
     //    measurementIt != extrapolatedHitsOnLayer1.end(); measurementIt++)
     //  checkAndSaveTrajMeasurementData(*measurementIt, clusterCollectionHandle,
@@ -1310,9 +1703,8 @@ PhaseIPixelNtuplizer::getTrajTrackData( const edm::Handle<reco::VertexCollection
     //                                  simTracksHandle, trajTree_);
     
     // Save first hit along trajectory
-    //std::cout<<"Nmeas="<<extrapolatedHitsOnLayer1.size()<<std::endl;
-    if (!extrapolatedHitsOnLayer1.empty()) {
-      checkAndSaveTrajMeasurementData(extrapolatedHitsOnLayer1.front(), clusterCollectionHandle,
+    if (getFirstLayer1ExtrapolatedHitFromMeas(*lastNonLayer1TrajMeasurementIt, firstExtrapolatedHitOnLayer1)) {
+      checkAndSaveTrajMeasurementData(firstExtrapolatedHitOnLayer1, clusterCollectionHandle,
                                       trajTrackCollectionHandle, track,
                                       simTracksHandle, trajTree_);
     }
@@ -1363,6 +1755,7 @@ PhaseIPixelNtuplizer::getTrajTrackDataCosmics(const edm::Handle<reco::VertexColl
                                               const edm::ESHandle<TransientTrackBuilder>& trackBuilderHandle,
                                               const edm::Handle<edm::SimTrackContainer>& simTracksHandle) {
   
+  StageProfiler::Scope profiledStage(stageProfiler_.get(), StageProfiler::trajTrackData);
   std::map<reco::TrackRef, TrackData> trackDataCollection
     (getTrackData(vertexCollectionHandle, trajTrackCollectionHandle, muonCollectionHandle, trackBuilderHandle));
 
@@ -1374,14 +1767,8 @@ PhaseIPixelNtuplizer::getTrajTrackDataCosmics(const edm::Handle<reco::VertexColl
     const reco::TrackRef                     track = currentTrackKeypair.val;
 
     // Match global and tracker muon inner tracks
-    bool saveMuon = false;
-    for (const reco::Muon& mu : *muonCollectionHandle) {
-      if ((keepAllTrackerMuons_&&mu.isTrackerMuon()) || (keepAllGlobalMuons_&&mu.isGlobalMuon())) {
-	//if (NtuplizerHelpers::sameTrack(track, mu.innerTrack())) saveMuon = true;
-        if (std::abs(track->pt()-mu.pt())<0.01&&std::abs(track->eta()-mu.eta())<0.01) saveMuon = true;
-      }
-    }
-    if (++nTrack % trackSaveDownscaling_ != 0 && !saveMuon) continue;
+    bool saveMuon = getTrackMuonMatch(track).muon != -1;
+    if (!isSelectedByDownscaling(nTrack, track.key(), trackSaveDownscaling_) && !saveMuon) continue;
 
     // Discarding tracks without pixel measurements
     if(!NtuplizerHelpers::trajectoryHasPixelHit(traj)) continue;
@@ -1424,8 +1811,9 @@ void PhaseIPixelNtuplizer::checkAndSaveTrajMeasurementData
   if(!(trajStateOnSurface.isValid())) return;
 
   // Save module data
-  getModuleData(traj_.mod,    0, detId);
-  getModuleData(traj_.mod_on, 1, detId);
+  const int moduleIndex = getModuleIndex(detId);
+  getModuleData(traj_.mod,    0, detId, moduleIndex);
+  getModuleData(traj_.mod_on, 1, detId, moduleIndex);
 
   // Position measurements
   // Looking for valid and missing hits
@@ -1446,20 +1834,18 @@ void PhaseIPixelNtuplizer::checkAndSaveTrajMeasurementData
   traj_.validhit = recHit -> getType() == TrackingRecHit::valid;
   traj_.missing  = recHit -> getType() == TrackingRecHit::missing;
   traj_.inactive = recHit -> getType() == TrackingRecHit::inactive;
+
+  // Efficiency-only mode: skipping the measurements that fail the cuts
+  // known before the sim hit matching and the cluster and track searches
+  if(efficiencyOnly_ && !((traj_.validhit || traj_.missing) &&
+			  passesTrackEfficiencyCuts() && passesModuleEfficiencyCuts())) return;
   
   // Distance of nearest other track
   traj_.dr_trk = 9999;
   if (isALCARECO_) {
     // Track distance to muons
-    auto const& muonTracks = *muonTrackCollectionHandle_;
-    unsigned int nMuons = muonTracks.size();
     // match muon to track
-    int iMatch = -1;
-    for (unsigned int i = 0; i < nMuons; i++) {
-      auto muon = muonTrackCollectionHandle_->ptrAt(i);
-      if (std::abs(track->pt()-muon->pt())<0.01 && std::abs(track->eta()-muon->eta())<0.01)
-        iMatch = i;
-    }
+    int iMatch = getTrackMuonMatch(track).muonTrack;
     if (iMatch != -1) {
       edm::RefToBase<reco::Track> trackRef = muonTrackCollectionHandle_->refAt(iMatch);
       for (const auto& distance : (*distancesToTrack_)[trackRef]) {
@@ -1468,50 +1854,46 @@ void PhaseIPixelNtuplizer::checkAndSaveTrajMeasurementData
       }
     }
   } else {
-    for(const auto& pair : *trajTrackCollectionHandle) {
-      const reco::TrackRef track2 = pair.val;
-      if (track!=track2) {
-        double deta = track2->eta()-track->eta();
-        double dphi = std::abs(track2->phi()-track->phi());
-        dphi = dphi<3.141592654 ? dphi : 6.283185307 - dphi;
-        double dr = std::sqrt(deta*deta+dphi*dphi);
-        if (dr<traj_.dr_trk) traj_.dr_trk = dr;
-      }
-    }
+    // Computed once per event for all tracks
+    auto nearestTrackDrIt = nearestTrackDr_.find(track);
+    if (nearestTrackDrIt != nearestTrackDr_.end()) traj_.dr_trk = nearestTrackDrIt -> second;
   }
 
   // Sim hit matching and residuals
 #if ADD_SIM_INFO > 0
-  if (isEventFromMc_) {
+  if (isEventFromMc_ && pixelHitAssociator_) {
+    StageProfiler::Scope profiledStage(stageProfiler_.get(), StageProfiler::simMatching);
     //std::vector<PSimHit> matched = trackerHitAssociator_->associateHit(*recHit);
-    std::vector<PSimHit> matched = pixelHitAssociator_->  associateHit(*recHit, localPosition);
+    const std::vector<const PSimHit*>& matched = pixelHitAssociator_->  associateHit(*recHit, localPosition);
     if (matched.size()>0) {
       float mindist = 999999;
-      PSimHit closest;
+      const PSimHit* closest = nullptr;
       unsigned int matchid = -9999;
       // Find the vector of SimHits matching this RecHit
       // Print out the SimHit positions and residuals
-      for (auto const& m : matched) {
-        //std::cout << " simtrack ID = " << m.trackId() << "                            Simhit Pos = " << m.localPosition() << std::endl;
+      for (const PSimHit* m : matched) {
+        //std::cout << " simtrack ID = " << m->trackId() << "                            Simhit Pos = " << m->localPosition() << std::endl;
         // Seek the smallest residual
-        float dist = (localPosition - m.localPosition()).mag();
+        float dist = (localPosition - m->localPosition()).mag();
         if (dist < mindist) {
           mindist = dist;
           closest = m;
-          matchid = m.trackId();
+          matchid = m->trackId();
         }
       }
-      //std::cout << " Closest Simhit = " << closest.localPosition();
+      //std::cout << " Closest Simhit = " << closest->localPosition();
       if (mindist != 999999) {
-        traj_.dx_simhit = localPosition.x() - closest.localPosition().x();
-        traj_.dy_simhit = localPosition.y() - closest.localPosition().y();
+        traj_.dx_simhit = localPosition.x() - closest->localPosition().x();
+        traj_.dy_simhit = localPosition.y() - closest->localPosition().y();
         //std::cout << ", diff(x,y) = (" << traj_.dx_simhit << ", " << traj_.dy_simhit << ")";
         //std::cout << ", |diff| = " << mindist << std::endl;
       }
       
       // Sim track (TrackingParticles) matching
       // https://github.com/cms-sw/cmssw/blob/master/Validation/RecoTrack/plugins/TrackingNtuple.cc#L3403-L3417
-      for (const auto& simtrack : *(simTracksHandle.product())) if (simtrack.trackId()==matchid) {
+      auto simTrackIt = simTrackById_.find(matchid);
+      if (simTrackIt != simTrackById_.end()) {
+        const SimTrack& simtrack = *(simTrackIt -> second);
         //std::cout << "sim track      pt=" << simtrack.momentum().pt() << " eta=" << simtrack.momentum().eta() << " phi=" << simtrack.momentum().phi() << std::endl;
         //std::cout << "--> reco track pt=" << track->pt() << " eta=" << track->eta() << " phi=" << track->phi() << std::endl<<std::endl<<std::endl;
         double deta = simtrack.momentum().eta()-track->eta();
@@ -1572,13 +1954,11 @@ void PhaseIPixelNtuplizer::checkAndSaveTrajMeasurementData
   if(clust != nullptr) {
 
     const GeomDetUnit* geomDetUnit = recHit -> detUnit();
-    LocalPoint clustLocalCoordinates;
-    std::tie(clustLocalCoordinates, std::ignore, std::ignore) = 
-      pixelClusterParameterEstimator_ -> getParameters(*clust, *geomDetUnit);
+    LocalPoint clustLocalCoordinates = getClusterParameters(*clust, *geomDetUnit).position;
     GlobalPoint clustGlobalCoordinates = geomDetUnit -> toGlobal(clustLocalCoordinates);
 
     traj_.clu.charge = clust -> charge() / 1000.0f;
-    traj_.clu.size   = clust -> size();
+    if(traj_.clu.setSize(clust -> size())) updateClusterPixelBranchAddresses();
     traj_.clu.sizeX  = clust -> sizeX();
     traj_.clu.sizeY  = clust -> sizeY();
     traj_.clu.x      = clust -> x();
@@ -1589,10 +1969,11 @@ void PhaseIPixelNtuplizer::checkAndSaveTrajMeasurementData
     traj_.clu.gly    = clustGlobalCoordinates.y();
     traj_.clu.glz    = clustGlobalCoordinates.z();
 
-    for(int i = 0; i < clust -> size() && i < 1000; i++) {
-      traj_.clu.adc[i]    = static_cast<float>(clust -> pixelADC()[i]) / 1000.0f;
-      traj_.clu.pix[i][0] = ((clust -> pixels())[i]).x;
-      traj_.clu.pix[i][1] = ((clust -> pixels())[i]).y;
+    const auto& pixels = clust -> pixels();
+    for(int i = 0; i < traj_.clu.size; i++) {
+      traj_.clu.adc[i]         = static_cast<float>(clust -> pixelADC()[i]) / 1000.0f;
+      traj_.clu.pix[2 * i]     = pixels[i].x;
+      traj_.clu.pix[2 * i + 1] = pixels[i].y;
     }
 
     traj_.norm_charge = traj_.clu.charge * 
@@ -1606,8 +1987,7 @@ void PhaseIPixelNtuplizer::checkAndSaveTrajMeasurementData
     float dx_cl[2] = {NOVAL_F, NOVAL_F};
     float dy_cl[2] = {NOVAL_F, NOVAL_F};
     float d_cl[2]  = {NOVAL_F, NOVAL_F};
-    findClosestClusters(clusterCollectionHandle, recHit->geographicalId().rawId(),
-			traj_.lx, traj_.ly, dx_cl, dy_cl);
+    findClosestClusters(recHit->geographicalId().rawId(), traj_.lx, traj_.ly, dx_cl, dy_cl);
     for (size_t i=0; i<2; i++)
       if (dx_cl[i]!=NOVAL_F)
 	d_cl[i]=sqrt(dx_cl[i]*dx_cl[i]+dy_cl[i]*dy_cl[i]);
@@ -1622,7 +2002,8 @@ void PhaseIPixelNtuplizer::checkAndSaveTrajMeasurementData
   } else traj_.clu.init();
 
   // Get closest other traj measurement
-  NtuplizerHelpers::getClosestTrajMeasDistance(measurement, track, trajTrackCollectionHandle, traj_.d_tr, traj_.dx_tr, traj_.dy_tr);
+  NtuplizerHelpers::getClosestTrajMeasDistance(detId.rawId(), traj_.lx, traj_.ly, track, trajMeasIndex_,
+					       traj_.d_tr, traj_.dx_tr, traj_.dy_tr);
   traj_.hit_near = (traj_.d_tr < 0.5); // 5 mm
   traj_.clust_near = (traj_.d_cl != NOVAL_F && traj_.d_cl < HIT_CLUST_NEAR_CUT_VAL);
 
@@ -1653,47 +2034,126 @@ void PhaseIPixelNtuplizer::checkAndSaveTrajMeasurementData
 #endif
 
   traj_.pass_effcuts = getTrajMeasurementEfficiencyQualification(measurement) != EXCLUDED;
+  if(efficiencyOnly_ && !traj_.pass_effcuts) return;
+
+  // Lumisection summary and ROC efficiency counters
+  if(targetTree == trajTree_) {
+    int layDiskIndex = -1;
+    if(traj_.mod_on.det == 0) layDiskIndex = traj_.mod_on.layer - 1;
+    if(traj_.mod_on.det == 1) layDiskIndex = std::abs(traj_.mod_on.disk) + 3;
+    if(0 <= layDiskIndex && layDiskIndex < 7) {
+      if(traj_.validhit) ++lumi_.nvalid[layDiskIndex];
+      if(traj_.missing)  ++lumi_.nmissing[layDiskIndex];
+    }
+    const int rocEfficiencyIndex = getROCEfficiencyIndex(traj_.mod_on);
+    pendingROCEfficiencyIndices_.push_back(rocEfficiencyIndex);
+    if(rocEfficiencyIndex != -1 && traj_.pass_effcuts) {
+      ++rocEfficiencyTotal_[rocEfficiencyIndex];
+      if(traj_.validhit || (traj_.missing && 0 < traj_.d_cl && traj_.d_cl < HIT_CLUST_NEAR_CUT_VAL))
+	++rocEfficiencyPassed_[rocEfficiencyIndex];
+    }
+  }
 
   // Filling the tree
-  targetTree -> Fill();
+  fillTree(targetTree);
 
 }
 
 std::vector<TrajectoryMeasurement> PhaseIPixelNtuplizer::getLayer1ExtrapolatedHitsFromMeas(const TrajectoryMeasurement& trajMeasurement)
 {
 
+  StageProfiler::Scope profiledStage(stageProfiler_.get(), StageProfiler::layer1Propagation);
   // Last layer 2 or disk 1 mesurement is to be propagated to layer 1 if possible
   // Only propagating valid measurements
-  std::unique_ptr<LayerMeasurements> layerMeasurements
-    (new LayerMeasurements(*measurementTracker_, *measurementTrackerEvent_));
+  // The layer measurements and the layer 1 pointer are set up once per event in analyze()
+  return layerMeasurements_ -> measurements(*pixelBarrelLayer1_, trajMeasurement.updatedState(),
+					    *trackerPropagator_, *chi2MeasurementEstimator_);
+}
+
+// Same measurement as the front() of getLayer1ExtrapolatedHitsFromMeas(), without
+// building and sorting the measurements of all the compatible detectors
+bool PhaseIPixelNtuplizer::getFirstLayer1ExtrapolatedHitFromMeas(const TrajectoryMeasurement& trajMeasurement,
+								  TrajectoryMeasurement& firstExtrapolatedHit)
+{
+
+  StageProfiler::Scope profiledStage(stageProfiler_.get(), StageProfiler::layer1Propagation);
+  const TrajectoryStateOnSurface& startingState = trajMeasurement.updatedState();
+  const std::vector<DetLayer::DetWithState> compatibleDets =
+    pixelBarrelLayer1_ -> compatibleDets(startingState, *trackerPropagator_, *chi2MeasurementEstimator_);
+
+  // No compatible detector: inactive hit on the layer, if the layer itself is compatible
+  if(compatibleDets.empty()) {
+    const std::pair<bool, TrajectoryStateOnSurface> compatibleLayer =
+      pixelBarrelLayer1_ -> compatible(startingState, *trackerPropagator_, *chi2MeasurementEstimator_);
+    if(!compatibleLayer.first) return false;
+    firstExtrapolatedHit = TrajectoryMeasurement
+      (compatibleLayer.second,
+       std::make_shared<InvalidTrackingRecHitNoDet>(pixelBarrelLayer1_ -> surface(), TrackingRecHit::inactive),
+       0.0f, pixelBarrelLayer1_);
+    return true;
+  }
+
+  // The measurements are ordered by their estimate, the first one can come from
+  // any of the compatible detectors: keeping the lowest estimate of all of them
+  bool  isFound      = false;
+  float bestEstimate = 0.0f;
+  for(const auto& detWithState: compatibleDets) {
+    MeasurementDetWithData measurementDet =
+      measurementTracker_ -> idToDet(detWithState.first -> geographicalId(), *measurementTrackerEvent_);
+    if(measurementDet.isNull())
+      throw cms::Exception("layer1_propagation") << "MeasurementDet not found: "
+						 << detWithState.first -> geographicalId().rawId();
+    tempMeasurements_.clear();
+    // Detectors without a compatible hit report no measurement here
+    if(!measurementDet.measurements(detWithState.second, *chi2MeasurementEstimator_, tempMeasurements_)) continue;
+    for(std::size_t numHit = 0; numHit < tempMeasurements_.size(); ++numHit) {
+      if(isFound && !(tempMeasurements_.distances[numHit] < bestEstimate)) continue;
+      isFound      = true;
+      bestEstimate = tempMeasurements_.distances[numHit];
+      firstExtrapolatedHit = TrajectoryMeasurement(detWithState.second, tempMeasurements_.hits[numHit],
+						   bestEstimate, pixelBarrelLayer1_);
+    }
+  }
+  tempMeasurements_.clear();
+
+  // None of the detectors has a hit: missing hit on the first compatible detector
+  if(!isFound) {
+    firstExtrapolatedHit = TrajectoryMeasurement
+      (compatibleDets.front().second,
+       std::make_shared<InvalidTrackingRecHit>(*compatibleDets.front().first, TrackingRecHit::missing),
+       0.0f, pixelBarrelLayer1_);
+  }
+  return true;
 
-  const DetLayer* pixelBarrelLayer1 = 
-    measurementTracker_ -> geometricSearchTracker() -> pixelBarrelLayers().front();
-  
-  return layerMeasurements -> measurements(*pixelBarrelLayer1, trajMeasurement.updatedState(),
-  					   *trackerPropagator_, *chi2MeasurementEstimator_);
 }
 
-PhaseIPixelNtuplizer::TrajectoryMeasurementEfficiencyQualification PhaseIPixelNtuplizer::getTrajMeasurementEfficiencyQualification(const TrajectoryMeasurement& t_measurement)
+// Cuts on the track and event quantities
+bool PhaseIPixelNtuplizer::passesTrackEfficiencyCuts()
 {
   // Nvtx Cut
-  if(!(VERTEX_NUMTRACK_CUT_VAL < track_.fromVtxNtrk)) return EXCLUDED;
+  if(!(VERTEX_NUMTRACK_CUT_VAL < track_.fromVtxNtrk)) return false;
   // Zerobias cut
-  if(!(evt_.trig & ZEROBIAS_BITMASK >> ZEROBIAS_TRIGGER_BIT)) return EXCLUDED;
+  if(!(evt_.trig & ZEROBIAS_BITMASK >> ZEROBIAS_TRIGGER_BIT)) return false;
   // Federr cut
-  if(!(evt_.federrs_size == 0)) return EXCLUDED;
+  if(!(evt_.federrs_size == 0)) return false;
   // Hp cut
-  if(!((track_.quality & TRACK_QUALITY_HIGH_PURITY_MASK) >> TRACK_QUALITY_HIGH_PURITY_BIT)) return EXCLUDED;
+  if(!((track_.quality & TRACK_QUALITY_HIGH_PURITY_MASK) >> TRACK_QUALITY_HIGH_PURITY_BIT)) return false;
   // Pt cut
-  if(!(TRACK_PT_CUT_VAL < track_.pt)) return EXCLUDED;
+  if(!(TRACK_PT_CUT_VAL < track_.pt)) return false;
   // Nstrip cut
-  if(!(TRACK_NSTRIP_CUT_VAL < track_.strip)) return EXCLUDED;
+  if(!(TRACK_NSTRIP_CUT_VAL < track_.strip)) return false;
+  return true;
+}
+
+// Cuts on the track quantities depending on the module, and fiducial cuts
+bool PhaseIPixelNtuplizer::passesModuleEfficiencyCuts()
+{
   // D0 cut
-  if(traj_.mod_on.det == 0) if(!(std::abs(track_.d0) < TRACK_D0_CUT_BARREL_VAL[traj_.mod_on.layer - 1])) return EXCLUDED;
-  if(traj_.mod_on.det == 1) if(!(std::abs(track_.d0) < TRACK_D0_CUT_FORWARD_VAL)) return EXCLUDED;
+  if(traj_.mod_on.det == 0) if(!(std::abs(track_.d0) < TRACK_D0_CUT_BARREL_VAL[traj_.mod_on.layer - 1])) return false;
+  if(traj_.mod_on.det == 1) if(!(std::abs(track_.d0) < TRACK_D0_CUT_FORWARD_VAL)) return false;
   // Dz cut
-  if(traj_.mod_on.det == 0) if(!(std::abs(track_.dz) < TRACK_DZ_CUT_BARREL_VAL)) return EXCLUDED;
-  if(traj_.mod_on.det == 1) if(!(std::abs(track_.dz) < TRACK_DZ_CUT_FORWARD_VAL)) return EXCLUDED;
+  if(traj_.mod_on.det == 0) if(!(std::abs(track_.dz) < TRACK_DZ_CUT_BARREL_VAL)) return false;
+  if(traj_.mod_on.det == 1) if(!(std::abs(track_.dz) < TRACK_DZ_CUT_FORWARD_VAL)) return false;
   // Pixhit cut
   if(traj_.mod_on.det == 0)
   {
@@ -1701,35 +2161,42 @@ PhaseIPixelNtuplizer::TrajectoryMeasurementEfficiencyQualification PhaseIPixelNt
       (track_.validbpix[1] > 0 && track_.validbpix[2] > 0 && track_.validbpix[3] > 0) ||
       (track_.validbpix[1] > 0 && track_.validbpix[2] > 0 && track_.validfpix[0] > 0) ||
       (track_.validbpix[1] > 0 && track_.validfpix[0] > 0 && track_.validfpix[1] > 0) ||
-      (track_.validfpix[0] > 0 && track_.validfpix[2] > 0 && track_.validfpix[2] > 0))) return EXCLUDED;
+      (track_.validfpix[0] > 0 && track_.validfpix[2] > 0 && track_.validfpix[2] > 0))) return false;
     if(traj_.mod_on.layer == 2) if(!(
       (track_.validbpix[0] > 0 && track_.validbpix[2] > 0 && track_.validbpix[3] > 0) ||
       (track_.validbpix[0] > 0 && track_.validbpix[2] > 0 && track_.validfpix[0] > 0) ||
-      (track_.validbpix[0] > 0 && track_.validfpix[0] > 0 && track_.validfpix[1] > 0))) return EXCLUDED;
+      (track_.validbpix[0] > 0 && track_.validfpix[0] > 0 && track_.validfpix[1] > 0))) return false;
     if(traj_.mod_on.layer == 3) if(!(
       (track_.validbpix[0] > 0 && track_.validbpix[1] > 0 && track_.validbpix[3] > 0) ||
-      (track_.validbpix[0] > 0 && track_.validbpix[1] > 0 && track_.validfpix[0] > 0))) return EXCLUDED;
+      (track_.validbpix[0] > 0 && track_.validbpix[1] > 0 && track_.validfpix[0] > 0))) return false;
     if(traj_.mod_on.layer == 4) if(!(
-      (track_.validbpix[0] > 0 && track_.validbpix[1] > 0 && track_.validbpix[2] > 0))) return EXCLUDED;
+      (track_.validbpix[0] > 0 && track_.validbpix[1] > 0 && track_.validbpix[2] > 0))) return false;
   }
   if(traj_.mod_on.det == 1)
   {
     if(std::abs(traj_.mod_on.disk) == 1) if(!(
       (track_.validbpix[0] > 0 && track_.validbpix[1] > 0 && track_.validbpix[2] > 0) ||
       (track_.validbpix[0] > 0 && track_.validbpix[1] > 0 && track_.validfpix[1] > 0) ||
-      (track_.validbpix[0] > 0 && track_.validfpix[1] > 0 && track_.validfpix[2] > 0))) return EXCLUDED;
+      (track_.validbpix[0] > 0 && track_.validfpix[1] > 0 && track_.validfpix[2] > 0))) return false;
     if(std::abs(traj_.mod_on.disk) == 2) if(!(
       (track_.validbpix[0] > 0 && track_.validbpix[1] > 0 && track_.validfpix[0] > 0) ||
-      (track_.validbpix[0] > 0 && track_.validfpix[0] > 0 && track_.validfpix[2] > 0))) return EXCLUDED;
+      (track_.validbpix[0] > 0 && track_.validfpix[0] > 0 && track_.validfpix[2] > 0))) return false;
     if(std::abs(traj_.mod_on.disk) == 3) if(!(
-      (track_.validbpix[0] > 0 && track_.validfpix[0] > 0 && track_.validfpix[1] > 0))) return EXCLUDED;
+      (track_.validbpix[0] > 0 && track_.validfpix[0] > 0 && track_.validfpix[1] > 0))) return false;
   }
   // Fidicual cuts
   if(traj_.mod_on.det == 0)
   {
-    if(!(std::abs(traj_.lx) < BARREL_MODULE_EDGE_X_CUT)) return EXCLUDED;
-    if(!(std::abs(traj_.lx) < BARREL_MODULE_EDGE_Y_CUT)) return EXCLUDED;
+    if(!(std::abs(traj_.lx) < BARREL_MODULE_EDGE_X_CUT)) return false;
+    if(!(std::abs(traj_.lx) < BARREL_MODULE_EDGE_Y_CUT)) return false;
   }
+  return true;
+}
+
+PhaseIPixelNtuplizer::TrajectoryMeasurementEfficiencyQualification PhaseIPixelNtuplizer::getTrajMeasurementEfficiencyQualification(const TrajectoryMeasurement& t_measurement)
+{
+  if(!passesTrackEfficiencyCuts())  return EXCLUDED;
+  if(!passesModuleEfficiencyCuts()) return EXCLUDED;
   // Hitsep cut
   if(traj_.d_tr < MEAS_HITSEP_CUT_VAL) return EXCLUDED;
   // Valmis cut
@@ -1833,114 +2300,207 @@ void PhaseIPixelNtuplizer::getDisk1PropagationData(const edm::Handle<TrajTrackAs
 }
 #endif
 
-std::vector<TEfficiency> PhaseIPixelNtuplizer::getDetectorPartEfficienciesInTrajTreeEntryRange(const TrajMeasurement& t_trajField, const Long64_t& t_minEntry, const Long64_t& t_maxEntry)
+int PhaseIPixelNtuplizer::getROCEfficiencyIndex(const ModuleData& mod)
 {
-  std::vector<TEfficiency> detectorPartEfficiencies;
-  detectorPartEfficiencies.emplace_back("ROC eff. - forward", "ROC eff. - forward",  112, -3.5, 3.5, 140, -17.5, 17.5);
-  detectorPartEfficiencies.emplace_back("ROC eff. - layer 1", "ROC eff. - layer 1",   72, -4.5, 4.5,  26,  -6.5,  6.5);
-  detectorPartEfficiencies.emplace_back("ROC eff. - layer 2", "ROC eff. - layer 2",   72, -4.5, 4.5,  58, -14.5, 14.5);
-  detectorPartEfficiencies.emplace_back("ROC eff. - layer 3", "ROC eff. - layer 3",   72, -4.5, 4.5,  90, -22.5, 22.5);
-  detectorPartEfficiencies.emplace_back("ROC eff. - layer 4", "ROC eff. - layer 4",   72, -4.5, 4.5, 130, -32.5, 32.5);
-  std::vector<std::ofstream> fillPrintouts;
-  // static int i = 0;
-  // fillPrintouts.emplace_back("entries_fwd" + std::to_string(i) + ".txt", std::ios::out | std::ios::app);
-  // fillPrintouts.emplace_back("entries_l1" + std::to_string(i) + ".txt", std::ios::out | std::ios::app);
-  // fillPrintouts.emplace_back("entries_l2" + std::to_string(i) + ".txt", std::ios::out | std::ios::app);
-  // fillPrintouts.emplace_back("entries_l3" + std::to_string(i) + ".txt", std::ios::out | std::ios::app);
-  // fillPrintouts.emplace_back("entries_l4" + std::to_string(i) + ".txt", std::ios::out | std::ios::app);
-  // i++;
-  for(Long64_t entryIndex = t_minEntry; entryIndex < t_maxEntry; ++entryIndex)
+  int part = -1;
+  float x = 0.0f;
+  float y = 0.0f;
+  if(mod.det == 0 && 1 <= mod.layer && mod.layer <= 4)
   {
-    trajTree_ -> GetEntry(entryIndex);
-    if(t_trajField.pass_effcuts == EXCLUDED) continue;
-    int efficiencyHistogramIndex = t_trajField.mod_on.det == 1 ? 0 : t_trajField.mod_on.layer;
-    int validMissing = 0;
-    if(t_trajField.validhit || (t_trajField.missing && 0 < t_trajField.d_cl && (t_trajField.d_cl < HIT_CLUST_NEAR_CUT_VAL))) validMissing = 1;
-    if(efficiencyHistogramIndex == 0) detectorPartEfficiencies[efficiencyHistogramIndex].Fill(validMissing, t_trajField.mod_on.module_coord, t_trajField.mod_on.ladder_coord);
-    else                              detectorPartEfficiencies[efficiencyHistogramIndex].Fill(validMissing, t_trajField.mod_on.disk_ring_coord, t_trajField.mod_on.blade_panel_coord);
-    // (fillPrintouts[efficiencyHistogramIndex]) << 
-    //   "t_trajField.mod_on.module_coord: " << std::setw(4) << std::setprecision(3) << t_trajField.mod_on.module_coord << " " <<
-    //   "t_trajField.mod_on.ladder_coord: " << std::setw(4) << std::setprecision(3) << t_trajField.mod_on.ladder_coord << " " <<
-    //   "validMissing: " << std::setw(4) << std::setprecision(3) << validMissing  << std::endl;
-  }
-  // std::for_each(fillPrintouts.begin(), fillPrintouts.end(), [] (auto& e) { e.close(); });
-  return detectorPartEfficiencies;
-}
-
-void PhaseIPixelNtuplizer::generateROCEfficiencyTree()
+    part = mod.layer;
+    x    = mod.module_coord;
+    y    = mod.ladder_coord;
+  }
+  if(mod.det == 1)
+  {
+    part = 0;
+    x    = mod.disk_ring_coord;
+    y    = mod.blade_panel_coord;
+  }
+  if(part == -1) return -1;
+  const ROCEfficiencyBinning& binning = ROC_EFFICIENCY_BINNINGS[part];
+  if(!(binning.xmin <= x && x < binning.xmax && binning.ymin <= y && y < binning.ymax)) return -1;
+  const int ix = std::min(static_cast<int>((x - binning.xmin) / (binning.xmax - binning.xmin) * binning.nx), binning.nx - 1);
+  const int iy = std::min(static_cast<int>((y - binning.ymin) / (binning.ymax - binning.ymin) * binning.ny), binning.ny - 1);
+  return rocEfficiencyOffsets_[part] + iy * binning.nx + ix;
+}
+
+// First counter of the forward and layer 1-4 ROC bins
+std::array<int, 5> PhaseIPixelNtuplizer::getROCEfficiencyOffsets()
+{
+  std::array<int, 5> offsets;
+  int numROCEfficiencyBins = 0;
+  for(std::size_t part = 0; part < ROC_EFFICIENCY_BINNINGS.size(); ++part) {
+    offsets[part] = numROCEfficiencyBins;
+    numROCEfficiencyBins += ROC_EFFICIENCY_BINNINGS[part].nx * ROC_EFFICIENCY_BINNINGS[part].ny;
+  }
+  return offsets;
+}
+
+// ROC, half-module and module efficiency of the ROC bin, NOVAL_F if not on a ROC bin
+std::array<float, 3> PhaseIPixelNtuplizer::getROCEfficiencies(int rocIndex,
+							      const std::vector<unsigned int>& rocEfficiencyPassed,
+							      const std::vector<unsigned int>& rocEfficiencyTotal)
 {
-  Long64_t numEntriesWithAssociatedEfficiency = trajROCEfficiencyTree_ -> GetEntries();
-  Long64_t trajTreeNumEntries = trajTree_ -> GetEntries();
-  TrajMeasurement trajField;
-  trajTree_ -> SetBranchAddress("traj",   &trajField);
-  trajTree_ -> SetBranchAddress("mod_on", &trajField.mod_on);
-  std::vector<TEfficiency> detectorPartEfficiencies { getDetectorPartEfficienciesInTrajTreeEntryRange(trajField, numEntriesWithAssociatedEfficiency, trajTreeNumEntries) };
-  // for(const TEfficiency& efficiency: detectorPartEfficiencies)
-  // {
-  //   static int i = 0;
-  //   TCanvas canvas;
-  //   canvas.cd();
-  //   const_cast<TH1*>(efficiency.GetPassedHistogram()) -> Draw("COLZ");
-  //   canvas.SaveAs((std::to_string(i++) + ".eps").c_str());
-  //   const_cast<TH1*>(efficiency.GetTotalHistogram()) -> Draw("COLZ");
-  //   canvas.SaveAs((std::to_string(i++) + ".eps").c_str());
-  // }
-  for(Long64_t entryIndex = numEntriesWithAssociatedEfficiency; entryIndex < trajTreeNumEntries; ++entryIndex)
+  if(rocIndex == -1) return {{NOVAL_F, NOVAL_F, NOVAL_F}};
+  static const std::array<int, 5> rocEfficiencyOffsets = getROCEfficiencyOffsets();
+  auto getEfficiency = [&] (const std::vector<int>& rocIndices)
   {
-    trajTree_ -> GetEntry(entryIndex);
-    std::size_t efficiencyHistogramIndex = trajField.mod_on.det == 1 ? 0 : trajField.mod_on.layer;
-    
-    const Int_t globalROCBin = [&] () 
+    unsigned int passed = 0;
+    unsigned int total  = 0;
+    for(int binIndex: rocIndices)
     {
-      if(efficiencyHistogramIndex) return detectorPartEfficiencies[efficiencyHistogramIndex].GetGlobalBin(trajField.mod_on.disk_ring_coord, trajField.mod_on.blade_panel_coord);
-      return detectorPartEfficiencies[efficiencyHistogramIndex].GetGlobalBin(trajField.mod_on.module_coord, trajField.mod_on.ladder_coord);
-    } ();
-    const Int_t& rowLengthBins = efficiencyHistogramIndex ? 112 : 72;
-    const bool isOddHalf = (globalROCBin / rowLengthBins) % 2; // Make sure this is integer division
-    const Int_t rowStartBin = globalROCBin - globalROCBin % 8;
-    const Int_t moduleOtherRowStartBin = isOddHalf ? rowStartBin + rowLengthBins  : rowStartBin - rowLengthBins;
-    Int_t halfmoduleEfficiencyNumerator   = 0;
-    Int_t halfmoduleEfficiencyDenominator = 0;
-    Int_t moduleEfficiencyNumerator       = 0;
-    Int_t moduleEfficiencyDenominator     = 0;
-    for(Int_t i = 0; i < 8; ++i)
+      passed += rocEfficiencyPassed[binIndex];
+      total  += rocEfficiencyTotal [binIndex];
+    }
+    if(0 < total) return static_cast<float>(passed) / static_cast<float>(total);
+    return 0.0f;
+  };
+  const int part = std::upper_bound(rocEfficiencyOffsets.begin(), rocEfficiencyOffsets.end(), rocIndex) - rocEfficiencyOffsets.begin() - 1;
+  const ROCEfficiencyBinning& binning = ROC_EFFICIENCY_BINNINGS[part];
+  const int ix = (rocIndex - rocEfficiencyOffsets[part]) % binning.nx;
+  const int iy = (rocIndex - rocEfficiencyOffsets[part]) / binning.nx;
+  // Half-modules are 8 ROCs in a row, modules are two of these rows
+  const int rowStartIndex      = rocEfficiencyOffsets[part] + iy * binning.nx + ix - ix % 8;
+  const int otherRowStartIndex = rowStartIndex + ((iy % 2) ? -binning.nx : binning.nx);
+  std::vector<int> halfModuleROCs;
+  std::vector<int> moduleROCs;
+  for(int i = 0; i < 8; ++i)
+  {
+    halfModuleROCs.push_back(rowStartIndex + i);
+    moduleROCs    .push_back(rowStartIndex + i);
+    if((iy ^ 1) < binning.ny) moduleROCs.push_back(otherRowStartIndex + i);
+  }
+  return {{getEfficiency({rocIndex}), getEfficiency(halfModuleROCs), getEfficiency(moduleROCs)}};
+}
+
+void PhaseIPixelNtuplizer::flushROCEfficiencies()
+{
+  for(int rocIndex: pendingROCEfficiencyIndices_)
+  {
+    const std::array<float, 3> efficiencies = getROCEfficiencies(rocIndex, rocEfficiencyPassed_, rocEfficiencyTotal_);
+    trajROCEff_.ROCEfficiency        = efficiencies[0];
+    trajROCEff_.halfModuleEfficiency = efficiencies[1];
+    trajROCEff_.moduleEfficiency     = efficiencies[2];
+    fillTree(trajROCEfficiencyTree_);
+  }
+  pendingROCEfficiencyIndices_.clear();
+  std::fill(rocEfficiencyPassed_.begin(), rocEfficiencyPassed_.end(), 0);
+  std::fill(rocEfficiencyTotal_ .begin(), rocEfficiencyTotal_ .end(), 0);
+}
+
+#ifdef NTUPLIZER_MULTISTREAM
+// Adds the lumisection summary and the ROC efficiency counters of the stream to the sums
+// over the streams. The buffer of the stream is sent to the merger together with the ROC
+// bins of its trajTree entries, so the batches are in the order of the entries in the
+// output file and globalEndJob can write one trajROCEfficiencyTree entry per trajTree entry.
+void PhaseIPixelNtuplizer::addSummariesToGlobalCache()
+{
+  const NtuplizerHelpers::OutputCache& outputCache = *globalCache();
+  const int window = 0 < efficiencyCalculationFrequency_ ? (nLumisection_ - 1) / efficiencyCalculationFrequency_ : 0;
+  std::lock_guard<std::mutex> lock(outputCache.summaryMutex);
+  LumiData& lumi = outputCache.lumisections[std::make_pair(lumi_.run, lumi_.ls)];
+  lumi.run  = lumi_.run;
+  lumi.ls   = lumi_.ls;
+  lumi.time = lumi_.time;
+  NtuplizerHelpers::addSummaryCounts(lumi, lumi_);
+  auto windowIt = outputCache.rocEfficiencyWindows.find(window);
+  if(windowIt == outputCache.rocEfficiencyWindows.end())
+  {
+    windowIt = outputCache.rocEfficiencyWindows.emplace(window, NtuplizerHelpers::ROCEfficiencyWindow()).first;
+    windowIt -> second.passed.assign(rocEfficiencyPassed_.size(), 0);
+    windowIt -> second.total .assign(rocEfficiencyTotal_ .size(), 0);
+  }
+  NtuplizerHelpers::ROCEfficiencyWindow& rocEfficiencyWindow = windowIt -> second;
+  for(std::size_t rocIndex = 0; rocIndex < rocEfficiencyPassed_.size(); ++rocIndex)
+  {
+    rocEfficiencyWindow.passed[rocIndex] += rocEfficiencyPassed_[rocIndex];
+    rocEfficiencyWindow.total [rocIndex] += rocEfficiencyTotal_ [rocIndex];
+  }
+  std::fill(rocEfficiencyPassed_.begin(), rocEfficiencyPassed_.end(), 0);
+  std::fill(rocEfficiencyTotal_ .begin(), rocEfficiencyTotal_ .end(), 0);
+  if(!pendingROCEfficiencyIndices_.empty())
+  {
+    rocEfficiencyWindow.batches.push_back(outputCache.rocEfficiencyBatches.size());
+    outputCache.rocEfficiencyBatches.push_back({subFileIndex_, std::move(pendingROCEfficiencyIndices_), {}});
+    pendingROCEfficiencyIndices_.clear();
+  }
+  // Send the trees filled so far to the output file to keep the memory usage bounded
+  if(streamOutputFile_) ntupleOutputFile_ -> Write();
+  if(0 < efficiencyCalculationFrequency_ &&
+     ++rocEfficiencyWindow.numStreamLumisections == outputCache.numStreams * efficiencyCalculationFrequency_)
+  {
+    completeROCEfficiencyWindow(outputCache, windowIt);
+  }
+}
+
+// Computes the efficiencies of the batches in the window from the counters of all streams
+void PhaseIPixelNtuplizer::completeROCEfficiencyWindow
+(const NtuplizerHelpers::OutputCache& outputCache,
+ std::map<int, NtuplizerHelpers::ROCEfficiencyWindow>::iterator windowIt)
+{
+  const NtuplizerHelpers::ROCEfficiencyWindow& rocEfficiencyWindow = windowIt -> second;
+  for(std::size_t batchIndex: rocEfficiencyWindow.batches)
+  {
+    NtuplizerHelpers::ROCEfficiencyBatch& batch = outputCache.rocEfficiencyBatches[batchIndex];
+    batch.efficiencies.reserve(batch.rocIndices.size());
+    for(int rocIndex: batch.rocIndices)
+      batch.efficiencies.push_back(getROCEfficiencies(rocIndex, rocEfficiencyWindow.passed, rocEfficiencyWindow.total));
+    batch.rocIndices = std::vector<int>();
+  }
+  outputCache.rocEfficiencyWindows.erase(windowIt);
+}
+
+// Writes the lumisection, run and ROC efficiency summaries of all streams
+void PhaseIPixelNtuplizer::writeSummaryTrees(const NtuplizerHelpers::OutputCache& outputCache, TFile* file)
+{
+  file -> cd();
+  LumiData          lumi;
+  RunData           run;
+  TrajROCEfficiency trajROCEff;
+  TTree* lumiTree              = new TTree("lumiTree",  "Lumisection summaries.");
+  TTree* runTree               = new TTree("runTree",   "Run summaries.");
+  TTree* trajROCEfficiencyTree = new TTree("trajROCEfficiencyTree", "ROC and module efficiencies.");
+  lumiTree              -> Branch("lumi", &lumi, lumi.list.c_str());
+  runTree               -> Branch("run",  &run,  run.list.c_str());
+  trajROCEfficiencyTree -> Branch("trajROCEfficiency", &trajROCEff, trajROCEff.list.c_str());
+  for(TTree* tree: { lumiTree, runTree, trajROCEfficiencyTree })
+    applyOutputSettings(tree, outputCache.outputSettings);
+  // The lumisections are ordered by run
+  for(auto lumiIt = outputCache.lumisections.begin(); lumiIt != outputCache.lumisections.end(); ++lumiIt)
+  {
+    const LumiData& lumisection = lumiIt -> second;
+    lumi.init();
+    lumi.run  = lumisection.run;
+    lumi.ls   = lumisection.ls;
+    lumi.time = lumisection.time;
+    NtuplizerHelpers::addSummaryCounts(lumi, lumisection);
+    lumiTree -> Fill();
+    if(lumiIt == outputCache.lumisections.begin() || run.run != lumisection.run)
     {
-      halfmoduleEfficiencyNumerator   += detectorPartEfficiencies[efficiencyHistogramIndex].GetPassedHistogram() -> GetBinContent(rowStartBin + i);
-      halfmoduleEfficiencyDenominator += detectorPartEfficiencies[efficiencyHistogramIndex].GetTotalHistogram()  -> GetBinContent(rowStartBin + i);
-      moduleEfficiencyNumerator       += detectorPartEfficiencies[efficiencyHistogramIndex].GetPassedHistogram() -> GetBinContent(rowStartBin + i);
-      moduleEfficiencyDenominator     += detectorPartEfficiencies[efficiencyHistogramIndex].GetTotalHistogram()  -> GetBinContent(rowStartBin + i);
-      moduleEfficiencyNumerator       += detectorPartEfficiencies[efficiencyHistogramIndex].GetPassedHistogram() -> GetBinContent(moduleOtherRowStartBin + i);
-      moduleEfficiencyDenominator     += detectorPartEfficiencies[efficiencyHistogramIndex].GetTotalHistogram()  -> GetBinContent(moduleOtherRowStartBin + i);
+      run.init();
+      run.run = lumisection.run;
     }
-    trajROCEff_.ROCEfficiency        = detectorPartEfficiencies[efficiencyHistogramIndex].GetEfficiency(globalROCBin);
-    if(0 < halfmoduleEfficiencyDenominator) trajROCEff_.halfModuleEfficiency = static_cast<float>(halfmoduleEfficiencyNumerator) / static_cast<float>(halfmoduleEfficiencyDenominator);
-    else                                    trajROCEff_.halfModuleEfficiency = 0.0f;
-    if(0 < moduleEfficiencyDenominator)     trajROCEff_.moduleEfficiency     = static_cast<float>(moduleEfficiencyNumerator)     / static_cast<float>(moduleEfficiencyDenominator);
-    else                                    trajROCEff_.moduleEfficiency     = 0.0f;
-
-    // std::cout << "***" << std::endl;
-    // std::cout << 
-    //   "trajField.mod_on.det:             " << std::setw(5) << std::setprecision(3) << trajField.mod_on.det             << std::endl << 
-    //   "trajField.mod_on.layer:           " << std::setw(5) << std::setprecision(3) << trajField.mod_on.layer           << std::endl << 
-    //   "trajField.mod_on.module_coord:    " << std::setw(5) << std::setprecision(3) << trajField.mod_on.module_coord    << std::endl << 
-    //   "trajField.mod_on.ladder_coord:    " << std::setw(5) << std::setprecision(3) << trajField.mod_on.ladder_coord    << std::endl << 
-    //   "trajROCEff_.ROCEfficiency:        " << std::setw(5) << std::setprecision(3) << trajROCEff_.ROCEfficiency        << std::endl << 
-    //   "trajROCEff_.halfModuleEfficiency: " << std::setw(5) << std::setprecision(3) << trajROCEff_.halfModuleEfficiency << std::endl << 
-    //   "trajROCEff_.moduleEfficiency:     " << std::setw(5) << std::setprecision(3) << trajROCEff_.moduleEfficiency     << std::endl << 
-    //   "halfmoduleEfficiencyNumerator:    " << std::setw(5) << std::setprecision(3) << halfmoduleEfficiencyNumerator    << std::endl << 
-    //   "halfmoduleEfficiencyDenominator:  " << std::setw(5) << std::setprecision(3) << halfmoduleEfficiencyDenominator  << std::endl << 
-    //   "moduleEfficiencyNumerator:        " << std::setw(5) << std::setprecision(3) << moduleEfficiencyNumerator        << std::endl << 
-    //   "moduleEfficiencyDenominator:      " << std::setw(5) << std::setprecision(3) << moduleEfficiencyDenominator      << std::endl << 
-    //   "moduleEfficiencyNumerator:        " << std::setw(5) << std::setprecision(3) << moduleEfficiencyNumerator        << std::endl << 
-    //   "moduleEfficiencyDenominator:      " << std::setw(5) << std::setprecision(3) << moduleEfficiencyDenominator      << std::endl;
-    trajROCEfficiencyTree_ -> Fill();
-  }
-  std::for_each(detectorPartEfficiencies.begin(), detectorPartEfficiencies.end(), [] (auto& e)
+    ++run.nls;
+    NtuplizerHelpers::addSummaryCounts(run, lumisection);
+    if(std::next(lumiIt) == outputCache.lumisections.end() || std::next(lumiIt) -> second.run != run.run)
+      runTree -> Fill();
+  }
+  for(const NtuplizerHelpers::ROCEfficiencyBatch& batch: outputCache.rocEfficiencyBatches)
   {
-    e.Delete();
-  });
-  detectorPartEfficiencies.clear();
+    for(const std::array<float, 3>& efficiencies: batch.efficiencies)
+    {
+      trajROCEff.ROCEfficiency        = efficiencies[0];
+      trajROCEff.halfModuleEfficiency = efficiencies[1];
+      trajROCEff.moduleEfficiency     = efficiencies[2];
+      trajROCEfficiencyTree -> Fill();
+    }
+  }
+  std::cout << "Summaries of all streams written: " << lumiTree -> GetEntries() << " lumisections, "
+	    << runTree -> GetEntries() << " runs, " << trajROCEfficiencyTree -> GetEntries()
+	    << " ROC efficiency entries." << std::endl;
 }
+#endif
 
 //////////////////////////////
 // Private member functions //
@@ -1981,7 +2541,57 @@ void PhaseIPixelNtuplizer::printEvtInfo(const std::string& streamType)
     << "\03339[m" << std::endl;
 }
 
+// Position of the module in the module table, -1 if it is not in the table
+int PhaseIPixelNtuplizer::getModuleIndex(const DetId &detId) const
+{
+
+  std::unordered_map<uint32_t, unsigned int>::const_iterator moduleIndex_it =
+    moduleIndex_.find(detId.rawId());
+  return moduleIndex_it == moduleIndex_.end() ? -1 : static_cast<int>(moduleIndex_it->second);
+
+}
+
 void PhaseIPixelNtuplizer::getModuleData(ModuleData &mod, bool online, const DetId &detId)
+{
+
+  getModuleData(mod, online, detId, getModuleIndex(detId));
+
+}
+
+// The module index is looked up once per module by the callers filling several entries
+void PhaseIPixelNtuplizer::getModuleData(ModuleData &mod, bool online, const DetId &detId, int moduleIndex)
+{
+
+  if(moduleIndex == -1) {
+    fillModuleDataFromCoordinates(mod, online, detId);
+    return;
+  }
+
+  mod.init();
+
+  const ModuleTableEntry& entry = moduleTable_[moduleIndex][online];
+  mod.det     = entry.det;
+  mod.shl     = entry.shl;
+  mod.side    = entry.side;
+  mod.module  = entry.module;
+  mod.layer   = entry.layer;
+  mod.sec     = entry.sec;
+  mod.ladder  = entry.ladder;
+  mod.flipped = entry.flipped;
+  mod.half    = entry.half;
+  mod.disk    = entry.disk;
+  mod.blade   = entry.blade;
+  mod.panel   = entry.panel;
+  mod.ring    = entry.ring;
+  mod.rawid   = entry.rawid;
+  mod.fedid   = entry.fedid;
+
+  // FED error
+  mod.federr = federrors_.get(moduleIndex);
+
+}
+
+void PhaseIPixelNtuplizer::fillModuleDataFromCoordinates(ModuleData &mod, bool online, const DetId &detId)
 {
 
   mod.init();
@@ -2023,9 +2633,97 @@ void PhaseIPixelNtuplizer::getModuleData(ModuleData &mod, bool online, const Det
   mod.fedid = coord_.fedid(detId);
 
   // FED error
-  std::map<uint32_t, int>::const_iterator federrors_it =
-    federrors_.find(detId.rawId());
-  mod.federr = (federrors_it != federrors_.end()) ? federrors_it->second : 0;
+  mod.federr = federrors_.get(moduleIndex_, detId.rawId());
+
+}
+
+void PhaseIPixelNtuplizer::buildModuleTable()
+{
+
+  moduleTable_.clear();
+  moduleIndex_.clear();
+
+  ModuleData mod;
+  for(const auto& detUnit: trackerGeometry_ -> detUnits()) {
+
+    DetId detId = detUnit -> geographicalId();
+    if(!NtuplizerHelpers::detidIsOnPixel(detId)) continue;
+
+    std::array<ModuleTableEntry, 2> entries;
+    for(int online = 0; online < 2; ++online) {
+      fillModuleDataFromCoordinates(mod, online, detId);
+      entries[online] = { mod.det, mod.shl, mod.side, mod.module, mod.layer, mod.sec,
+			  mod.ladder, mod.flipped, mod.half, mod.disk, mod.blade, mod.panel,
+			  mod.ring, mod.rawid, mod.fedid };
+    }
+    moduleIndex_[detId.rawId()] = moduleTable_.size();
+    moduleTable_.push_back(entries);
+
+  }
+
+  std::cout << "Module data table built for " << moduleTable_.size() << " pixel modules." << std::endl;
+
+}
+
+void PhaseIPixelNtuplizer::benchmarkModuleTable()
+{
+
+  // Every cluster fills the module data in both conventions
+  constexpr int numRepetitions = 100;
+
+  std::vector<DetId> detIds;
+  for(const auto& moduleIndex: moduleIndex_) detIds.emplace_back(moduleIndex.first);
+
+  ModuleData modOffline;
+  ModuleData modOnline;
+  ModuleData modOfflineTable;
+  ModuleData modOnlineTable;
+
+  auto coordinatesStart = std::chrono::steady_clock::now();
+  for(int repetition = 0; repetition < numRepetitions; ++repetition) {
+    for(const DetId& detId: detIds) {
+      fillModuleDataFromCoordinates(modOffline, 0, detId);
+      fillModuleDataFromCoordinates(modOnline,  1, detId);
+    }
+  }
+  auto coordinatesEnd = std::chrono::steady_clock::now();
+
+  for(int repetition = 0; repetition < numRepetitions; ++repetition) {
+    for(const DetId& detId: detIds) {
+      const int moduleIndex = getModuleIndex(detId);
+      getModuleData(modOfflineTable, 0, detId, moduleIndex);
+      getModuleData(modOnlineTable,  1, detId, moduleIndex);
+    }
+  }
+  auto tableEnd = std::chrono::steady_clock::now();
+
+  int numMismatches = 0;
+  for(const DetId& detId: detIds) {
+    for(int online = 0; online < 2; ++online) {
+      fillModuleDataFromCoordinates(modOffline, online, detId);
+      getModuleData(modOfflineTable, online, detId);
+      if(modOffline.det    != modOfflineTable.det    || modOffline.shl     != modOfflineTable.shl     ||
+	 modOffline.side   != modOfflineTable.side   || modOffline.module  != modOfflineTable.module  ||
+	 modOffline.layer  != modOfflineTable.layer  || modOffline.sec     != modOfflineTable.sec     ||
+	 modOffline.ladder != modOfflineTable.ladder || modOffline.flipped != modOfflineTable.flipped ||
+	 modOffline.half   != modOfflineTable.half   || modOffline.disk    != modOfflineTable.disk    ||
+	 modOffline.blade  != modOfflineTable.blade  || modOffline.panel   != modOfflineTable.panel   ||
+	 modOffline.ring   != modOfflineTable.ring   || modOffline.rawid   != modOfflineTable.rawid   ||
+	 modOffline.fedid  != modOfflineTable.fedid  || modOffline.federr  != modOfflineTable.federr) ++numMismatches;
+    }
+  }
+
+  const double numFills = static_cast<double>(numRepetitions) * detIds.size();
+  const double coordinatesTime = std::chrono::duration<double, std::nano>(coordinatesEnd - coordinatesStart).count() / numFills;
+  const double tableTime       = std::chrono::duration<double, std::nano>(tableEnd - coordinatesEnd).count() / numFills;
+
+  std::cout << " --- Module data fill benchmark --- " << std::endl;
+  std::cout << "Modules: " << detIds.size() << ", repetitions: " << numRepetitions << std::endl;
+  std::cout << "Per-cluster cost (offline + online) with SiPixelCoordinates: " << coordinatesTime << " ns" << std::endl;
+  std::cout << "Per-cluster cost (offline + online) with the module table:   " << tableTime << " ns" << std::endl;
+  std::cout << "Speedup: " << (0.0 < tableTime ? coordinatesTime / tableTime : 0.0) << std::endl;
+  std::cout << "Module data fills differing between the two methods: " << numMismatches << std::endl;
+  std::cout << " --- End module data fill benchmark --- " << std::endl;
 
 }
 
@@ -2164,8 +2862,7 @@ float PhaseIPixelNtuplizer::clusterPointDistance
 {
 
   const GeomDetUnit* geomDetUnit = trackerGeometry_ -> idToDetUnit(detId);
-  LocalPoint clustLocalCoordinates;
-  std::tie(clustLocalCoordinates, std::ignore, std::ignore) = pixelClusterParameterEstimator_ -> getParameters(cluster, *geomDetUnit);
+  LocalPoint clustLocalCoordinates = getClusterParameters(cluster, *geomDetUnit).position;
 
   float xDist = clustLocalCoordinates.x() - referencePoint.x();
   float yDist = clustLocalCoordinates.y() - referencePoint.y();
@@ -2180,9 +2877,7 @@ LocalPoint PhaseIPixelNtuplizer::clusterPointDistanceVector
 {
 
   const GeomDetUnit* geomDetUnit = trackerGeometry_ -> idToDetUnit(detId);
-  LocalPoint clustLocalCoordinates;
-  std::tie(clustLocalCoordinates, std::ignore, std::ignore) = 
-    pixelClusterParameterEstimator_ -> getParameters(cluster, *geomDetUnit);
+  LocalPoint clustLocalCoordinates = getClusterParameters(cluster, *geomDetUnit).position;
 
   return LocalPoint(clustLocalCoordinates.x() - referencePoint.x(),
 		    clustLocalCoordinates.y() - referencePoint.y(),
@@ -2330,25 +3025,27 @@ void PhaseIPixelNtuplizer::printTrackCompositionInfo
 
 }
 
-void PhaseIPixelNtuplizer::findClosestClusters(const edm::Handle<edmNew::DetSetVector<SiPixelCluster> >& clusterCollectionHandle,
-					       uint32_t rawId, float lx, float ly, float* dx_cl, float* dy_cl) {
-  
-  for (size_t i=0; i<2; i++) dx_cl[i]=dy_cl[i]=NOVAL_F;
+void PhaseIPixelNtuplizer::buildClusterIndex(const edm::Handle<edmNew::DetSetVector<SiPixelCluster>>& clusterCollectionHandle) {
+
+  clusterIndex_.clear();
+  clusterCollection_ = nullptr;
+  clusterParametersFilled_.clear();
+  std::fill(clusterIndexNclu_, clusterIndexNclu_ + 7, 0);
+  std::fill(clusterIndexNpix_, clusterIndexNpix_ + 7, 0);
 
   if (!clusterCollectionHandle.isValid()) return;
 
-  const edmNew::DetSetVector<SiPixelCluster>& clusterCollection=*clusterCollectionHandle;
-  edmNew::DetSetVector<SiPixelCluster>::const_iterator itClusterSet= clusterCollection.begin();
+  clusterCollection_ = clusterCollectionHandle.product();
+  const std::vector<SiPixelCluster>& clusters = clusterCollection_ -> data();
 
-  float minD[2];
-  minD[0]=minD[1]=10000.;
+  // CPE results are filled lazily, see getClusterParameters()
+  clusterParameters_.resize(clusters.size());
+  clusterParametersFilled_.assign(clusters.size(), 0);
 
-  for ( ; itClusterSet!=clusterCollection.end(); itClusterSet++) {
-    
-    DetId detId(itClusterSet->id());
-    
-    if (detId.rawId()!=rawId) continue;
+  for (const auto& clusterSet: *clusterCollection_) {
+    if (clusterSet.empty()) continue;
 
+    DetId detId(clusterSet.id());
     unsigned int subDetId=detId.subdetId();
     if (subDetId!=PixelSubdetector::PixelBarrel &&
 	subDetId!=PixelSubdetector::PixelEndcap) {
@@ -2356,37 +3053,124 @@ void PhaseIPixelNtuplizer::findClosestClusters(const edm::Handle<edmNew::DetSetV
       continue;
     }
 
-    const PixelGeomDetUnit *pixdet = (const PixelGeomDetUnit*) trackerGeometry_->idToDetUnit(detId);
-
-    edmNew::DetSet<SiPixelCluster>::const_iterator itCluster=itClusterSet->begin();  
-    for(; itCluster!=itClusterSet->end(); ++itCluster) {
-      //const Surface* surface;
-      //surface = &(tracker->idToDet(detId)->surface());
-      //GlobalPoint gp;
-      LocalPoint lp(itCluster->x(), itCluster->y(), 0.);
-      PixelClusterParameterEstimator::ReturnType params=pixelClusterParameterEstimator_->getParameters(*itCluster,*pixdet);
-      lp = std::get<0>(params);
-      //else {
-      //  LocalPoint lp(itCluster->x(), itCluster->y(), 0.);
-      //  gp = surface->toGlobal(lp);
-      //}
-      //floatD=sqrt((gp.x()-glx)*(gp.x()-glx)+(gp.y()-gly)*(gp.y()-gly)+(gp.z()-glz)*(gp.z()-glz));
-      float D = sqrt((lp.x()-lx)*(lp.x()-lx)+(lp.y()-ly)*(lp.y()-ly));
-      if (D<minD[0]) {
-	minD[1]=minD[0];
-	dx_cl[1]=dx_cl[0];
-	dy_cl[1]=dy_cl[0];
-	minD[0]=D;
-	dx_cl[0]=lp.x();
-	dy_cl[0]=lp.y();
-      } else if (D<minD[1]) {
-	minD[1]=D;
-	dx_cl[1]=lp.x();
-	dy_cl[1]=lp.y();
-      }
-    } // loop on cluster sets
+    const unsigned int begin = clusterSet.begin() - clusters.data();
+    clusterIndex_[detId.rawId()] = ModuleClusterRange{begin, begin + static_cast<unsigned int>(clusterSet.size())};
+
+    // Event level numbers of clusters on layers/disk
+    const int layDiskIndex = subDetId == PixelSubdetector::PixelBarrel ?
+      trackerTopology_ -> pxbLayer(detId.rawId()) - 1 : trackerTopology_ -> pxfDisk(detId.rawId()) + 3;
+    clusterIndexNclu_[layDiskIndex] += clusterSet.size();
+    if(!npixFromDigiCollection_) for(const auto& cluster: clusterSet) clusterIndexNpix_[layDiskIndex] += cluster.size();
+  }
+
+}
+
+void PhaseIPixelNtuplizer::matchTracksToMuons(const edm::Handle<TrajTrackAssociationCollection>& trajTrackCollectionHandle,
+					      const edm::Handle<reco::MuonCollection>& muonCollectionHandle) {
+
+  trackMuonMatches_.clear();
+
+  if (!trajTrackCollectionHandle.isValid()) return;
+
+  // Muons
+  muonHash_.clear();
+  if (muonCollectionHandle.isValid()) {
+    for (unsigned int i = 0; i < muonCollectionHandle->size(); i++) {
+      const reco::Muon& mu = (*muonCollectionHandle)[i];
+      if ((keepAllTrackerMuons_&&mu.isTrackerMuon()) || (keepAllGlobalMuons_&&mu.isGlobalMuon()))
+	muonHash_.insert(mu.pt(), mu.eta(), i);
+    }
+  }
+  for(const auto& trajTrackPair: *trajTrackCollectionHandle) {
+    const reco::TrackRef& track = trajTrackPair.val;
+    trackMuonMatches_[track] = NtuplizerHelpers::TrackMuonMatch{muonHash_.findLastMatch(track->pt(), track->eta()), -1};
+  }
+
+  // Muon tracks of the ALCARECO
+  if (!isALCARECO_ || !muonTrackCollectionHandle_.isValid()) return;
+
+  muonHash_.clear();
+  for (unsigned int i = 0; i < muonTrackCollectionHandle_->size(); i++) {
+    auto muon = muonTrackCollectionHandle_->ptrAt(i);
+    muonHash_.insert(muon->pt(), muon->eta(), i);
+  }
+  for(auto& trackMuonMatch: trackMuonMatches_) {
+    const reco::TrackRef& track = trackMuonMatch.first;
+    trackMuonMatch.second.muonTrack = muonHash_.findLastMatch(track->pt(), track->eta());
+  }
+
+}
+
+NtuplizerHelpers::TrackMuonMatch PhaseIPixelNtuplizer::getTrackMuonMatch(const reco::TrackRef& track) {
+
+  auto trackMuonMatchIt = trackMuonMatches_.find(track);
+  if (trackMuonMatchIt == trackMuonMatches_.end()) return NtuplizerHelpers::TrackMuonMatch{-1, -1};
+  return trackMuonMatchIt -> second;
+
+}
+
+const PhaseIPixelNtuplizer::ClusterParameters&
+PhaseIPixelNtuplizer::getClusterParameters(const SiPixelCluster& cluster, const GeomDetUnit& geomDetUnit) {
+
+  // Clusters not stored in the cluster collection of the event are not cached
+  const SiPixelCluster* clustersBegin = clusterParametersFilled_.empty() ? nullptr : clusterCollection_ -> data().data();
+  const SiPixelCluster* clustersEnd   = clustersBegin + clusterParametersFilled_.size();
+  if (clustersBegin == nullptr ||
+      std::less<const SiPixelCluster*>()(&cluster, clustersBegin) ||
+      !std::less<const SiPixelCluster*>()(&cluster, clustersEnd)) {
+    ++nClusterParametersCacheMiss_;
+    std::tie(uncachedClusterParameters_.position, uncachedClusterParameters_.error, std::ignore) =
+      pixelClusterParameterEstimator_ -> getParameters(cluster, geomDetUnit);
+    return uncachedClusterParameters_;
   }
 
+  const std::size_t clusterPosition = &cluster - clustersBegin;
+  ClusterParameters& parameters = clusterParameters_[clusterPosition];
+
+  if (clusterParametersFilled_[clusterPosition]) {
+    ++nClusterParametersCacheHit_;
+    return parameters;
+  }
+
+  ++nClusterParametersCacheMiss_;
+  std::tie(parameters.position, parameters.error, std::ignore) =
+    pixelClusterParameterEstimator_ -> getParameters(cluster, geomDetUnit);
+  clusterParametersFilled_[clusterPosition] = 1;
+  return parameters;
+
+}
+
+void PhaseIPixelNtuplizer::findClosestClusters(uint32_t rawId, float lx, float ly, float* dx_cl, float* dy_cl) {
+  
+  for (size_t i=0; i<2; i++) dx_cl[i]=dy_cl[i]=NOVAL_F;
+
+  auto moduleClustersIt = clusterIndex_.find(rawId);
+  if (moduleClustersIt == clusterIndex_.end()) return;
+  const ModuleClusterRange& moduleClusters = moduleClustersIt -> second;
+
+  const PixelGeomDetUnit *pixdet = (const PixelGeomDetUnit*) trackerGeometry_->idToDetUnit(DetId(rawId));
+  const std::vector<SiPixelCluster>& clusters = clusterCollection_ -> data();
+
+  float minD[2];
+  minD[0]=minD[1]=10000.;
+
+  for (unsigned int i=moduleClusters.begin; i<moduleClusters.end; ++i) {
+    const LocalPoint& lp = getClusterParameters(clusters[i], *pixdet).position;
+    float D = sqrt((lp.x()-lx)*(lp.x()-lx)+(lp.y()-ly)*(lp.y()-ly));
+    if (D<minD[0]) {
+      minD[1]=minD[0];
+      dx_cl[1]=dx_cl[0];
+      dy_cl[1]=dy_cl[0];
+      minD[0]=D;
+      dx_cl[0]=lp.x();
+      dy_cl[0]=lp.y();
+    } else if (D<minD[1]) {
+      minD[1]=D;
+      dx_cl[1]=lp.x();
+      dy_cl[1]=lp.y();
+    }
+  } // loop on the clusters of the module
+
   for (size_t i=0; i<2; i++) {
     if (minD[i]<9999.) {
       dx_cl[i]=fabs(dx_cl[i]-lx);
@@ -2400,32 +3184,65 @@ void PhaseIPixelNtuplizer::findClosestClusters(const edm::Handle<edmNew::DetSetV
 namespace NtuplizerHelpers
 {
 
-  std::map<uint32_t, int> getFedErrors
+  void getFedErrors
   ( const edm::Event& iEvent, 
-    const edm::EDGetTokenT<edm::DetSetVector<SiPixelRawDataError>>& rawDataErrorToken)
+    const edm::EDGetTokenT<edm::DetSetVector<SiPixelRawDataError>>& rawDataErrorToken,
+    const std::unordered_map<uint32_t, unsigned int>& moduleIndex,
+    FedErrorTable& federrors,
+    int& nErrors)
   {
 
-    std::map<uint32_t, int> federrors;
+    federrors.reset(moduleIndex.size());
+    nErrors = 0;
 
     edm::Handle<edm::DetSetVector<SiPixelRawDataError>> siPixelRawDataErrorCollectionHandle;
     iEvent.getByToken(rawDataErrorToken,                siPixelRawDataErrorCollectionHandle);
 
-    // Return empty map if no fed error entry is available
-    if(!siPixelRawDataErrorCollectionHandle.isValid()) return federrors;
+    // Leave the table empty if no fed error entry is available
+    if(!siPixelRawDataErrorCollectionHandle.isValid()) return;
 
     // Loop on errors
     for(const auto& pixel_error_set: *siPixelRawDataErrorCollectionHandle) {
       for(const auto& pixel_error: pixel_error_set) {
+	++nErrors;
 	if(pixel_error_set.detId() != 0xffffffff) {
 	  DetId detId(pixel_error_set.detId());
 	  int type = pixel_error.getType();
-	  federrors.insert(std::pair<uint32_t,int>(detId.rawId(), type));
+	  federrors.insert(moduleIndex, detId.rawId(), type);
 	}
       }
     }
 
-    return federrors;
+  }
 
+  void FedErrorTable::reset(size_t numModules) {
+    if(types_.size() != numModules) {
+      types_.assign(numModules, -1);
+    } else {
+      for(unsigned int moduleNum: setModules_) types_[moduleNum] = -1;
+    }
+    setModules_.clear();
+    unindexed_.clear();
+  }
+
+  void FedErrorTable::insert(const std::unordered_map<uint32_t, unsigned int>& moduleIndex,
+			     uint32_t rawId, int type) {
+    auto moduleIndexIt = moduleIndex.find(rawId);
+    if(moduleIndexIt == moduleIndex.end()) {
+      unindexed_.insert(std::pair<uint32_t,int>(rawId, type));
+      return;
+    }
+    int& moduleType = types_[moduleIndexIt -> second];
+    if(0 <= moduleType) return;
+    moduleType = type;
+    setModules_.push_back(moduleIndexIt -> second);
+  }
+
+  int FedErrorTable::get(const std::unordered_map<uint32_t, unsigned int>& moduleIndex, uint32_t rawId) const {
+    auto moduleIndexIt = moduleIndex.find(rawId);
+    if(moduleIndexIt != moduleIndex.end()) return get(moduleIndexIt -> second);
+    auto unindexedIt = unindexed_.find(rawId);
+    return unindexedIt != unindexed_.end() ? unindexedIt -> second : 0;
   }
 
   bool detidIsOnPixel(const DetId& detid) {
@@ -2531,7 +3348,7 @@ namespace NtuplizerHelpers
 
   TrajectoryStateOnSurface getTrajectoryStateOnSurface(const TrajectoryMeasurement& measurement) {
 
-    static TrajectoryStateCombiner trajStateCombiner;
+    static const TrajectoryStateCombiner trajStateCombiner;
 
     const auto& forwardPredictedState  = measurement.forwardPredictedState();
     const auto& backwardPredictedState = measurement.backwardPredictedState();
@@ -2601,34 +3418,200 @@ namespace NtuplizerHelpers
           std::abs(one->vz() - two->vz()) < 1e-2);
   }
 
-  void getClosestTrajMeasDistance(const TrajectoryMeasurement& measurement,
+  void buildTrajMeasIndex(const edm::Handle<TrajTrackAssociationCollection>& trajTrackCollectionHandle,
+                          const TrackerTopology* trackerTopology,
+                          TrajMeasIndex& trajMeasIndex, TrackHitCounts& trackHitCounts) {
+
+    trajMeasIndex.clear();
+    trackHitCounts.reset();
+
+    if(!trajTrackCollectionHandle.isValid()) return;
+
+    // Keeping the order of the collection, so that ties are resolved as before
+    TrackHitCounts currentTrackCounts;
+    for(const auto& trajTrackPair: *trajTrackCollectionHandle) {
+
+      const reco::TrackRef& track = trajTrackPair.val;
+      const edm::Ref<std::vector<Trajectory>> traj = trajTrackPair.key;
+
+      // Only the tracks with a valid pixel hit are counted, see trajectoryHasPixelHit()
+      bool hasPixelHit = false;
+      currentTrackCounts.reset();
+      for(const auto& measurement: traj -> measurements()) {
+
+	DetId detId = measurement.recHit() -> geographicalId();
+	if(!detidIsOnPixel(detId)) continue;
+
+	std::pair<float, float> localXY = getLocalXY(measurement);
+	trajMeasIndex[detId.rawId()].push_back({localXY.first, localXY.second, track});
+
+	if(!measurement.updatedState().isValid()) continue;
+	const bool isValidHit = measurement.recHit() -> getType() == TrackingRecHit::valid;
+	hasPixelHit |= measurement.recHit() -> isValid();
+	if(detId.subdetId() == PixelSubdetector::PixelBarrel) {
+	  const int layer = trackerTopology -> pxbLayer(detId.rawId());
+	  currentTrackCounts.ntrackBPix[layer - 1]++;
+	  if(isValidHit) currentTrackCounts.ntrackBPixvalid[layer - 1]++;
+	} else {
+	  const int disk = trackerTopology -> pxfDisk(detId.rawId());
+	  currentTrackCounts.ntrackFPix[disk - 1]++;
+	  if(isValidHit) currentTrackCounts.ntrackFPixvalid[disk - 1]++;
+	}
+      }
+
+      if(!hasPixelHit) continue;
+      ++trackHitCounts.ntracks;
+      for(size_t i = 0; i < 4; i++) {
+	trackHitCounts.ntrackBPix[i]      += currentTrackCounts.ntrackBPix[i];
+	trackHitCounts.ntrackBPixvalid[i] += currentTrackCounts.ntrackBPixvalid[i];
+      }
+      for(size_t i = 0; i < 3; i++) {
+	trackHitCounts.ntrackFPix[i]      += currentTrackCounts.ntrackFPix[i];
+	trackHitCounts.ntrackFPixvalid[i] += currentTrackCounts.ntrackFPixvalid[i];
+      }
+    }
+  }
+
+  void PtEtaHash::insert(double pt, double eta, int index) {
+    long long ptCell  = static_cast<long long>(std::floor(pt  / CELL_SIZE));
+    long long etaCell = static_cast<long long>(std::floor(eta / CELL_SIZE));
+    cells_[cellKey(ptCell, etaCell)].push_back(objects_.size());
+    objects_.push_back({pt, eta, index});
+  }
+
+  int PtEtaHash::findLastMatch(double pt, double eta) const {
+    // Cells are wider than the matching window, so only neighbouring cells have to be checked
+    long long ptCell  = static_cast<long long>(std::floor(pt  / CELL_SIZE));
+    long long etaCell = static_cast<long long>(std::floor(eta / CELL_SIZE));
+    int lastMatch = -1;
+    for(long long dPt = -1; dPt <= 1; ++dPt) {
+      for(long long dEta = -1; dEta <= 1; ++dEta) {
+	auto cellIt = cells_.find(cellKey(ptCell + dPt, etaCell + dEta));
+	if(cellIt == cells_.end()) continue;
+	for(unsigned int objectNum: cellIt -> second) {
+	  const Object& object = objects_[objectNum];
+	  if(std::abs(pt-object.pt)<0.01 && std::abs(eta-object.eta)<0.01 && lastMatch < object.index)
+	    lastMatch = object.index;
+	}
+      }
+    }
+    return lastMatch;
+  }
+
+  void getNearestTrackDistances(const edm::Handle<TrajTrackAssociationCollection>& trajTrackCollectionHandle,
+                                std::map<reco::TrackRef, float>& nearestTrackDr) {
+
+    nearestTrackDr.clear();
+
+    if(!trajTrackCollectionHandle.isValid()) return;
+
+    // Tracks are put on an eta-phi grid with cells at least cellSize wide.
+    // The cells around a track are searched ring by ring: the tracks outside
+    // of the first r rings are farther than r * cellSize, so the search stops
+    // when a closer track has been found, or when the grid is covered.
+    constexpr double cellSize    = 0.2;
+    const int        nPhiCells   = static_cast<int>(6.283185307 / cellSize);
+    const double     phiCellSize = 6.283185307 / nPhiCells;
+
+    auto cellKey = [&] (int etaCell, int phiCell) {
+      return static_cast<long long>(etaCell) * nPhiCells + (phiCell + nPhiCells) % nPhiCells;
+    };
+
+    auto trackDistance = [] (const reco::TrackRef& track, const reco::TrackRef& track2) {
+      double deta = track2->eta()-track->eta();
+      double dphi = std::abs(track2->phi()-track->phi());
+      dphi = dphi<3.141592654 ? dphi : 6.283185307 - dphi;
+      return std::sqrt(deta*deta+dphi*dphi);
+    };
+
+    std::vector<reco::TrackRef>      tracks;
+    std::vector<std::pair<int, int>> trackCells;
+    std::unordered_map<long long, std::vector<unsigned int>> grid;
+    int minEtaCell = 0;
+    int maxEtaCell = 0;
+
+    for(const auto& pair : *trajTrackCollectionHandle) {
+      const reco::TrackRef& track = pair.val;
+      int etaCell = static_cast<int>(std::floor(track->eta() / cellSize));
+      int phiCell = static_cast<int>((track->phi() + 3.141592654) / phiCellSize);
+      phiCell = std::max(0, std::min(phiCell, nPhiCells - 1));
+      grid[cellKey(etaCell, phiCell)].push_back(tracks.size());
+      minEtaCell = tracks.empty() ? etaCell : std::min(minEtaCell, etaCell);
+      maxEtaCell = tracks.empty() ? etaCell : std::max(maxEtaCell, etaCell);
+      tracks.push_back(track);
+      trackCells.emplace_back(etaCell, phiCell);
+    }
+
+    // Every phi cell is reached by exactly one offset in [minPhiOffset, maxPhiOffset]
+    const int minPhiOffset = -(nPhiCells - 1) / 2;
+    const int maxPhiOffset = nPhiCells / 2;
+
+    for(unsigned int i = 0; i < tracks.size(); ++i) {
+      const int etaCell = trackCells[i].first;
+      const int phiCell = trackCells[i].second;
+      const int numRings = std::max({etaCell - minEtaCell, maxEtaCell - etaCell, maxPhiOffset});
+
+      auto checkCell = [&] (int dEta, int dPhi, double& minDistance) {
+	if(etaCell + dEta < minEtaCell || maxEtaCell < etaCell + dEta) return;
+	if(dPhi < minPhiOffset || maxPhiOffset < dPhi) return;
+	auto cellIt = grid.find(cellKey(etaCell + dEta, phiCell + dPhi));
+	if(cellIt == grid.end()) return;
+	for(unsigned int j: cellIt -> second) {
+	  if(tracks[i] == tracks[j]) continue;
+	  double distance = trackDistance(tracks[i], tracks[j]);
+	  if(distance < minDistance) minDistance = distance;
+	}
+      };
+
+      double minDistance = 9999;
+      for(int ring = 0; ring <= numRings; ++ring) {
+	for(int dEta = -ring; dEta <= ring; ++dEta) {
+	  if(std::abs(dEta) == ring) {
+	    for(int dPhi = -ring; dPhi <= ring; ++dPhi) checkCell(dEta, dPhi, minDistance);
+	  } else {
+	    checkCell(dEta, -ring, minDistance);
+	    checkCell(dEta,  ring, minDistance);
+	  }
+	}
+	if(minDistance <= ring * cellSize) break;
+      }
+      nearestTrackDr[tracks[i]] = minDistance;
+    }
+  }
+
+  // Combines the seed with the value, finalized as in splitmix64
+  uint64_t getDownscaleHash(uint64_t seed, uint64_t value) {
+    uint64_t hash = seed ^ (value + 0x9e3779b97f4a7c15ULL + (seed << 6) + (seed >> 2));
+    hash = (hash ^ (hash >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    hash = (hash ^ (hash >> 27)) * 0x94d049bb133111ebULL;
+    return hash ^ (hash >> 31);
+  }
+
+  void getClosestTrajMeasDistance(uint32_t rawId, float lx, float ly,
                               const reco::TrackRef& track,
-                              const edm::Handle<TrajTrackAssociationCollection>& trajTrackCollectionHandle,
+                              const TrajMeasIndex& trajMeasIndex,
                               float& distance, float& dx, float& dy) {
 
     dx = -NOVAL_F;
     dy = -NOVAL_F;
     distance = -NOVAL_F;
 
-    DetId detId = measurement.recHit() -> geographicalId();
-    double closestDistance = 9999;
-    for(const auto& otherTrajTrackPair: *trajTrackCollectionHandle) {
+    auto moduleMeasurementsIt = trajMeasIndex.find(rawId);
+    if(moduleMeasurementsIt == trajMeasIndex.end()) return;
 
-      const reco::TrackRef& otherTrack = otherTrajTrackPair.val;
-      if (sameTrack(track, otherTrack)) continue;
-
-      const edm::Ref<std::vector<Trajectory>> otherTraj = otherTrajTrackPair.key;
-
-      for(auto otherTrajMeasurementIt = otherTraj -> measurements().begin();
-	  otherTrajMeasurementIt != otherTraj -> measurements().end(); ++otherTrajMeasurementIt) {
-
-	if(otherTrajMeasurementIt -> recHit() -> geographicalId() != detId) continue;
-
-	float otherDistance =  trajMeasurementDistance(measurement, *otherTrajMeasurementIt);
-	if (otherDistance < closestDistance) {
-          closestDistance = otherDistance;
-          trajMeasurementDistance(measurement, *otherTrajMeasurementIt, distance, dx, dy);
-        }
+    double closestDistance = 9999;
+    for(const auto& otherMeasurement: moduleMeasurementsIt -> second) {
+
+      if (sameTrack(track, otherMeasurement.track)) continue;
+
+      float otherDx = lx - otherMeasurement.lx;
+      float otherDy = ly - otherMeasurement.ly;
+      float otherDistance = std::sqrt(otherDx * otherDx + otherDy * otherDy);
+      if (otherDistance < closestDistance) {
+        closestDistance = otherDistance;
+        distance = otherDistance;
+        dx = otherDx;
+        dy = otherDy;
       }
     }
   }
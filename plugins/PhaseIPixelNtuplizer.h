@@ -3,6 +3,9 @@
 
 #define ADD_SIM_INFO 0
 #define ADD_NEW_MUON_SELECTORS 1 // Works in 9_4_X, 10_6_X or later
+// Multi-stream (edm::stream) version of the plugin, enable with
+// scram b -j 8 USER_CXXFLAGS="-DCMSSW_VERSION=123 -DNTUPLIZER_MULTISTREAM"
+// #define NTUPLIZER_MULTISTREAM
 
 /*
 #define ADD_SIM_INFO 1
@@ -19,7 +22,9 @@
 
 // CMSSW code
 #include "FWCore/Framework/interface/Frameworkfwd.h"
-#if CMSSW_VERSION >= 123
+#ifdef NTUPLIZER_MULTISTREAM
+#include "FWCore/Framework/interface/stream/EDAnalyzer.h"
+#elif CMSSW_VERSION >= 123
 #include "FWCore/Framework/interface/one/EDAnalyzer.h"
 #else
 #include "FWCore/Framework/interface/EDAnalyzer.h"
@@ -29,6 +34,7 @@
 #include "FWCore/Framework/interface/MakerMacros.h"
 #include "FWCore/ParameterSet/interface/ParameterSet.h"
 #include "FWCore/Framework/interface/ESHandle.h"
+#include "FWCore/Framework/interface/ESWatcher.h"
 #include "FWCore/MessageLogger/interface/MessageLogger.h"
 #include "FWCore/Common/interface/TriggerNames.h"
 //#include "DataFormats/TrackReco/interface/Track.h"
@@ -58,6 +64,7 @@
 #include "DataFormats/SiStripDetId/interface/StripSubdetector.h"
 #include "SimDataFormats/TrackingHit/interface/PSimHit.h"
 #include "SimDataFormats/TrackingHit/interface/PSimHitContainer.h"
+#include "SimDataFormats/Track/interface/SimTrackContainer.h"
 #include "DataFormats/SiPixelCluster/interface/SiPixelCluster.h"
 #include "DataFormats/SiPixelRawData/interface/SiPixelRawDataError.h"
 #include "DataFormats/TrackerRecHit2D/interface/SiPixelRecHit.h"
@@ -74,11 +81,16 @@
 #include "RecoTracker/MeasurementDet/interface/MeasurementTracker.h"
 #include "RecoTracker/MeasurementDet/interface/MeasurementTrackerEvent.h"
 #include "TrackingTools/MeasurementDet/interface/LayerMeasurements.h"
+#include "TrackingTools/MeasurementDet/interface/MeasurementDetWithData.h"
+#include "TrackingTools/MeasurementDet/interface/TempMeasurements.h"
+#include "DataFormats/TrackingRecHit/interface/InvalidTrackingRecHit.h"
 #include "RecoLocalTracker/ClusterParameterEstimator/interface/PixelClusterParameterEstimator.h"
 #include "RecoTracker/Record/interface/CkfComponentsRecord.h"
 #include "RecoLocalTracker/Records/interface/TkPixelCPERecord.h"
 #include "SimTracker/TrackerHitAssociation/interface/TrackerHitAssociator.h"
 #include "../interface/PixelHitAssociator.h"
+#include "../interface/TreeRNTupleWriter.h"
+#include "../interface/StageProfiler.h"
 
 // muons
 #include "DataFormats/MuonReco/interface/MuonFwd.h"
@@ -96,7 +108,7 @@
 // Datastructures - Keep all this in one file
 // This has to be a versioned file
 // It cannot go into separate files included from everywhere
-#include "../interface/DataStructures_v9.h" // 2020 December 12, CMSSW_10_6_X and up
+#include "../interface/DataStructures_v10.h" // 2026 October 18, CMSSW_10_6_X and up
 
 // SiPixelCoordinates: new class for plotting Phase 0/1 Geometry
 #include "DQM/SiPixelPhase1Common/interface/SiPixelCoordinates.h"
@@ -108,10 +120,15 @@
 #include <TROOT.h>
 #include <TFile.h>
 #include <TTree.h>
+#include <TBranch.h>
 // #include <TH1D.h>
 #include <TH2D.h>
 #include <TRandom3.h>
-#include <TEfficiency.h>
+#ifdef NTUPLIZER_MULTISTREAM
+#include <RVersion.h>
+#include <ROOT/TBufferMerger.hxx>
+#include <TFileMerger.h>
+#endif
 
 // C++
 #include <iostream>
@@ -119,12 +136,137 @@
 #include <fstream>
 #include <vector>
 #include <map>
+#include <unordered_map>
+#include <chrono>
+#include <memory>
+#include <atomic>
+#include <mutex>
+#include <cstdio>
 
 // Compiler directives
 #define EDM_ML_LOGDEBUG
 #define ML_DEBUG
 
-#if CMSSW_VERSION >= 123
+namespace NtuplizerHelpers
+{
+  // Pixel trajectory measurements of the event grouped by module,
+  // used for the closest other track distance
+  struct TrajMeasIndexEntry {
+    float          lx;
+    float          ly;
+    reco::TrackRef track;
+  };
+  using TrajMeasIndex = std::unordered_map<uint32_t, std::vector<TrajMeasIndexEntry>>;
+
+  // Numbers of the tracks with pixel hits and of their pixel measurements
+  // on the layers and disks, counted while building the TrajMeasIndex
+  struct TrackHitCounts {
+    int ntracks;
+    int ntrackBPix[4];
+    int ntrackBPixvalid[4];
+    int ntrackFPix[3];
+    int ntrackFPixvalid[3];
+    void reset() { *this = TrackHitCounts(); }
+  };
+
+  // Quantized pt-eta hash of objects, to find the ones matching a track
+  // within |dpt| < 0.01 and |deta| < 0.01
+  class PtEtaHash
+  {
+  public:
+    void clear() { cells_.clear(); objects_.clear(); }
+    void insert(double pt, double eta, int index);
+    // Returns the largest index matching, or -1 if there is none
+    int findLastMatch(double pt, double eta) const;
+
+  private:
+    static constexpr double CELL_SIZE = 0.02;
+    struct Object {
+      double pt;
+      double eta;
+      int    index;
+    };
+    static long long cellKey(long long ptCell, long long etaCell) { return ptCell * 1000003 + etaCell; }
+    std::unordered_map<long long, std::vector<unsigned int>> cells_;
+    std::vector<Object>                                      objects_;
+  };
+
+  // FED error types of the event by the index of the module in the module
+  // table, the first error of a module is kept
+  class FedErrorTable
+  {
+  public:
+    // Clears the modules set in the previous event, resized after a module table rebuild
+    void reset(size_t numModules);
+    void insert(const std::unordered_map<uint32_t, unsigned int>& moduleIndex, uint32_t rawId, int type);
+    // 0 if the module has no error
+    int get(unsigned int moduleNum) const {
+      return moduleNum < types_.size() && 0 <= types_[moduleNum] ? types_[moduleNum] : 0;
+    }
+    int get(const std::unordered_map<uint32_t, unsigned int>& moduleIndex, uint32_t rawId) const;
+
+  private:
+    std::vector<int>          types_;      // -1 if the module has no error
+    std::vector<unsigned int> setModules_; // entries to clear for the next event
+    std::map<uint32_t, int>   unindexed_;  // modules missing from the module table
+  };
+
+  // Indices of the objects matched to a track, -1 if not matched
+  struct TrackMuonMatch {
+    int muon;      // in the muon collection (respecting keepAllTrackerMuons and keepAllGlobalMuons)
+    int muonTrack; // in the ALCARECO muon track collection
+  };
+
+#ifdef NTUPLIZER_MULTISTREAM
+#if ROOT_VERSION_CODE >= ROOT_VERSION(6,22,0)
+  using BufferMerger     = ROOT::TBufferMerger;
+  using BufferMergerFile = ROOT::TBufferMergerFile;
+#else
+  using BufferMerger     = ROOT::Experimental::TBufferMerger;
+  using BufferMergerFile = ROOT::Experimental::TBufferMergerFile;
+#endif
+
+  // ROC efficiency counters of the streams in a group of efficiencyCalculationFrequency
+  // lumisections, complete once every stream has ended all lumisections of the group
+  struct ROCEfficiencyWindow {
+    std::vector<unsigned int> passed;
+    std::vector<unsigned int> total;
+    int                       numStreamLumisections = 0;
+    std::vector<std::size_t>  batches; // in OutputCache::rocEfficiencyBatches
+  };
+
+  // trajTree entries sent to the output by a stream at once
+  struct ROCEfficiencyBatch {
+    int                               subFile; // of the stream in subFilenames, -1 with the merger
+    std::vector<int>                  rocIndices;   // cleared when the window is complete
+    std::vector<std::array<float, 3>> efficiencies; // ROC, half-module and module
+  };
+
+  // Shared by the streams: each stream fills the trees either in its own
+  // buffer file, flushed into the output file by the merger (outputMode
+  // "bufferMerger"), or in its own file, merged into the output file in
+  // globalEndJob (outputMode "subFiles")
+  // The lumisection, run and ROC efficiency summaries are added up over the
+  // streams and written once in globalEndJob
+  struct OutputCache {
+    std::string                   outputFilename;
+    int                           compressionSettings;
+    edm::ParameterSet             outputSettings;
+    std::unique_ptr<BufferMerger> merger;
+    mutable std::mutex               subFilenamesMutex;
+    mutable std::vector<std::string> subFilenames;
+    mutable std::mutex                                  summaryMutex;
+    mutable int                                         numStreams = 0;
+    mutable std::map<std::pair<int, int>, LumiData>     lumisections; // by run and lumisection
+    mutable std::map<int, ROCEfficiencyWindow>          rocEfficiencyWindows;
+    mutable std::vector<ROCEfficiencyBatch>             rocEfficiencyBatches; // in the order of the trajTree entries
+  };
+#endif
+} // NtuplizerHelpers
+
+#ifdef NTUPLIZER_MULTISTREAM
+class PhaseIPixelNtuplizer : public edm::stream::EDAnalyzer<edm::GlobalCache<NtuplizerHelpers::OutputCache>>
+#elif CMSSW_VERSION >= 123
 class PhaseIPixelNtuplizer : public edm::one::EDAnalyzer<edm::one::WatchLuminosityBlocks, edm::one::WatchRuns>
 #else
 class PhaseIPixelNtuplizer : public edm::EDAnalyzer
@@ -147,11 +289,41 @@ class PhaseIPixelNtuplizer : public edm::EDAnalyzer
     static constexpr float                BARREL_MODULE_EDGE_X_CUT       = 0.6f;
     static constexpr float                BARREL_MODULE_EDGE_Y_CUT       = 3.0f;
 
+    // ROC binning of the efficiency counters (forward, layer 1-4)
+    struct ROCEfficiencyBinning
+    {
+      int   nx;
+      float xmin;
+      float xmax;
+      int   ny;
+      float ymin;
+      float ymax;
+    };
+    static constexpr std::array<ROCEfficiencyBinning, 5> ROC_EFFICIENCY_BINNINGS =
+    {{
+      {112, -3.5f, 3.5f, 140, -17.5f, 17.5f},
+      { 72, -4.5f, 4.5f,  26,  -6.5f,  6.5f},
+      { 72, -4.5f, 4.5f,  58, -14.5f, 14.5f},
+      { 72, -4.5f, 4.5f,  90, -22.5f, 22.5f},
+      { 72, -4.5f, 4.5f, 130, -32.5f, 32.5f}
+    }};
+
 public:
+#ifdef NTUPLIZER_MULTISTREAM
+  PhaseIPixelNtuplizer(edm::ParameterSet const& iConfig, const NtuplizerHelpers::OutputCache*);
+  virtual ~PhaseIPixelNtuplizer();
+  static std::unique_ptr<NtuplizerHelpers::OutputCache> initializeGlobalCache(edm::ParameterSet const&);
+  static void globalEndJob(NtuplizerHelpers::OutputCache*);
+  virtual void beginStream(edm::StreamID) override;
+  virtual void endStream() override;
+  void beginJob();
+  void endJob();
+#else
   PhaseIPixelNtuplizer(edm::ParameterSet const& iConfig);
   virtual ~PhaseIPixelNtuplizer();
   virtual void beginJob() override;
   virtual void endJob() override;
+#endif
   virtual void analyze(const edm::Event& iEvent, const edm::EventSetup& iSetup) override;
   virtual void beginRun(edm::Run const&, edm::EventSetup const&) override;
   virtual void endRun(edm::Run const&, edm::EventSetup const&) override;
@@ -179,6 +351,15 @@ private:
   int npixFromDigiCollection_;
   int minVertexSize_;
   LumisectionCount efficiencyCalculationFrequency_;
+  bool benchmarkModuleTable_;
+  edm::ParameterSet outputSettings_;
+  bool saveRNTuple_;
+  bool normalizeEventData_;
+  bool profileStages_;
+  bool efficiencyOnly_;
+  std::string downscaleMode_;
+  bool hashDownscaling_;
+  uint64_t eventDownscaleHash_ = 0;
 
   int nEvent_ = 0;
   LumisectionCount nLumisection_ = 0;
@@ -188,10 +369,19 @@ private:
 
   // Misc. data
   TFile*                                 ntupleOutputFile_;
+#ifdef NTUPLIZER_MULTISTREAM
+  std::shared_ptr<NtuplizerHelpers::BufferMergerFile> streamOutputFile_;
+  unsigned int streamIndex_ = 0;
+  int subFileIndex_ = -1;
+#endif
   edm::Handle<edm::ConditionsInRunBlock> conditionsInRunBlock_;
   std::vector<std::string>               triggerNames_;
   edm::InputTag                          triggerTag_;
-  std::map<uint32_t, int>                federrors_;
+  // Trigger bits set by the paths of the current HLT menu (path index, bitmask),
+  // rebuilt by getTriggerInfo() when the menu changes
+  edm::ParameterSetID                    triggerMenuID_;
+  std::vector<std::pair<unsigned int, int>> triggerPathBits_;
+  NtuplizerHelpers::FedErrorTable        federrors_;
 
 #if CMSSW_VERSION >= 123
   edm::ESGetToken<TransientTrackBuilder, TransientTrackRecord> trackBuilderToken_;
@@ -214,9 +404,23 @@ private:
   TTree* trajTree_;
   TTree* nonPropagatedExtraTrajTree_;
   TTree* trajROCEfficiencyTree_;
+  // Per-stage timing of analyze(), created if profileStages_ is set
+  std::unique_ptr<StageProfiler> stageProfiler_;
+#ifdef TREE_RNTUPLE_WRITER_AVAILABLE
+  // Column-wise copies of the trees, written if saveRNTuple_ is set
+  TFile*                                                  rntupleOutputFile_ = nullptr;
+  std::map<const TTree*, std::unique_ptr<TreeRNTupleWriter>> rntupleWriters_;
+#endif
+
+  // ROC efficiency counters of the trajectory measurements saved since the last flushROCEfficiencies()
+  std::array<int, 5>        rocEfficiencyOffsets_;
+  std::vector<unsigned int> rocEfficiencyPassed_;
+  std::vector<unsigned int> rocEfficiencyTotal_;
+  std::vector<int>          pendingROCEfficiencyIndices_; // one per trajTree_ entry, -1 if not on a ROC bin
 
   // Tree field definitions are in the interface directory
   EventData         evt_;
+  EventIndexData    eventIndex_;
   LumiData          lumi_;
   RunData           run_;
   Digi              digi_;
@@ -248,18 +452,92 @@ private:
   edm::Handle<edm::View<reco::Track>> muonTrackCollectionHandle_;
   edm::Handle<edm::ValueMap<std::vector<float>>> distancesToTrack_;
 
+  // Per-event cluster index, filled by buildClusterIndex()
+  struct ModuleClusterRange {
+    unsigned int begin; // position of the first cluster of the module in the DetSetVector data
+    unsigned int end;
+  };
+  const edmNew::DetSetVector<SiPixelCluster>*      clusterCollection_ = nullptr;
+  std::unordered_map<uint32_t, ModuleClusterRange> clusterIndex_;
+  // Per-event numbers of clusters and pixels, [0-3]: layer 1-4, [4-6]: disk 1-3
+  int                                              clusterIndexNclu_[7];
+  int                                              clusterIndexNpix_[7];
+
+  // Per-event CPE results of the clusters in clusterCollection_, filled lazily by getClusterParameters()
+  // The position of a cluster in the DetSetVector data is its DetSet offset + its index in the DetSet
+  struct ClusterParameters {
+    LocalPoint position;
+    LocalError error;
+  };
+  std::vector<ClusterParameters>     clusterParameters_;
+  std::vector<unsigned char>         clusterParametersFilled_;
+  ClusterParameters                  uncachedClusterParameters_;
+  unsigned long long int             nClusterParametersCacheHit_  = 0;
+  unsigned long long int             nClusterParametersCacheMiss_ = 0;
+
+  // Per-event trajectory measurement index and track counts, filled by NtuplizerHelpers::buildTrajMeasIndex()
+  NtuplizerHelpers::TrajMeasIndex  trajMeasIndex_;
+  NtuplizerHelpers::TrackHitCounts trackHitCounts_;
+
+  // Per-event distance (dR) of the tracks to their nearest other track
+  std::map<reco::TrackRef, float> nearestTrackDr_;
+
+  // Per-event sim tracks by their trackId, filled when the SimTrackContainer is read
+  std::unordered_map<unsigned int, const SimTrack*> simTrackById_;
+
+  // Per-event track-muon association, filled by matchTracksToMuons()
+  NtuplizerHelpers::PtEtaHash                                 muonHash_;
+  std::map<reco::TrackRef, NtuplizerHelpers::TrackMuonMatch> trackMuonMatches_;
+
+  // Module level informations for the offline [0] and online [1] conventions,
+  // rebuilt by buildModuleTable() when the geometry or the cabling changes
+  struct ModuleTableEntry {
+    int          det;
+    int          shl;
+    int          side;
+    int          module;
+    int          layer;
+    int          sec;
+    int          ladder;
+    int          flipped;
+    int          half;
+    int          disk;
+    int          blade;
+    int          panel;
+    int          ring;
+    unsigned int rawid;
+    unsigned int fedid;
+  };
+  std::vector<std::array<ModuleTableEntry, 2>> moduleTable_;
+  std::unordered_map<uint32_t, unsigned int>   moduleIndex_;
+  edm::ESWatcher<TrackerTopologyRcd>           trackerTopologyWatcher_;
+  edm::ESWatcher<TrackerDigiGeometryRecord>    trackerGeometryWatcher_;
+#if CMSSW_VERSION > 110
+  edm::ESWatcher<SiPixelFedCablingMapRcd>      cablingMapWatcher_;
+#endif
+  edm::ESWatcher<TrackingComponentsRecord>     trackingComponentsWatcher_;
+  edm::ESWatcher<CkfComponentsRecord>          measurementTrackerWatcher_;
+  edm::ESWatcher<TkPixelCPERecord>             pixelCPEWatcher_;
+  unsigned int numModuleInfoUpdates_         = 0;
+  unsigned int numTrackingComponentsUpdates_ = 0;
+  unsigned int numMeasurementTrackerUpdates_ = 0;
+  unsigned int numPixelCPEUpdates_           = 0;
+
   // Tools
   SiPixelCoordinates coord_;
   const PixelClusterParameterEstimator* pixelClusterParameterEstimator_;
   const TrackerTopology*                trackerTopology_;
   const TrackerGeometry*                trackerGeometry_;
-  const Propagator*                     trackerPropagator_;
+  std::unique_ptr<Propagator>           trackerPropagator_; // clone with the direction set to oppositeToMomentum
   const MeasurementTracker*             measurementTracker_;
   const MeasurementTrackerEvent*        measurementTrackerEvent_;
+  std::unique_ptr<LayerMeasurements>    layerMeasurements_;
+  const DetLayer*                       pixelBarrelLayer1_;
+  TempMeasurements                      tempMeasurements_; // hits of a detector in the layer 1 search
   const MeasurementEstimator*           chi2MeasurementEstimator_;
 #if ADD_SIM_INFO > 0
   //const TrackerHitAssociator*           trackerHitAssociator_;
-  PixelHitAssociator*                   pixelHitAssociator_;
+  std::unique_ptr<PixelHitAssociator>   pixelHitAssociator_; // created with the MC option, reset for every event
 #endif
 
 #ifdef ADD_CHECK_PLOTS_TO_NTUPLE
@@ -304,14 +582,23 @@ private:
   TH1D* disk1PropagationEtaEfficiency;
 
   // Private methods
+  bool updateEventSetupTools(const edm::EventSetup&);
+  bool isSelectedByDownscaling(unsigned long long int&, uint64_t, int);
   void setTriggerTable();
+  void openOutputFile();
+  void applyOutputSettings(TTree*);
+  static void applyOutputSettings(TTree*, const edm::ParameterSet&);
+  void updateClusterPixelBranchAddresses();
+  void fillTree(TTree*);
+  void addEventBranch(TTree*);
+  void createRNTupleWriters();
+  void closeRNTupleWriters();
+  static int getCompressionSettings(const std::string&, int);
 
   void getEvtData(const edm::Event&, const edm::Handle<reco::VertexCollection>&,
 		  const edm::Handle<edm::TriggerResults>&,
 		  const edm::Handle<std::vector<PileupSummaryInfo>>&,
-		  const edm::Handle<edm::DetSetVector<PixelDigi>>&,
-		  const edm::Handle<edmNew::DetSetVector<SiPixelCluster>>&,
-		  const edm::Handle<TrajTrackAssociationCollection>&);
+		  const edm::Handle<edm::DetSetVector<PixelDigi>>&);
 
   int getTriggerInfo(const edm::Event&, const edm::Handle<edm::TriggerResults>&);
 
@@ -352,6 +639,7 @@ private:
 				       TTree*);
 
   std::vector<TrajectoryMeasurement> getLayer1ExtrapolatedHitsFromMeas(const TrajectoryMeasurement&);
+  bool getFirstLayer1ExtrapolatedHitFromMeas(const TrajectoryMeasurement&, TrajectoryMeasurement&);
 
   enum TrajectoryMeasurementEfficiencyQualification
   {
@@ -361,11 +649,22 @@ private:
   };
 
   TrajectoryMeasurementEfficiencyQualification getTrajMeasurementEfficiencyQualification(const TrajectoryMeasurement& t_measurement);
+  bool passesTrackEfficiencyCuts();
+  bool passesModuleEfficiencyCuts();
 
   void getDisk1PropagationData(const edm::Handle<TrajTrackAssociationCollection>&);
 
-  std::vector<TEfficiency> getDetectorPartEfficienciesInTrajTreeEntryRange(const TrajMeasurement& t_trajField, const Long64_t& t_minEntry, const Long64_t& t_maxEntry);
-  void generateROCEfficiencyTree();
+  int getROCEfficiencyIndex(const ModuleData&);
+  static std::array<int, 5> getROCEfficiencyOffsets();
+  static std::array<float, 3> getROCEfficiencies(int, const std::vector<unsigned int>&,
+						 const std::vector<unsigned int>&);
+  void flushROCEfficiencies();
+#ifdef NTUPLIZER_MULTISTREAM
+  void addSummariesToGlobalCache();
+  static void completeROCEfficiencyWindow(const NtuplizerHelpers::OutputCache&,
+					  std::map<int, NtuplizerHelpers::ROCEfficiencyWindow>::iterator);
+  static void writeSummaryTrees(const NtuplizerHelpers::OutputCache&, TFile*);
+#endif
 
 
   void handleDefaultError(const std::string&, const std::string&, std::string);
@@ -374,7 +673,15 @@ private:
 
   void printEvtInfo(const std::string&);
 
+  int  getModuleIndex(const DetId&) const;
   void getModuleData(ModuleData&, bool, const DetId&);
+  void getModuleData(ModuleData&, bool, const DetId&, int);
+
+  void fillModuleDataFromCoordinates(ModuleData&, bool, const DetId&);
+
+  void buildModuleTable();
+
+  void benchmarkModuleTable();
 
   void getRocData(ModuleData&, bool, const DetId&, const PixelDigi*);
 
@@ -400,15 +707,25 @@ private:
 				 const edm::Handle<edmNew::DetSetVector<SiPixelCluster>>,
 				 const edm::Handle<reco::VertexCollection>&);
 
-  void findClosestClusters(const edm::Handle<edmNew::DetSetVector<SiPixelCluster> >&,
-			   uint32_t, float, float, float*, float*);
+  void buildClusterIndex(const edm::Handle<edmNew::DetSetVector<SiPixelCluster>>&);
+
+  void matchTracksToMuons(const edm::Handle<TrajTrackAssociationCollection>&,
+			  const edm::Handle<reco::MuonCollection>&);
+
+  NtuplizerHelpers::TrackMuonMatch getTrackMuonMatch(const reco::TrackRef&);
+
+  const ClusterParameters& getClusterParameters(const SiPixelCluster&, const GeomDetUnit&);
+
+  void findClosestClusters(uint32_t, float, float, float*, float*);
 };
 
 namespace NtuplizerHelpers 
 {
-  std::map<uint32_t, int>
+  void
   getFedErrors(const edm::Event&,
-	       const edm::EDGetTokenT<edm::DetSetVector<SiPixelRawDataError>>&);
+	       const edm::EDGetTokenT<edm::DetSetVector<SiPixelRawDataError>>&,
+	       const std::unordered_map<uint32_t, unsigned int>&,
+	       FedErrorTable&, int&);
 
   bool detidIsOnPixel(const DetId&);
 
@@ -431,9 +748,29 @@ namespace NtuplizerHelpers
 
   bool sameTrack(const reco::TrackRef&, const reco::TrackRef&);
 
+  void buildTrajMeasIndex(const edm::Handle<TrajTrackAssociationCollection>&, const TrackerTopology*,
+                          TrajMeasIndex&, TrackHitCounts&);
+
+  void getNearestTrackDistances(const edm::Handle<TrajTrackAssociationCollection>&,
+                                std::map<reco::TrackRef, float>&);
+
+  uint64_t getDownscaleHash(uint64_t, uint64_t);
+
+  // Adds the counters of the lumisection to a lumisection or run summary
+  template<typename Summary>
+  void addSummaryCounts(Summary& sum, const LumiData& lumi) {
+    sum.nevt    += lumi.nevt;
+    sum.nfederr += lumi.nfederr;
+    for(size_t i = 0; i < 7; i++) {
+      sum.nclu[i]     += lumi.nclu[i];
+      sum.npix[i]     += lumi.npix[i];
+      sum.nvalid[i]   += lumi.nvalid[i];
+      sum.nmissing[i] += lumi.nmissing[i];
+    }
+  }
+
   void getClosestTrajMeasDistance
-  (const TrajectoryMeasurement&, const reco::TrackRef&,
-   const edm::Handle<TrajTrackAssociationCollection>&,
+  (uint32_t, float, float, const reco::TrackRef&, const TrajMeasIndex&,
    float&, float&, float&);
 
 
@@ -15,6 +15,7 @@
 
 //for accumulate
 #include <numeric>
+#include <algorithm>
 #include <iostream>
 
 // For hit->pixel matching
@@ -27,11 +28,11 @@ using namespace edm;
 //
 // Constructor 
 //
-PixelHitAssociator::PixelHitAssociator(const edm::Event& e)  : 
+PixelHitAssociator::PixelHitAssociator(edm::ConsumesCollector&& iC)  
   //doPixel_( true ),
   //doStrip_( false ), 
   //doTrackAssoc_( false ), 
-  myEvent_(e) { 
+{ 
 
   trackerContainers.clear();
   trackerContainers.push_back("TrackerHitsPixelBarrelLowTof");
@@ -39,78 +40,94 @@ PixelHitAssociator::PixelHitAssociator(const edm::Event& e)  :
   trackerContainers.push_back("TrackerHitsPixelEndcapLowTof");
   trackerContainers.push_back("TrackerHitsPixelEndcapHighTof");
     
-  SimHitMap.clear();
-
-  for(auto const& trackerContainer : trackerContainers) {     
-    //cout<<" "<<trackerContainer<<endl;
-      edm::Handle<std::vector<PSimHit> > simHits;
-      edm::InputTag tag("g4SimHits", trackerContainer);
-      e.getByLabel(tag, simHits);
-
-      int i=0;
-      for (std::vector<PSimHit>::const_iterator isim=simHits->begin(); 
-	   isim!= simHits->end();isim++) {
-	i++;
-	//std::cout<<i<<" "<<(*isim).detUnitId()<<std::endl;
-	SimHitMap[(*isim).detUnitId()].push_back((*isim));
-      }
-    } // for loop
-    
-  //std::cout<<" size "<<SimHitMap.size()<<std::endl;
-
-  e.getByLabel("simSiPixelDigis", pixeldigisimlink);
-  //e.getByLabel("mix", pixeldigisimlink);
-  
+  consumeInputs(iC);
 }
 
 //
 // Constructor with configurables
 // Modified to work with simple PSimHit containers and not the crossing bullshit
-PixelHitAssociator::PixelHitAssociator(const edm::Event& e, const edm::ParameterSet& conf)  : 
+PixelHitAssociator::PixelHitAssociator(const edm::ParameterSet& conf, edm::ConsumesCollector&& iC)  
   //doPixel_( conf.getParameter<bool>("associatePixel") ),
   //doStrip_( conf.getParameter<bool>("associateStrip") ),
   //doTrackAssoc_( conf.getParameter<bool>("associateRecoTracks") ),
-  myEvent_(e) {
+{
   
   //cout<<" from constructor "<<doPixel_<<" "<<doStrip_<<" "<<doTrackAssoc_<<endl;
 
-  //if(!doTrackAssoc_) {
-    
-    trackerContainers.clear();
-    trackerContainers = conf.getParameter<std::vector<std::string> >("ROUList");
+  trackerContainers.clear();
+  trackerContainers = conf.getParameter<std::vector<std::string> >("ROUList");
     
-    SimHitMap.clear();
-
-    for(auto const& trackerContainer : trackerContainers) {     
-      //cout<<" "<<trackerContainer<<endl;
-      edm::Handle<std::vector<PSimHit> > simHits;
-      edm::InputTag tag("g4SimHits", trackerContainer);
-      e.getByLabel(tag, simHits);
-
-      //cout<<simHits->size()<<endl;
-      int i=0;
-      for (std::vector<PSimHit>::const_iterator isim=simHits->begin(); 
-	   isim!= simHits->end();isim++) {
-	i++;
-	//std::cout<<i<<" "<<(*isim).detUnitId()<<std::endl;
-	SimHitMap[(*isim).detUnitId()].push_back((*isim));
+  consumeInputs(iC);
+}
+
+void PixelHitAssociator::consumeInputs(edm::ConsumesCollector& iC) {
+
+  simHitTokens_.clear();
+  for(auto const& trackerContainer : trackerContainers)
+    simHitTokens_.push_back(iC.consumes<std::vector<PSimHit> >(edm::InputTag("g4SimHits", trackerContainer)));
+  pixelDigiSimLinkToken_ = iC.consumes<edm::DetSetVector<PixelDigiSimLink> >(edm::InputTag("simSiPixelDigis"));
+  //pixelDigiSimLinkToken_ = iC.consumes<edm::DetSetVector<PixelDigiSimLink> >(edm::InputTag("mix"));
+}
+
+// Indexes the sim hits of the event by module and by (module, sim track, event),
+// the sim hits stay in the event products
+void PixelHitAssociator::reset(const edm::Event& e) {
+
+  // The vectors of the modules keep their capacity
+  for(auto& module: moduleIndex_) {
+    module.second.simHits.clear();
+    module.second.nextSimHitOfTrack.clear();
+    module.second.links.clear();
+    module.second.linksFilled = false;
+  }
+  simHitsOfTrack_.clear();
+
+  for(const auto& simHitToken : simHitTokens_) {     
+    edm::Handle<std::vector<PSimHit> > simHits;
+    e.getByToken(simHitToken, simHits);
+
+    for(const PSimHit& simHit: *simHits) {
+      ModuleIndex& module = moduleIndex_[simHit.detUnitId()];
+      const int position = module.simHits.size();
+      module.simHits.push_back(&simHit);
+      module.nextSimHitOfTrack.push_back(-1);
+      auto inserted = simHitsOfTrack_.emplace(SimHitKey{ simHit.detUnitId(), simHit.trackId(), simHit.eventId().rawId() },
+					      std::make_pair(position, position));
+      if(!inserted.second) {
+	module.nextSimHitOfTrack[inserted.first -> second.second] = position;
+	inserted.first -> second.second = position;
       }
+    }
+  } // for loop
 
-      //std::cout<<" simhit size "<<SimHitMap.size()<<std::endl;
+  //std::cout<<" size "<<moduleIndex_.size()<<std::endl;
 
-    } // for loop
-    
-//}
+  e.getByToken(pixelDigiSimLinkToken_, pixeldigisimlink);
+}
 
-  e.getByLabel("simSiPixelDigis", pixeldigisimlink);
-  //e.getByLabel("mix", pixeldigisimlink);
-  
+// The digi sim links of a module with their pixel coordinates, sorted by column
+const std::vector<PixelHitAssociator::ModuleLink>& PixelHitAssociator::getModuleLinks(uint32_t detID, ModuleIndex& module) {
+
+  if(module.linksFilled) return module.links;
+  module.linksFilled = true;
+
+  edm::DetSetVector<PixelDigiSimLink>::const_iterator isearch = pixeldigisimlink->find(detID); 
+  if(isearch != pixeldigisimlink->end()) {  //if it is not empty
+    for(const PixelDigiSimLink& link: isearch->data) {
+      std::pair<int,int> pixel_coord = PixelDigi::channelToPixel(link.channel());
+      module.links.push_back({ pixel_coord.second, pixel_coord.first, SimHitIdpr(link.SimTrackId(), link.eventId()) });
+    }
+    // Stable, to keep the order of the sim track ids of the clusters
+    std::stable_sort(module.links.begin(), module.links.end(),
+		     [] (const ModuleLink& lhs, const ModuleLink& rhs) { return lhs.col < rhs.col; });
+  }
+  return module.links;
 }
 
 
-std::vector<PSimHit> PixelHitAssociator::associateHit(const TrackingRecHit & thit, LocalPoint lp)  {  
+const std::vector<const PSimHit*>& PixelHitAssociator::associateHit(const TrackingRecHit & thit, LocalPoint lp)  {  
   //vector with the matched SimHit
-  std::vector<PSimHit> result; 
+  matchedSimHits_.clear();
   //initialize vectors!
   simtrackid.clear();
   simhitCFPos.clear();
@@ -122,103 +139,71 @@ std::vector<PSimHit> PixelHitAssociator::associateHit(const TrackingRecHit & thi
   uint32_t detID = detid.rawId();
 
   //check we are in the pixel tracker
-  if( (unsigned int)(detid.subdetId()) == PixelSubdetector::PixelBarrel || 
-      (unsigned int)(detid.subdetId()) == PixelSubdetector::PixelEndcap)   {
-    // valid hits
-    if (thit.getType() == TrackingRecHit::valid) {
-      if(const SiPixelRecHit * rechit = dynamic_cast<const SiPixelRecHit *>(&thit)) {	  
-        //std::cout << "associate to pixelHit" << std::endl;
-        //check if the cluster reference is valid
-        //    edm::Ref< edm::DetSetVector<SiPixelCluster>, SiPixelCluster> const& cluster = rechit->cluster();
-        SiPixelRecHit::ClusterRef const& cluster = rechit->cluster();
-        if(!(cluster.isNull())){//if the cluster is valid
-          int minPixelRow = (*cluster).minPixelRow();
-          int maxPixelRow = (*cluster).maxPixelRow();
-          int minPixelCol = (*cluster).minPixelCol();
-          int maxPixelCol = (*cluster).maxPixelCol();
-          if(verbose) 
-            std::cout << "    Cluster minRow " << minPixelRow << " maxRow " 
-                      << maxPixelRow << "    Cluster minCol " 
-                      << minPixelCol << " maxCol " << maxPixelCol << std::endl;
-          
-          DetId detid=  rechit->geographicalId();
-          uint32_t detID = detid.rawId();
-          
-          // Find digis for module
-          edm::DetSetVector<PixelDigiSimLink>::const_iterator isearch = pixeldigisimlink->find(detID); 
-          if(isearch != pixeldigisimlink->end()) {  //if it is not empty
-            edm::DetSet<PixelDigiSimLink> link_detset = (*isearch);
-            
-            // loop on digis
-            edm::DetSet<PixelDigiSimLink>::const_iterator linkiter = link_detset.data.begin();
-            int dsl = 0;
-            std::vector<SimHitIdpr> idcachev;
-            for( ; linkiter != link_detset.data.end(); linkiter++) {
-              dsl++;
-              std::pair<int,int> pixel_coord = PixelDigi::channelToPixel(linkiter->channel());
-              if(verbose) std::cout << "    " << dsl << ") Digi link: row " << pixel_coord.first << " col " << pixel_coord.second << std::endl;      
-              if(  pixel_coord.first  <= maxPixelRow && 
-                   pixel_coord.first  >= minPixelRow &&
-                   pixel_coord.second <= maxPixelCol &&
-                   pixel_coord.second >= minPixelCol ) {
-                if(verbose) std::cout << "      !-> trackid   " << linkiter->SimTrackId() << " fraction  " << linkiter->fraction()   << endl;
-                SimHitIdpr currentId(linkiter->SimTrackId(), linkiter->eventId());
-                if(find(idcachev.begin(),idcachev.end(),currentId) == idcachev.end()){
-                  simtrackid.push_back(currentId);
-                  idcachev.push_back(currentId);
-                }
-              } 
-            }
-          }
-          
-          //cout << "Associator for pixels " << detID << endl;
-          
-          // This part is for pixel rechits
-          //now get the SimHit from the trackid
-          std::map<unsigned int, std::vector<PSimHit> >::const_iterator it = SimHitMap.find(detID);
-          if (it!= SimHitMap.end()){
-            vector<PSimHit>::const_iterator simHitIter = (it->second).begin();
-            vector<PSimHit>::const_iterator simHitIterEnd = (it->second).end();
-            
-            for (;simHitIter != simHitIterEnd; ++simHitIter) {
-              const PSimHit& ihit = *simHitIter;
-              unsigned int simHitid = ihit.trackId();
-              EncodedEventId simHiteid = ihit.eventId();
-              
-              for(size_t i=0; i<simtrackid.size();i++){
-                if(simHitid == simtrackid[i].first && simHiteid == simtrackid[i].second){ 
-                  if (verbose) cout << "Associator ---> ID" << ihit.trackId() << " Simhit x= " << ihit.localPosition().x() 
-                                    << " y= " <<  ihit.localPosition().y() << " z= " <<  ihit.localPosition().x() << endl; 
-                  result.push_back(ihit);
-                }
-              }
-            }
-          }
-        }
-      }
-    } else {
-      // Associate also missing hits with the closest simhit found on the same module
-      float mindist = 999999;
-      PSimHit mhit;
-      std::map<unsigned int, std::vector<PSimHit> >::const_iterator it = SimHitMap.find(detID);
-      if (it!= SimHitMap.end()){
-        vector<PSimHit>::const_iterator simHitIter = (it->second).begin();
-        vector<PSimHit>::const_iterator simHitIterEnd = (it->second).end();
-        for (;simHitIter != simHitIterEnd; ++simHitIter) {
-          const PSimHit& ihit = *simHitIter;
-          float dist = (lp - ihit.localPosition()).mag();
-          if (dist<mindist) {
-            mindist = dist;
-            mhit = ihit;
-            if (verbose) std::cout<<"SimHit found for missing hit: dist="<<dist<<std::endl;
-          }
-        }
+  if( (unsigned int)(detid.subdetId()) != PixelSubdetector::PixelBarrel && 
+      (unsigned int)(detid.subdetId()) != PixelSubdetector::PixelEndcap) return matchedSimHits_;
+
+  // Modules without sim hits in any event so far get an empty entry
+  ModuleIndex& module = moduleIndex_[detID];
+
+  // valid hits
+  if (thit.getType() == TrackingRecHit::valid) {
+    const SiPixelRecHit * rechit = dynamic_cast<const SiPixelRecHit *>(&thit);
+    if(rechit == nullptr) return matchedSimHits_;
+    //check if the cluster reference is valid
+    SiPixelRecHit::ClusterRef const& cluster = rechit->cluster();
+    if(cluster.isNull()) return matchedSimHits_;
+    int minPixelRow = (*cluster).minPixelRow();
+    int maxPixelRow = (*cluster).maxPixelRow();
+    int minPixelCol = (*cluster).minPixelCol();
+    int maxPixelCol = (*cluster).maxPixelCol();
+    if(verbose) 
+      std::cout << "    Cluster minRow " << minPixelRow << " maxRow " 
+		<< maxPixelRow << "    Cluster minCol " 
+		<< minPixelCol << " maxCol " << maxPixelCol << std::endl;
+
+    // Sim track ids of the digi sim links inside the cluster, each only once
+    const std::vector<ModuleLink>& links = getModuleLinks(detID, module);
+    auto linkIt = std::lower_bound(links.begin(), links.end(), minPixelCol,
+				   [] (const ModuleLink& link, int col) { return link.col < col; });
+    for(; linkIt != links.end() && linkIt -> col <= maxPixelCol; ++linkIt) {
+      if(linkIt -> row < minPixelRow || maxPixelRow < linkIt -> row) continue;
+      if(verbose) std::cout << "      !-> trackid   " << linkIt -> id.first << endl;
+      if(find(simtrackid.begin(), simtrackid.end(), linkIt -> id) == simtrackid.end())
+	simtrackid.push_back(linkIt -> id);
+    }
+    if(module.simHits.empty()) return matchedSimHits_;
+
+    //now get the SimHits from the trackids
+    matchedSimHitIndices_.clear();
+    for(const SimHitIdpr& id: simtrackid) {
+      auto simHitsOfTrackIt = simHitsOfTrack_.find({ detID, id.first, id.second.rawId() });
+      if(simHitsOfTrackIt == simHitsOfTrack_.end()) continue;
+      for(int position = simHitsOfTrackIt -> second.first; position != -1; position = module.nextSimHitOfTrack[position])
+	matchedSimHitIndices_.push_back(position);
+    }
+    std::sort(matchedSimHitIndices_.begin(), matchedSimHitIndices_.end());
+    for(int simHitIndex: matchedSimHitIndices_) {
+      const PSimHit* ihit = module.simHits[simHitIndex];
+      if (verbose) cout << "Associator ---> ID" << ihit->trackId() << " Simhit x= " << ihit->localPosition().x() 
+			<< " y= " <<  ihit->localPosition().y() << " z= " <<  ihit->localPosition().z() << endl; 
+      matchedSimHits_.push_back(ihit);
+    }
+  } else {
+    // Associate also missing hits with the closest simhit found on the same module
+    float mindist = 999999;
+    const PSimHit* mhit = nullptr;
+    for (const PSimHit* ihit: module.simHits) {
+      float dist = (lp - ihit->localPosition()).mag();
+      if (dist<mindist) {
+	mindist = dist;
+	mhit = ihit;
+	if (verbose) std::cout<<"SimHit found for missing hit: dist="<<dist<<std::endl;
       }
-      if (mindist!=999999) result.push_back(mhit);
     }
+    if (mhit != nullptr) matchedSimHits_.push_back(mhit);
   }
   
-  return result;  
+  return matchedSimHits_;  
 }
 
 
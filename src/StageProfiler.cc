@@ -0,0 +1,150 @@
+// File: StageProfiler.cc
+
+#include "../interface/StageProfiler.h"
+
+#include <algorithm>
+#include <cstdio>
+#include <iomanip>
+#include <iostream>
+
+#include <unistd.h>
+
+const char* StageProfiler::getStageName(Stage stage) {
+  static const std::array<const char*, numStages> stageNames = {
+    "getEvtData", "getDigiData", "getSimhitData", "getClustData", "getTrackData",
+    "getTrajTrackData", "layer1Propagation", "simMatching", "treeFill", "other" };
+  return stageNames[stage];
+}
+
+void StageProfiler::bookHistograms(TDirectory* directory) {
+
+  TDirectory* timingDirectory = directory -> mkdir("timing");
+  // The axes are extended when needed
+  for(int stage = 0; stage < numStages; ++stage) {
+    const std::string stageName = getStageName(static_cast<Stage>(stage));
+    stages_[stage].histogram = new TH1D(("time_" + stageName).c_str(),
+					(stageName + " per event;time [ms];events").c_str(), 200, 0.0, 10.0);
+    stages_[stage].histogram -> SetCanExtend(TH1::kXaxis);
+    stages_[stage].histogram -> SetDirectory(timingDirectory);
+  }
+  eventTimeHistogram_ = new TH1D("time_event", "analyze() per event;time [ms];events", 200, 0.0, 100.0);
+  eventTimeHistogram_ -> SetCanExtend(TH1::kXaxis);
+  eventTimeHistogram_ -> SetDirectory(timingDirectory);
+  peakMemoryIncreaseHistogram_ = new TH1D("peakMemoryIncrease",
+					  "Peak resident memory increase per event;increase [MB];events",
+					  200, 0.0, 10.0);
+  peakMemoryIncreaseHistogram_ -> SetCanExtend(TH1::kXaxis);
+  peakMemoryIncreaseHistogram_ -> SetDirectory(timingDirectory);
+}
+
+void StageProfiler::beginEvent() {
+
+  for(auto& stats: stages_) {
+    stats.eventTime  = 0;
+    stats.eventCalls = 0;
+  }
+  stageStack_.assign(1, other);
+  eventStartMemory_ = eventMaxMemory_ = getResidentBytes();
+  eventStartTime_   = lastTime_       = Clock::now();
+}
+
+void StageProfiler::endEvent() {
+
+  chargeRunningStage();
+  sampleMemory();
+  stageStack_.clear();
+  ++stages_[other].eventCalls;
+
+  for(auto& stats: stages_) {
+    if(stats.eventCalls == 0) continue;
+    stats.calls     += stats.eventCalls;
+    stats.totalTime += stats.eventTime;
+    stats.maxTime    = std::max(stats.maxTime, stats.eventTime);
+    ++stats.events;
+    if(stats.histogram) stats.histogram -> Fill(stats.eventTime);
+  }
+
+  const double eventTime = std::chrono::duration<double, std::milli>(lastTime_ - eventStartTime_).count();
+  ++numEvents_;
+  totalEventTime_ += eventTime;
+  maxEventTime_    = std::max(maxEventTime_, eventTime);
+  if(eventTimeHistogram_) eventTimeHistogram_ -> Fill(eventTime);
+
+  const double peakMemoryIncrease = (eventMaxMemory_ - eventStartMemory_) / 1.0e6;
+  totalPeakMemoryIncrease_ += peakMemoryIncrease;
+  maxPeakMemoryIncrease_    = std::max(maxPeakMemoryIncrease_, peakMemoryIncrease);
+  if(peakMemoryIncreaseHistogram_) peakMemoryIncreaseHistogram_ -> Fill(peakMemoryIncrease);
+}
+
+void StageProfiler::start(Stage stage) {
+
+  chargeRunningStage();
+  stageStack_.push_back(stage);
+  ++stages_[stage].eventCalls;
+  // The memory is only sampled around the stages called directly from
+  // analyze(), sampling it around every tree fill would distort the timing
+  if(stageStack_.size() == 2) sampleMemory();
+}
+
+void StageProfiler::stop() {
+
+  chargeRunningStage();
+  if(stageStack_.size() == 2) sampleMemory();
+  stageStack_.pop_back();
+}
+
+void StageProfiler::printSummary() const {
+
+  const double numEvents = std::max(numEvents_, 1LL);
+  std::cout << " --- Stage profile --- " << std::endl;
+  std::cout << "Events: " << numEvents_ << std::endl;
+  std::cout << std::left << std::setw(20) << "stage" << std::right
+	    << std::setw(12) << "calls"         << std::setw(10) << "events"
+	    << std::setw(12) << "total [s]"     << std::setw(12) << "mean [ms]"
+	    << std::setw(12) << "max [ms]"      << std::setw(10) << "fraction" << std::endl;
+  for(int stage = 0; stage < numStages; ++stage) {
+    const StageStats& stats = stages_[stage];
+    std::cout << std::left << std::setw(20) << getStageName(static_cast<Stage>(stage)) << std::right
+	      << std::setw(12) << stats.calls << std::setw(10) << stats.events
+	      << std::fixed << std::setprecision(3)
+	      << std::setw(12) << stats.totalTime / 1000.0
+	      << std::setw(12) << stats.totalTime / numEvents
+	      << std::setw(12) << stats.maxTime
+	      << std::setw(10) << (0.0 < totalEventTime_ ? stats.totalTime / totalEventTime_ : 0.0)
+	      << std::defaultfloat << std::endl;
+  }
+  std::cout << std::left << std::setw(42) << "analyze()" << std::right
+	    << std::fixed << std::setprecision(3)
+	    << std::setw(12) << totalEventTime_ / 1000.0
+	    << std::setw(12) << totalEventTime_ / numEvents
+	    << std::setw(12) << maxEventTime_ << std::defaultfloat << std::endl;
+  std::cout << "Mean and max stage times are per event." << std::endl;
+  std::cout << "Peak resident memory increase per event [MB], mean: " << totalPeakMemoryIncrease_ / numEvents
+	    << ", max: " << maxPeakMemoryIncrease_ << std::endl;
+  std::cout << "Resident memory at the end of the job [MB]: " << getResidentBytes() / 1.0e6 << std::endl;
+  std::cout << " --- End stage profile --- " << std::endl;
+}
+
+void StageProfiler::chargeRunningStage() {
+
+  const Clock::time_point now = Clock::now();
+  stages_[stageStack_.back()].eventTime += std::chrono::duration<double, std::milli>(now - lastTime_).count();
+  lastTime_ = now;
+}
+
+void StageProfiler::sampleMemory() {
+
+  eventMaxMemory_ = std::max(eventMaxMemory_, getResidentBytes());
+}
+
+// Resident set size of the process, 0 where /proc is not available
+long long int StageProfiler::getResidentBytes() {
+
+  long long int numPages = 0;
+  long long int numResidentPages = 0;
+  FILE* statm = std::fopen("/proc/self/statm", "r");
+  if(statm == nullptr) return 0;
+  if(std::fscanf(statm, "%lld %lld", &numPages, &numResidentPages) != 2) numResidentPages = 0;
+  std::fclose(statm);
+  return numResidentPages * sysconf(_SC_PAGESIZE);
+}
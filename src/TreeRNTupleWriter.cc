@@ -0,0 +1,123 @@
+// File: TreeRNTupleWriter.cc
+
+#include "../interface/TreeRNTupleWriter.h"
+
+#ifdef TREE_RNTUPLE_WRITER_AVAILABLE
+
+#include "FWCore/Utilities/interface/Exception.h"
+
+#include <TObjArray.h>
+
+#include <algorithm>
+#include <map>
+
+namespace {
+
+  // RNTuple type names of the leaf types used in the leaf-lists
+  std::string getFieldTypeName(const std::string& leafTypeName) {
+    static const std::map<std::string, std::string> fieldTypeNames = {
+      { "Char_t",    "char"          },
+      { "UChar_t",   "std::uint8_t"  },
+      { "Short_t",   "std::int16_t"  },
+      { "UShort_t",  "std::uint16_t" },
+      { "Int_t",     "std::int32_t"  },
+      { "UInt_t",    "std::uint32_t" },
+      { "Long64_t",  "std::int64_t"  },
+      { "ULong64_t", "std::uint64_t" },
+      { "Float_t",   "float"         },
+      { "Double_t",  "double"        },
+      { "Bool_t",    "bool"          } };
+    const auto fieldTypeName = fieldTypeNames.find(leafTypeName);
+    if(fieldTypeName == fieldTypeNames.end())
+      throw cms::Exception("rntuple_output") << "Unsupported leaf type: " << leafTypeName;
+    return fieldTypeName -> second;
+  }
+
+  // Array dimensions from a leaf title, e.g. "federrs[16][2]" -> {16, 2}
+  std::vector<int> getFixedDimensions(const std::string& leafTitle) {
+    std::vector<int> dimensions;
+    size_t begin = leafTitle.find('[');
+    while(begin != std::string::npos) {
+      const size_t end = leafTitle.find(']', begin);
+      dimensions.push_back(std::stoi(leafTitle.substr(begin + 1, end - begin - 1)));
+      begin = leafTitle.find('[', end);
+    }
+    return dimensions;
+  }
+
+} // namespace
+
+TreeRNTupleWriter::TreeRNTupleWriter(TTree* tree, TFile& file) {
+
+  auto model = RNTupleAPI::RNTupleModel::CreateBare();
+
+  TIter nextBranch(tree -> GetListOfBranches());
+  while(TBranch* branch = static_cast<TBranch*>(nextBranch())) {
+
+    TObjArray* leaves = branch -> GetListOfLeaves();
+    std::vector<std::unique_ptr<RNTupleAPI::RFieldBase>> itemFields;
+
+    for(int numLeaf = 0; numLeaf < leaves -> GetEntriesFast(); ++numLeaf) {
+      TLeaf* leaf = static_cast<TLeaf*>(leaves -> At(numLeaf));
+      const std::string fieldTypeName = getFieldTypeName(leaf -> GetTypeName());
+
+      // Variable length leaves are stored as flattened vectors
+      if(leaf -> GetLeafCount() != nullptr) {
+	const bool isFloat = std::string(leaf -> GetTypeName()) == "Float_t";
+	if(!isFloat && std::string(leaf -> GetTypeName()) != "Int_t")
+	  throw cms::Exception("rntuple_output") << "Unsupported variable length leaf type: "
+						 << leaf -> GetTypeName();
+	const std::string fieldName = leaves -> GetEntriesFast() == 1 ?
+	  branch -> GetName() : std::string(branch -> GetName()) + "_" + leaf -> GetName();
+	model -> AddField(RNTupleAPI::RFieldBase::Create
+			  (fieldName, "std::vector<" + fieldTypeName + ">").Unwrap());
+	variableLengthColumns_.push_back({ branch, leaf, fieldName, leaf -> GetLenStatic(), isFloat, {}, {} });
+	continue;
+      }
+
+      // The record field lays out its items with natural alignment,
+      // that has to agree with the offsets of the leaf-list
+      if(leaf -> GetOffset() % leaf -> GetLenType() != 0)
+	throw cms::Exception("rntuple_output") << "Misaligned leaf: " << branch -> GetName()
+					       << "." << leaf -> GetName();
+      std::string itemTypeName = fieldTypeName;
+      const std::vector<int> dimensions = getFixedDimensions(leaf -> GetTitle());
+      for(auto dimension = dimensions.rbegin(); dimension != dimensions.rend(); ++dimension)
+	itemTypeName = "std::array<" + itemTypeName + "," + std::to_string(*dimension) + ">";
+      itemFields.push_back(RNTupleAPI::RFieldBase::Create(leaf -> GetName(), itemTypeName).Unwrap());
+    }
+
+    if(itemFields.empty()) continue;
+    model -> AddField(std::make_unique<RNTupleAPI::RRecordField>(branch -> GetName(), std::move(itemFields)));
+    recordColumns_.push_back({ branch, branch -> GetName() });
+  }
+
+  writer_ = RNTupleAPI::RNTupleWriter::Append(std::move(model), tree -> GetName(), file);
+  entry_  = writer_ -> CreateEntry();
+}
+
+void TreeRNTupleWriter::fill() {
+
+  // Addresses may change between the fills (e.g. growing cluster pixel storage)
+  for(const auto& column: recordColumns_)
+    entry_ -> BindRawPtr(column.fieldName, column.branch -> GetAddress());
+
+  for(auto& column: variableLengthColumns_) {
+    const char* values = column.branch -> GetAddress() + column.leaf -> GetOffset();
+    const int count    = static_cast<int>(column.leaf -> GetLeafCount() -> GetValue());
+    const int numValues = std::max(0, count) * column.staticLength;
+    if(column.isFloat) {
+      const float* first = reinterpret_cast<const float*>(values);
+      column.floatValues.assign(first, first + numValues);
+      entry_ -> BindRawPtr(column.fieldName, &column.floatValues);
+    } else {
+      const int* first = reinterpret_cast<const int*>(values);
+      column.intValues.assign(first, first + numValues);
+      entry_ -> BindRawPtr(column.fieldName, &column.intValues);
+    }
+  }
+
+  writer_ -> Fill(*entry_);
+}
+
+#endif
@@ -195,7 +195,7 @@ process.schedule = cms.Schedule(
     process.endjob_step
 )
 
-##Setup FWK for multithreaded
+##Setup FWK for multithreaded (needs the plugin built with -DNTUPLIZER_MULTISTREAM, see README)
 #process.options.numberOfThreads=cms.untracked.uint32(8)
 #process.options.numberOfStreams=cms.untracked.uint32(0)
 #process.options.numberOfConcurrentLuminosityBlocks=cms.untracked.uint32(1)
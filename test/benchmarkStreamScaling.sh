@@ -0,0 +1,55 @@
+#!/bin/bash -e
+##########################################################################
+# Scaling of the multi-stream ntuplizer with the number of streams
+#
+#   Runs test/run_PhaseIPixelNtuplizer_Data_2025_150X_cfg.py with 1, 2, 4
+#   and 8 threads/streams in both output modes (bufferMerger, subFiles)
+#   and prints the event throughput of each job. The startup time is
+#   measured with a job of zero events and subtracted.
+#
+#   The plugin has to be built with the multi-stream option:
+#   scram b -j 8 USER_CXXFLAGS="-DCMSSW_VERSION=123 -DNTUPLIZER_MULTISTREAM"
+#
+# Usage:
+#   test/benchmarkStreamScaling.sh <input file> <global tag> [data tier] [number of events]
+#   eg:
+#   test/benchmarkStreamScaling.sh file:ALCARECO.root 150X_dataRun3_Prompt_v1 ALCARECO 2000
+##########################################################################
+
+if [ $# -lt 2 ]; then
+    echo "Usage: $0 <input file> <global tag> [data tier] [number of events]"
+    exit 1
+fi
+
+INPUT=$1
+GLOBALTAG=$2
+DATATIER=${3:-ALCARECO}
+NEVENTS=${4:-2000}
+CFG=test/run_PhaseIPixelNtuplizer_Data_2025_150X_cfg.py
+LOGDIR=benchmarkStreamScaling_logs
+mkdir -p $LOGDIR
+
+# Wall time of a cmsRun job in seconds
+run_job() {
+    local nthreads=$1 mode=$2 nevents=$3
+    local log=$LOGDIR/threads${nthreads}_${mode}_${nevents}.log
+    local start=$(date +%s.%N)
+    cmsRun $CFG inputFileName=$INPUT globalTag=$GLOBALTAG dataTier=$DATATIER \
+	maxEvents=$nevents multiStream=True nThreads=$nthreads outputMode=$mode \
+	outputFileName=$LOGDIR/Ntuple_threads${nthreads}_${mode}.root > $log 2>&1
+    local end=$(date +%s.%N)
+    echo "$end - $start" | bc -l
+}
+
+printf "%-14s %8s %12s %12s %10s\n" "mode" "threads" "time [s]" "events/s" "speedup"
+for mode in bufferMerger subFiles; do
+    base=""
+    for nthreads in 1 2 4 8; do
+	startup=$(run_job $nthreads $mode 0)
+	total=$(run_job $nthreads $mode $NEVENTS)
+	loop=$(echo "$total - $startup" | bc -l)
+	rate=$(echo "$NEVENTS / $loop" | bc -l)
+	[ -z "$base" ] && base=$rate
+	printf "%-14s %8d %12.1f %12.2f %10.2f\n" $mode $nthreads $loop $rate $(echo "$rate / $base" | bc -l)
+    done
+done
@@ -185,6 +185,18 @@ opt.register('prescale',           1,
 	     opts.VarParsing.multiplicity.singleton, opts.VarParsing.varType.int,
 	     'Save only 1/nth of the events (to conserve disk space for long runs)')
 
+opt.register('multiStream',        False,
+	     opts.VarParsing.multiplicity.singleton, opts.VarParsing.varType.bool,
+	     'The plugin is built with -DNTUPLIZER_MULTISTREAM: run nThreads streams, use outputMode')
+
+opt.register('nThreads',           1,
+	     opts.VarParsing.multiplicity.singleton, opts.VarParsing.varType.int,
+	     'Number of threads and streams (multiStream only)')
+
+opt.register('outputMode',         'bufferMerger',
+	     opts.VarParsing.multiplicity.singleton, opts.VarParsing.varType.string,
+	     'Output of the multi-stream plugin: bufferMerger or subFiles (multiStream only)')
+
 opt.register('loadTagsFromPrep',   '',
              opts.VarParsing.multiplicity.singleton, opts.VarParsing.varType.string,
              'Load and use condition(s) from Prep automatically (can specify more if separated by commas, useful for quick validation)')
@@ -196,6 +208,13 @@ opt.setDefault('maxEvents', -1)
 opt.parseArguments()
 
 process.maxEvents.input = opt.maxEvents
+# The default (edm::one) plugin processes one event at a time, more threads would only wait for it
+if opt.multiStream:
+	process.options.numberOfThreads = opt.nThreads
+	process.options.numberOfStreams = opt.nThreads
+elif opt.nThreads != 1 or opt.outputMode != 'bufferMerger':
+	raise Exception('nThreads and outputMode need the multi-stream plugin:'
+			' build it with -DNTUPLIZER_MULTISTREAM and run with multiStream=True')
 process.MessageLogger.cerr.FwkReport.reportEvery = 10
 
 # Switch off magnetic field if needed
@@ -267,12 +286,32 @@ process.PhaseINtuplizerPlugin = cms.EDAnalyzer("PhaseIPixelNtuplizer",
     eventSaveDownscaleFactor       = cms.untracked.int32(opt.prescale),
     trackSaveDownscaleFactor       = cms.untracked.int32(1),
     clusterSaveDownscaleFactor     = cms.untracked.int32(1),
+    # counter: every N-th event/track/cluster, hash: reproducible selection independent of the job splitting
+    downscaleMode                  = cms.untracked.string("counter"),
     saveDigiTree                   = cms.untracked.bool(False),
     saveTrackTree                  = cms.untracked.bool(True),
     saveNonPropagatedExtraTrajTree = cms.untracked.bool(False),
     clusterCollection              = cms.InputTag("siPixelClusters"),
+    # save only the run and event numbers instead of the event data outside the eventTree
+    normalizeEventData             = cms.untracked.bool(False),
+    # time the processing stages of the events (histograms in the timing directory)
+    profileStages                  = cms.untracked.bool(False),
+    # save only the traj. measurements entering the hit efficiency (pass_effcuts)
+    efficiencyOnly                 = cms.untracked.bool(False),
+    # output compression and basket settings, PSets named after a tree override the defaults
+    # (see test/benchmarkOutputSettings.C to compare the settings)
+    #outputSettings = cms.untracked.PSet(
+    #    compressionAlgorithm = cms.untracked.string("ZSTD"), # ZLIB, LZMA, LZ4 or ZSTD
+    #    compressionLevel     = cms.untracked.int32(5),
+    #    autoFlush            = cms.untracked.int64(-30000000),
+    #    trajTree             = cms.untracked.PSet(basketSize = cms.untracked.int32(256000)),
+    #),
     )
 
+# Output of the streams (multi-stream plugin only): bufferMerger or subFiles
+if opt.multiStream:
+    process.PhaseINtuplizerPlugin.outputMode = cms.untracked.string(opt.outputMode)
+
 # Switch ALCARECO collections
 if opt.dataTier == 'ALCARECO':
     process.MeasurementTrackerEvent.pixelClusterProducer = 'ALCARECOSiPixelCalSingleMuonTight'
@@ -316,6 +355,10 @@ print("  useLocalGain                           = ", str(opt.useLocalGain))
 print("  useLocalGenErr                         = ", str(opt.useLocalGenErr))
 print("  useLocalTemplates                      = ", str(opt.useLocalTemplates))
 print("  prescale                               = ", str(opt.prescale))
+print("  multiStream                            = ", str(opt.multiStream))
+if opt.multiStream:
+    print("  nThreads                               = ", str(opt.nThreads))
+    print("  outputMode                             = ", str(opt.outputMode))
 
 if opt.loadTagsFromPrep != '':
     Rcds = {